@@ -0,0 +1,158 @@
+#
+# Step tree memory benchmark.
+#
+#   python benchmarks/memory_bench.py [options]
+#
+#   -s <shape>,...      - shapes to build, default: flat,wide,deps
+#                           flat  - <n> commands in one parallel group
+#                           wide  - parallel group of <n>/10 sequential groups, 10 commands each
+#                           deps  - <n> commands in chains of 10 linked with -id/-after
+#   -n <n>              - number of commands, default: 100000
+#   -v <n>              - number of variables added to the environment, default: 300
+#   -r <rev>,...        - also measure the director package from these git revisions, e.g. -r HEAD~1
+#   -o <file>           - append results to the file, default: stdout
+#
+# Only the tree is measured: convert(), paths, dependency resolution and run environments.
+# Parsing is done before.
+# Each case runs in a separate process. Results are written as JSON, one line per case:
+#
+#   bytes_per_step      - memory allocated for the tree, by tracemalloc, divided by the number of steps
+#   rss_kb              - RSS growth while building the tree, without tracemalloc
+#   build_s             - time to build the tree, without tracemalloc
+#
+
+import sys, os, time, getopt, json, subprocess, tempfile, tarfile, io, gc
+
+Root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def generate_flat(n):
+    return "{\n    -multiplicity=16\n" + "    true\n" * n + "}\n"
+
+def generate_wide(n):
+    lines = ["{", "    -multiplicity=16"]
+    for _ in range(n // 10):
+        lines.append("    [")
+        lines += ["        true"] * 10
+        lines.append("    ]")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+def generate_deps(n):
+    lines = ["{", "    -multiplicity=16"]
+    for i in range(n):
+        after = " -after=s%d" % (i - 1,) if i % 10 else ""
+        lines += ["    ( -id=s%d%s" % (i, after), "        true", "    )"]
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+Generators = {"flat": generate_flat, "wide": generate_wide, "deps": generate_deps}
+
+
+def rss_kb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+def count_steps(tree):
+    if hasattr(tree, "walk"):
+        return len(list(tree.walk()))
+    return 1 + sum(count_steps(step) for step in getattr(tree, "Steps", ()))    # revisions without walk()
+
+def run_case(shape, n):
+    import tracemalloc
+    from director.parser import Parser, convert
+    try:
+        from director.context import Context
+    except ImportError:
+        Context = None          # revisions before the shared context, steps are built without it
+    try:
+        from director import dag
+    except ImportError:
+        dag = None              # revisions before -after
+
+    parsed = Parser().parse(Generators[shape](n))
+    environ = dict(os.environ)
+
+    def build():
+        tree = convert(parsed, context=Context()) if Context is not None else convert(parsed)
+        if hasattr(tree, "set_path"):
+            tree.set_path("0")
+        if dag is not None:
+            dag.resolve(tree)
+        tree.update_run_env(environ)
+        return tree
+
+    gc.collect()
+    rss0 = rss_kb()
+    t0 = time.time()
+    tree = build()
+    build_time = time.time() - t0
+    rss = rss_kb() - rss0
+    nsteps = count_steps(tree)
+    del tree
+    gc.collect()
+
+    tracemalloc.start()
+    tree = build()
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "shape":            shape,
+        "commands":         n,
+        "steps":            nsteps,
+        "bytes_per_step":   traced / nsteps,
+        "traced_mb":        traced / 1e6,
+        "rss_kb":           rss,
+        "build_s":          build_time,
+        "python":           sys.version.split()[0],
+        "time":             time.time()
+    }
+
+def extract(rev, where):
+    # extracts the director package at the git revision into the directory
+    data = subprocess.run(["git", "-C", Root, "archive", "--format=tar", rev, "director"],
+                stdout=subprocess.PIPE, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        tar.extractall(where)
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "s:n:v:r:o:", ["case=", "source="])
+    opts = dict(opts)
+    n = int(opts.get("-n", 100000))
+    nvars = int(opts.get("-v", 300))
+
+    if "--case" in opts:
+        # internal: run one case with the director package from --source and print the result
+        sys.path.insert(0, opts["--source"])
+        for i in range(nvars):
+            os.environ["DIRECTOR_BENCH_%d" % (i,)] = "value_%d_" % (i,) + "x" * 40
+        print(json.dumps(run_case(opts["--case"], n)))
+        return
+
+    shapes = opts.get("-s", "flat,wide,deps").split(",")
+    revisions = [rev for rev in opts.get("-r", "").split(",") if rev]
+    out = open(opts["-o"], "a") if "-o" in opts else sys.stdout
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sources = [("working tree", Root)]
+        for rev in revisions:
+            where = os.path.join(tmp, rev.replace("/", "_"))
+            extract(rev, where)
+            sources.append((rev, where))
+        for shape in shapes:
+            for label, source in sources:
+                cmd = [sys.executable, __file__, "--case=" + shape, "--source=" + source, "-n", str(n), "-v", str(nvars)]
+                result = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout.decode("utf-8").strip().split("\n")[-1]
+                record = json.loads(result)
+                record["source"] = label
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+                print("%-5s %-14s %7d steps  %7.0f bytes/step  rss: %8dK  build: %6.3fs" % (
+                        shape, label, record["steps"], record["bytes_per_step"], record["rss_kb"], record["build_s"]),
+                    file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
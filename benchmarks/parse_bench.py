@@ -0,0 +1,72 @@
+#
+# Parse throughput benchmark.
+#
+#   python benchmarks/parse_bench.py [-n <commands>,...] [-e]
+#
+#   -n  - comma separated list of script sizes (number of commands), default: 1000,10000,50000
+#   -e  - also time the Earley parser with a separate transform pass, for comparison
+#
+
+import sys, time, getopt, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from director.parser import Parser, grammar
+
+
+def generate_script(ncommands, group_size=100):
+    # sequential group of parallel groups with options, env and comments
+    lines = ["[", "    env PATH=/usr/bin:$PATH"]
+    i = 0
+    while i < ncommands:
+        lines.append("    {    # group %d" % (i // group_size,))
+        lines.append("        - multiplicity=5")
+        lines.append("        env GROUP=%d" % (i // group_size,))
+        for _ in range(min(group_size, ncommands - i)):
+            if i % 10 == 0:
+                lines.append('        ( - title="step %d"' % (i,))
+                lines.append("            echo %d; sleep 0  # comment" % (i,))
+                lines.append("        )")
+            else:
+                lines.append("        /bin/echo step %d" % (i,))
+            i += 1
+        lines.append("    }")
+    lines.append("]")
+    return "\n".join(lines) + "\n"
+
+
+def time_lalr(text):
+    t0 = time.time()
+    Parser().parse(text)
+    return time.time() - t0
+
+
+def time_earley(text):
+    from lark import Lark
+    t0 = time.time()
+    Parser().transform(Lark(grammar, start="script").parse(text))
+    return time.time() - t0
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "n:e")
+    opts = dict(opts)
+    sizes = [int(x) for x in opts.get("-n", "1000,10000,50000").split(",")]
+    earley = "-e" in opts
+
+    t0 = time.time()
+    Parser.lark_parser()
+    print("parser construction: %.3fs" % (time.time() - t0,))
+
+    for n in sizes:
+        text = generate_script(n)
+        t = time_lalr(text)
+        line = "%8d commands %9d bytes  lalr: %7.3fs  %9.0f commands/s" % (n, len(text), t, n/t)
+        if earley:
+            te = time_earley(text)
+            line += "  earley: %7.3fs  speedup: %.1fx" % (te, te/t)
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#
+# Producer/consumer benchmark: data passed through a temporary file in a sequential group vs. streamed
+# through -stdin pipes in a parallel group.
+#
+#   python benchmarks/pipe_bench.py [-s <size>] [-c <consumers>] [-E <engine>,...] [-d <dir>]
+#
+#   -s  - amount of data, default: 1G
+#   -c  - number of consumers, default: 1. With more than 1, the pipes go through the tee
+#   -E  - engines, default: threads,asyncio
+#   -d  - directory for the temporary file, default: the system temporary directory
+#
+# The producer is "head -c <size> /dev/zero", each consumer is "wc -c". Prints one JSON line per engine
+# with the times and the speedup of the pipes.
+#
+
+import sys, time, getopt, os, json, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from director.director import Script
+from director.context import Context
+from director.resources import parse_size
+
+
+def file_script(size, consumers, path):
+    consume = "\n".join("        wc -c %s" % (path,) for _ in range(consumers))
+    return "[\n    head -c %d /dev/zero > %s\n    {\n%s\n    }\n    rm -f %s\n]\n" % (size, path, consume, path)
+
+def pipe_script(size, consumers):
+    consume = "".join("    ( -stdin=producer\n        wc -c\n    )\n" for _ in range(consumers))
+    return "{ -multiplicity=%d\n    ( -id=producer\n        head -c %d /dev/zero\n    )\n%s}\n" % (consumers + 1, size, consume)
+
+def time_run(text, engine):
+    script = Script(text, context=Context(history=None))
+    t0 = time.time()
+    status = script.run(True, engine)
+    assert status == "ok", status
+    return time.time() - t0
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "s:c:E:d:")
+    opts = dict(opts)
+    size = parse_size(opts.get("-s", "1G"))
+    consumers = int(opts.get("-c", 1))
+    directory = opts.get("-d") or tempfile.gettempdir()
+
+    for engine in opts.get("-E", "threads,asyncio").split(","):
+        with tempfile.TemporaryDirectory(dir=directory) as tmp:
+            through_file = time_run(file_script(size, consumers, os.path.join(tmp, "data")), engine)
+        through_pipe = time_run(pipe_script(size, consumers), engine)
+        print(json.dumps({
+            "engine":           engine,
+            "bytes":            size,
+            "consumers":        consumers,
+            "file_s":           through_file,
+            "pipe_s":           through_pipe,
+            "speedup":          through_file / through_pipe
+        }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#
+# Scheduler overhead benchmark.
+#
+#   python benchmarks/scheduler_bench.py [options]
+#
+#   -s <shape>,...      - shapes to run, default: flat,deep,wide,env
+#                           flat  - <n> "true" commands in one parallel group
+#                           deep  - <n> levels of alternating sequential/parallel groups
+#                           wide  - parallel group of <n>/10 sequential groups, 10 commands each
+#                           env   - <n> commands under groups with large env blocks
+#   -n <shape>=<n>,...  - override the size of shapes, default: flat=10000,deep=200,wide=10000,env=1000
+#   -E <engine>,...     - engines to run, default: threads,asyncio
+#   -m <multiplicity>   - multiplicity of parallel groups, default: 16
+#   -x                  - do not poll the status server during the run
+#   -o <file>           - append results to the file, default: stdout
+#
+# Each shape/engine case runs in a separate process, so that peak RSS is measured per case.
+# Results are written as JSON, one line per case:
+#
+#   parse_s                 - parsing time
+#   tree_s                  - tree construction: convert(), paths, dependency resolution
+#   run_s                   - run time of the whole script
+#   spawn_to_start_ms       - from the step start to its process running: resource checks, buffers, fork/exec
+#   exit_to_next_start_ms   - from a command end to the start of the next command in the same slot
+#   peak_rss_kb             - peak RSS of the director process
+#   status_latency_ms       - latency of GET / on the status server, polled continuously during the run
+#
+
+import sys, time, getopt, os, json, subprocess, socket, threading, resource, gc, platform
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from director.parser import Parser, convert
+from director.context import Context
+from director.director import Script
+from director.usage import command_spans, assign_slots
+from director.version import Version
+from director import dag
+
+DefaultSizes = {"flat": 10000, "deep": 200, "wide": 10000, "env": 1000}
+
+
+def generate_flat(n, multiplicity):
+    return "{\n    -multiplicity=%d\n" % (multiplicity,) + "    true\n" * n + "}\n"
+
+def generate_deep(n, multiplicity):
+    lines = []
+    for level in range(n):
+        indent = "  " * level
+        if level % 2:
+            lines.append(indent + "{")
+            lines.append(indent + "  -multiplicity=%d" % (multiplicity,))
+        else:
+            lines.append(indent + "[")
+        lines.append(indent + "  true")
+    for level in reversed(range(n)):
+        lines.append("  " * level + ("}" if level % 2 else "]"))
+    return "\n".join(lines) + "\n"
+
+def generate_wide(n, multiplicity):
+    lines = ["{", "    -multiplicity=%d" % (multiplicity,)]
+    for _ in range(n // 10):
+        lines.append("    [")
+        lines += ["        true"] * 10
+        lines.append("    ]")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+def generate_env(n, multiplicity, nvars=100, group_size=100):
+    lines = ["["] + ["    env OUTER_%d=value_%d_$PATH" % (i, i) for i in range(nvars)]
+    for g in range(0, n, group_size):
+        lines.append("    {")
+        lines.append("        -multiplicity=%d" % (multiplicity,))
+        lines += ["        env INNER_%d=group_%d_$OUTER_%d" % (i, g, i) for i in range(nvars)]
+        lines += ["        true"] * min(group_size, n - g)
+        lines.append("    }")
+    lines.append("]")
+    return "\n".join(lines) + "\n"
+
+Generators = {"flat": generate_flat, "deep": generate_deep, "wide": generate_wide, "env": generate_env}
+
+
+def stats(values, scale=1.0):
+    if not values:
+        return None
+    values = sorted(v * scale for v in values)
+    n = len(values)
+    return {
+        "n":        n,
+        "mean":     sum(values) / n,
+        "p50":      values[n // 2],
+        "p99":      values[min(n - 1, int(n * 0.99))],
+        "max":      values[-1]
+    }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_case(shape, n, engine, multiplicity, poll_status):
+    text = Generators[shape](n, multiplicity)
+
+    t0 = time.time()
+    parsed = Parser().parse(text)
+    parse_time = time.time() - t0
+
+    t0 = time.time()
+    tree = convert(parsed, context=Context())
+    tree.set_path("0")
+    dag.resolve(tree)
+    tree_time = time.time() - t0
+    del parsed, tree
+    gc.collect()
+
+    port = free_port()
+    script = Script(text, port, Context())
+    latencies = []
+    done = threading.Event()
+
+    def poll():
+        url = "http://127.0.0.1:%d/" % (port,)
+        while not done.is_set():
+            t = time.time()
+            try:
+                urlopen(url, timeout=10).read()
+            except OSError:
+                time.sleep(0.01)            # the server is not up yet
+                continue
+            latencies.append(time.time() - t)
+
+    poller = None
+    if poll_status:
+        poller = threading.Thread(target=poll, daemon=True)
+        poller.start()
+    t0 = time.time()
+    status = script.run(True, engine)
+    run_time = time.time() - t0
+    done.set()
+    if poller is not None:
+        poller.join()
+
+    spans = command_spans(script.Tree)
+    spawn_to_start = [step.ProcessStartT - step.StartT for _, _, step in spans]
+    slots, nslots = assign_slots(spans)
+    last_end = {}
+    exit_to_next = []
+    for slot, t0, t1, step in slots:
+        if slot in last_end:
+            exit_to_next.append(t0 - last_end[slot])
+        last_end[slot] = t1
+    ncommands = len(spans)
+
+    return {
+        "shape":                    shape,
+        "size":                     n,
+        "engine":                   engine,
+        "multiplicity":             multiplicity,
+        "commands":                 ncommands,
+        "status":                   status,
+        "script_bytes":             len(text),
+        "parse_s":                  parse_time,
+        "tree_s":                   tree_time,
+        "run_s":                    run_time,
+        "commands_per_s":           ncommands / run_time if run_time > 0 else None,
+        "slots":                    nslots,
+        "spawn_to_start_ms":        stats(spawn_to_start, 1000.0),
+        "exit_to_next_start_ms":    stats(exit_to_next, 1000.0),
+        "peak_rss_kb":              resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "status_latency_ms":        stats(latencies, 1000.0),
+        "director_version":         Version,
+        "python":                   platform.python_version(),
+        "time":                     time.time()
+    }
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "s:n:E:m:xo:", ["case="])
+    opts = dict(opts)
+    multiplicity = int(opts.get("-m", 16))
+    poll_status = "-x" not in opts
+
+    if "--case" in opts:
+        # internal: run one case in this process and print the result
+        shape, n, engine = opts["--case"].split(":")
+        print(json.dumps(run_case(shape, int(n), engine, multiplicity, poll_status)))
+        return
+
+    shapes = opts.get("-s", "flat,deep,wide,env").split(",")
+    engines = opts.get("-E", "threads,asyncio").split(",")
+    sizes = dict(DefaultSizes)
+    for item in opts.get("-n", "").split(","):
+        if item:
+            name, size = item.split("=")
+            sizes[name] = int(size)
+    out = open(opts["-o"], "a") if "-o" in opts else sys.stdout
+
+    for shape in shapes:
+        for engine in engines:
+            cmd = [sys.executable, __file__, "--case=%s:%d:%s" % (shape, sizes[shape], engine), "-m", str(multiplicity)]
+            if not poll_status:
+                cmd.append("-x")
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout.decode("utf-8").strip().split("\n")[-1]
+            record = json.loads(result)
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            print("%-5s %-8s %6d commands  parse: %6.3fs  tree: %6.3fs  run: %7.3fs  %7.0f commands/s  rss: %7dK" % (
+                    shape, engine, record["commands"], record["parse_s"], record["tree_s"], record["run_s"],
+                    record["commands_per_s"] or 0, record["peak_rss_kb"]),
+                file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
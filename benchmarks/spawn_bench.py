@@ -0,0 +1,60 @@
+#
+# Process creation benchmark: /bin/sh per command vs. posix_spawn fast path for simple commands
+# vs. long-lived shell workers.
+#
+#   python benchmarks/spawn_bench.py [-n <commands>] [-m <multiplicity>] [-E <engine>,...] [-c <command>]
+#
+#   -n  - number of commands in the parallel group, default: 2000
+#   -m  - multiplicity of the group, default: 16
+#   -E  - engines, default: threads,asyncio
+#   -c  - command to run, default: "true"
+#
+# Prints one JSON line per engine with commands/s for each mode and the speedups relative to the shell.
+#
+
+import sys, time, getopt, os, json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from director.director import Script
+from director.context import Context
+
+
+def generate_script(n, multiplicity, command):
+    return "{\n    -multiplicity=%d\n" % (multiplicity,) + ("    %s\n" % (command,)) * n + "}\n"
+
+def time_run(text, engine, **context_args):
+    script = Script(text, context=Context(**context_args))
+    t0 = time.time()
+    status = script.run(True, engine)
+    assert status == "ok", status
+    return time.time() - t0
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "n:m:E:c:")
+    opts = dict(opts)
+    n = int(opts.get("-n", 2000))
+    multiplicity = int(opts.get("-m", 16))
+    command = opts.get("-c", "true")
+    text = generate_script(n, multiplicity, command)
+
+    for engine in opts.get("-E", "threads,asyncio").split(","):
+        shell = time_run(text, engine, fast_spawn=False)
+        fast = time_run(text, engine, fast_spawn=True)
+        workers = time_run(text, engine, shell_workers=True)
+        print(json.dumps({
+            "engine":           engine,
+            "command":          command,
+            "commands":         n,
+            "multiplicity":     multiplicity,
+            "shell_per_s":      n / shell,
+            "spawn_per_s":      n / fast,
+            "workers_per_s":    n / workers,
+            "spawn_speedup":    shell / fast,
+            "workers_speedup":  shell / workers
+        }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#
+# Startup latency benchmark: a one-command script run as a new process, from the interpreter start
+# through the imports to the first spawned command and the exit.
+#
+#   python benchmarks/startup_bench.py [options]
+#
+#   -n <n>              - number of runs of each case, default: 20
+#   -e <engine>,...     - engines, default: threads,asyncio
+#   -r <rev>,...        - also measure the director package from these git revisions, e.g. -r HEAD~1
+#   -o <file>           - append results to the file, default: stdout
+#
+# The processes run in a temporary directory, so the package is imported from the source, not from
+# the current directory. Each run uses its own XDG_CACHE_HOME:
+#
+#   warm    - the cache directory is shared by the runs and filled by a run before, as in repeated use
+#   cold    - a new cache directory for each run, nothing is cached
+#
+# The command is "touch <file>", the time of the first spawn is the modification time of the file.
+# Results are medians in milliseconds, one JSON line per source, engine and cache:
+#
+#   python_ms           - python -c pass, for reference
+#   import_ms           - python -c "import director.director"
+#   first_spawn_ms      - from the start of the director process to the start of the command
+#   total_ms            - from the start of the director process to its exit
+#
+
+import sys, os, time, getopt, json, subprocess, tempfile, tarfile, io, statistics
+
+Root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def extract(rev, where):
+    # extracts the director package at the git revision into the directory
+    data = subprocess.run(["git", "-C", Root, "archive", "--format=tar", rev, "director"],
+                stdout=subprocess.PIPE, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        tar.extractall(where)
+
+def run_once(source, engine, cache_home, tmp):
+    marker = os.path.join(tmp, "spawned")
+    script = os.path.join(tmp, "script.txt")
+    with open(script, "w") as f:
+        f.write("touch %s\n" % (marker,))
+    if os.path.exists(marker):
+        os.remove(marker)
+    env = dict(os.environ, PYTHONPATH=source, XDG_CACHE_HOME=cache_home)
+    t0 = time.time()
+    subprocess.run([sys.executable, "-m", "director.director", "-q", "--engine=" + engine, script],
+        env=env, check=True, stdout=subprocess.DEVNULL, cwd=tmp)
+    t1 = time.time()
+    return os.stat(marker).st_mtime_ns / 1e9 - t0, t1 - t0
+
+def python_time(code, source, cache_home):
+    env = dict(os.environ, PYTHONPATH=source, XDG_CACHE_HOME=cache_home)
+    os.makedirs(cache_home, exist_ok=True)
+    t0 = time.time()
+    subprocess.run([sys.executable, "-c", code], env=env, check=True, cwd=cache_home)
+    return time.time() - t0
+
+def measure(source, engine, n, cold, tmp):
+    spawns, totals, imports, pythons = [], [], [], []
+    warm_home = os.path.join(tmp, "cache-warm")
+    if not cold:
+        run_once(source, engine, warm_home, tmp)            # fills the cache
+    for i in range(n):
+        home = os.path.join(tmp, "cache-cold-%d" % (i,)) if cold else warm_home
+        pythons.append(python_time("pass", source, home))
+        imports.append(python_time("import director.director", source, home))
+        spawn, total = run_once(source, engine, home, tmp)
+        spawns.append(spawn)
+        totals.append(total)
+    return {
+        "python_ms":        statistics.median(pythons) * 1000,
+        "import_ms":        statistics.median(imports) * 1000,
+        "first_spawn_ms":   statistics.median(spawns) * 1000,
+        "total_ms":         statistics.median(totals) * 1000
+    }
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], "n:e:r:o:")
+    opts = dict(opts)
+    n = int(opts.get("-n", 20))
+    engines = opts.get("-e", "threads,asyncio").split(",")
+    revisions = [rev for rev in opts.get("-r", "").split(",") if rev]
+    out = open(opts["-o"], "a") if "-o" in opts else sys.stdout
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sources = [("working tree", Root)]
+        for rev in revisions:
+            where = os.path.join(tmp, "src-" + rev.replace("/", "_"))
+            extract(rev, where)
+            sources.append((rev, where))
+        for label, source in sources:
+            for engine in engines:
+                for cold in (False, True):
+                    with tempfile.TemporaryDirectory(dir=tmp) as case_tmp:
+                        record = measure(source, engine, n, cold, case_tmp)
+                    record.update({"source": label, "engine": engine, "cache": "cold" if cold else "warm",
+                        "runs": n, "python": sys.version.split()[0], "time": time.time()})
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+                    print("%-14s %-8s %-5s python: %6.1fms  import: %6.1fms  first spawn: %6.1fms  total: %6.1fms" % (
+                            label, engine, record["cache"], record["python_ms"], record["import_ms"], record["first_spawn_ms"],
+                            record["total_ms"]),
+                        file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import os, time, threading
+from collections import deque
+
+#
+# Adaptive multiplicity of parallel groups:
+#
+#   -multiplicity=auto              - between 1 and 4 x number of CPUs
+#   -multiplicity=auto:<max>
+#   -multiplicity=auto:<min>..<max>
+#
+# The group starts with the number of CPUs, within the bounds, and adjusts the limit every Interval
+# seconds from the system state sampled from /proc (AIMD):
+#
+#   - halved when memory or I/O pressure (Linux PSI), or the load average per CPU, is above the threshold
+#   - incremented by 1 when CPUs are idle, the group has steps waiting and all its slots are busy,
+#     doubled instead until the first decrease
+#
+# After a decrease, the limit is not decreased again until the number of running steps drops to it,
+# because the running steps still add to the load.
+#
+
+def read_first_line(path):
+    try:
+        with open(path, "r") as f:
+            return f.readline()
+    except OSError:
+        return None
+
+def pressure(resource):
+    # PSI "some" and "full" avg10 percentages, or None if not available
+    out = {}
+    try:
+        with open(f"/proc/pressure/{resource}", "r") as f:
+            for line in f:
+                kind, *fields = line.split()
+                out[kind] = float(dict(field.split("=") for field in fields)["avg10"])
+    except (OSError, ValueError, KeyError):
+        return None
+    return out
+
+
+class LoadMonitor(object):
+    #
+    # Samples the system state, at most once per MinInterval seconds, for all groups of the process
+    #
+
+    MinInterval = 0.5
+
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.CPUs = os.cpu_count() or 1
+        self.CPUTimes = None            # (idle, total) from /proc/stat at the previous sample
+        self.Last = None                # the last sample
+        self.LastT = 0.0
+
+    def cpu_idle(self):
+        # fraction of the CPU time idle since the previous sample
+        line = read_first_line("/proc/stat")
+        if line is None or not line.startswith("cpu "):
+            return None
+        times = [int(x) for x in line.split()[1:]]
+        idle, total = times[3] + times[4], sum(times)           # idle + iowait
+        previous, self.CPUTimes = self.CPUTimes, (idle, total)
+        if previous is None or total == previous[1]:
+            return None
+        return (idle - previous[0]) / (total - previous[1])
+
+    def sample(self):
+        with self.Lock:
+            now = time.time()
+            if self.Last is None or now - self.LastT >= self.MinInterval:
+                loadavg = read_first_line("/proc/loadavg")
+                memory = pressure("memory")
+                io = pressure("io")
+                self.Last = {
+                    "load_per_cpu":     float(loadavg.split()[0]) / self.CPUs if loadavg else None,
+                    "cpu_idle":         self.cpu_idle(),
+                    "memory_pressure":  memory["some"] if memory else None,
+                    "io_pressure":      io.get("full") if io else None
+                }
+                self.LastT = now
+            return self.Last
+
+Monitor = LoadMonitor()
+
+
+class AdaptiveLimit(object):
+
+    Interval = 1.0
+    MemoryPressureHigh = 10.0       # % of time some tasks were stalled on memory in the last 10 seconds
+    IOPressureHigh = 20.0           # % of time all tasks were stalled on I/O
+    LoadHigh = 1.5                  # 1 minute load average per CPU
+    IdleLow = 0.1                   # do not grow if less CPU time than that is idle
+    History = 20                    # adjustments kept for the status
+
+    def __init__(self, spec):
+        # spec: "auto", "auto:<max>" or "auto:<min>..<max>"
+        _, _, bounds = spec.partition(":")
+        cpus = Monitor.CPUs
+        try:
+            if ".." in bounds:
+                low, high = (int(x) for x in bounds.split(".."))
+            else:
+                low, high = 1, int(bounds) if bounds else 4*cpus
+        except ValueError:
+            raise ValueError(f"Invalid multiplicity: {spec}, expected auto, auto:<max> or auto:<min>..<max>")
+        if not 1 <= low <= high:
+            raise ValueError(f"Invalid multiplicity bounds: {spec}")
+        self.Min, self.Max = low, high
+        self.Limit = max(low, min(high, cpus))
+        self.NextT = 0.0
+        self.Sample = None
+        self.Draining = False           # decreased, waiting for the running steps to drop to the limit
+        self.SlowStart = True           # no decrease yet
+        self.Adjustments = deque(maxlen=self.History)       # (time, from, to, reason)
+
+    def overload(self, sample):
+        # reason to decrease the limit, or None
+        if sample["memory_pressure"] is not None and sample["memory_pressure"] > self.MemoryPressureHigh:
+            return "memory pressure %.1f%%" % (sample["memory_pressure"],)
+        if sample["io_pressure"] is not None and sample["io_pressure"] > self.IOPressureHigh:
+            return "I/O pressure %.1f%%" % (sample["io_pressure"],)
+        if sample["load_per_cpu"] is not None and sample["load_per_cpu"] > self.LoadHigh:
+            return "load average %.2f per CPU" % (sample["load_per_cpu"],)
+        return None
+
+    def adjust(self, running, waiting):
+        # running: number of steps running, waiting: the group has steps to start.
+        # Returns (new limit, reason) if the limit has changed, or None
+        now = time.time()
+        if now < self.NextT:
+            return None
+        self.NextT = now + self.Interval
+        sample = self.Sample = Monitor.sample()
+        if running <= self.Limit:
+            self.Draining = False
+        limit, reason = self.Limit, self.overload(sample)
+        if reason is not None:
+            if not self.Draining:
+                limit = max(self.Min, self.Limit // 2)
+        elif waiting and running >= self.Limit and sample["cpu_idle"] is not None and sample["cpu_idle"] > self.IdleLow:
+            limit = min(self.Max, self.Limit * 2 if self.SlowStart else self.Limit + 1)
+            reason = "CPU idle %.0f%%" % (sample["cpu_idle"]*100,)
+        if limit == self.Limit:
+            return None
+        self.Draining = limit < self.Limit
+        self.SlowStart = self.SlowStart and not self.Draining
+        self.Adjustments.append((now, self.Limit, limit, reason))
+        self.Limit = limit
+        return limit, reason
+
+    def next_check(self):
+        return max(0.0, self.NextT - time.time())
+
+    def dump(self):
+        return {
+            "limit":        self.Limit,
+            "min":          self.Min,
+            "max":          self.Max,
+            "load":         self.Sample,
+            "adjustments":  [{"time": t, "from": old, "to": new, "reason": reason}
+                                for t, old, new, reason in self.Adjustments]
+        }
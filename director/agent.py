@@ -0,0 +1,307 @@
+import sys, os, json, socket, signal, selectors, threading, codecs, traceback
+from pythreader import Primitive, synchronized
+from .usage import rusage_dict
+from .spawn import spawn
+
+#
+# Director agent runs commands on behalf of a director running on another host.
+#
+# Protocol: one TCP connection per command, JSON messages, one per line.
+#
+#   director -> agent:
+#       {"op":"run", "command":"...", "env":{...}}
+#       {"op":"kill", "grace":<seconds>}                SIGTERM to the command process group,
+#                                                       SIGKILL if it still runs after the grace period
+#   agent -> director:
+#       {"event":"started", "pid":1234}
+#       {"event":"out", "stream":"out"|"err", "data":"..."}
+#       {"event":"exit", "code":0, "usage":{...}}        usage: see usage.py
+#
+# If the director closes the connection before the command exits, the command is killed, with
+# AgentConnection.KillGrace seconds between SIGTERM and SIGKILL.
+#
+
+Usage = """
+director-agent [-b <bind address>] [-p <port>]
+    -b <address>    - address to listen on, default 127.0.0.1. The agent runs any command it receives,
+                      listen on a public address only on a trusted network
+    -p <port>       - port to listen on, default 8890
+"""
+
+DefaultPort = 8890
+
+
+class AgentConnection(threading.Thread):
+
+    ChunkSize = 64*1024
+    KillGrace = 1.0
+
+    def __init__(self, sock):
+        threading.Thread.__init__(self, daemon=True)
+        self.Sock = sock
+        self.File = sock.makefile("rb")
+        self.Process = None
+        self.Killed = False
+
+    def send(self, **message):
+        self.Sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+    def kill(self, grace=None):
+        # as a local command is killed, see reaper.py: SIGTERM, then SIGKILL after the grace period
+        if self.Process is None or self.Process.returncode is not None or self.Killed:
+            return
+        self.Killed = True
+        grace = self.KillGrace if grace is None else grace
+        if grace > 0:
+            self.signal(signal.SIGTERM)
+            timer = threading.Timer(grace, self.signal, (signal.SIGKILL,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.signal(signal.SIGKILL)
+
+    def signal(self, sig):
+        if self.Process.returncode is None:
+            try:
+                os.killpg(self.Process.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def read_requests(self):
+        # runs in a separate thread while the command is running
+        try:
+            for line in self.File:
+                request = json.loads(line)
+                if request.get("op") == "kill":
+                    self.kill(request.get("grace"))
+        except (OSError, ValueError):
+            pass
+        self.kill()                 # the director is gone
+
+    def run(self):
+        try:
+            request = json.loads(self.File.readline())
+            if request.get("op") != "run":
+                return
+            self.Process = spawn(request["command"], request.get("env"))
+            self.send(event="started", pid=self.Process.pid)
+            threading.Thread(target=self.read_requests, daemon=True).start()
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.Process.stdout, selectors.EVENT_READ, "out")
+                selector.register(self.Process.stderr, selectors.EVENT_READ, "err")
+                decoders = {name: codecs.getincrementaldecoder("utf-8")(errors="replace") for name in ("out", "err")}
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        data = os.read(key.fd, self.ChunkSize)
+                        text = decoders[key.data].decode(data, final=not data)
+                        if text:
+                            self.send(event="out", stream=key.data, data=text)
+                        if not data:
+                            selector.unregister(key.fileobj)
+                            key.fileobj.close()
+            _, status, rusage = os.wait4(self.Process.pid, 0)
+            self.Process.returncode = os.waitstatus_to_exitcode(status)
+            self.send(event="exit", code=self.Process.returncode, usage=rusage_dict(rusage))
+        except OSError:
+            self.kill()
+        except:
+            traceback.print_exc()
+            self.kill()
+        finally:
+            self.Sock.close()
+
+
+def main():
+    import getopt
+
+    opts, args = getopt.getopt(sys.argv[1:], "h?b:p:")
+    opts = dict(opts)
+    if args or "-?" in opts or "-h" in opts:
+        print(Usage)
+        sys.exit(2)
+    address = (opts.get("-b", "127.0.0.1"), int(opts.get("-p", DefaultPort)))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(100)
+    print("director-agent listening on %s:%d" % sock.getsockname(), file=sys.stderr)
+    while True:
+        csock, caddr = sock.accept()
+        AgentConnection(csock).start()
+
+
+#
+# Director side
+#
+
+class Agent(object):
+
+    def __init__(self, host, port, slots):
+        self.Host = host
+        self.Port = port
+        self.Slots = slots
+        self.Used = 0
+
+    def __str__(self):
+        return f"{self.Host}:{self.Port}"
+
+
+class AgentPool(Primitive):
+    #
+    # Agents with their slot counts. A remote command occupies one slot of the agent it runs on.
+    #
+
+    def __init__(self, agents):
+        Primitive.__init__(self)
+        self.Agents = agents
+        self.Waiters = []               # [(step, wake)], wake(agent or None)
+
+    @staticmethod
+    def parse(text):
+        # "host:port:slots,host:port,..." - slots default to 1
+        agents = []
+        for item in text.split(","):
+            item = item.strip()
+            if item:
+                parts = item.split(":")
+                host = parts[0] or "127.0.0.1"
+                port = int(parts[1]) if len(parts) > 1 else DefaultPort
+                slots = int(parts[2]) if len(parts) > 2 else 1
+                agents.append(Agent(host, port, slots))
+        return AgentPool(agents)
+
+    def free_agent(self):
+        free = [agent for agent in self.Agents if agent.Used < agent.Slots]
+        return max(free, key=lambda agent: agent.Slots - agent.Used) if free else None
+
+    @synchronized
+    def request(self, step, wake):
+        agent = self.free_agent()
+        if agent is not None:
+            agent.Used += 1
+            return agent
+        self.Waiters.append((step, wake))
+
+    def acquire(self, step):
+        # blocks until an agent slot is free. Returns the Agent or None if cancelled
+        event = threading.Event()
+        result = []
+        def wake(agent):
+            result.append(agent)
+            event.set()
+        agent = self.request(step, wake)
+        if agent is not None:
+            return agent
+        event.wait()
+        return result[0]
+
+    async def aacquire(self, step):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def wake(agent):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(agent))
+        agent = self.request(step, wake)
+        if agent is not None:
+            return agent
+        return await future
+
+    @synchronized
+    def release(self, agent):
+        agent.Used -= 1
+        while self.Waiters:
+            free = self.free_agent()
+            if free is None:
+                break
+            step, wake = self.Waiters.pop(0)
+            free.Used += 1
+            wake(free)
+
+    @synchronized
+    def cancel(self, step):
+        waiters = []
+        for waiter in self.Waiters:
+            if waiter[0] is step:
+                waiter[1](None)
+            else:
+                waiters.append(waiter)
+        self.Waiters = waiters
+
+
+class RemoteProcess(object):
+    #
+    # Command running on an agent. Mimics the parts of Popen interface used by Command
+    #
+
+    def __init__(self, agent):
+        self.Agent = agent
+        self.pid = None
+        self.returncode = None
+        self.Usage = None
+        self.Sock = None
+        self.Reader = self.Writer = None        # asyncio streams
+
+    def __str__(self):
+        return f"{self.Agent}/{self.pid}"
+
+    def request(self, command, env):
+        return (json.dumps({"op":"run", "command":command, "env":env}) + "\n").encode("utf-8")
+
+    def start(self, command, env):
+        self.Sock = socket.create_connection((self.Agent.Host, self.Agent.Port))
+        self.File = self.Sock.makefile("rb")
+        self.Sock.sendall(self.request(command, env))
+        self.event(self.File.readline())
+
+    async def astart(self, command, env):
+        import asyncio
+        self.Reader, self.Writer = await asyncio.open_connection(self.Agent.Host, self.Agent.Port, limit=1024*1024)
+        self.Writer.write(self.request(command, env))
+        self.event(await self.Reader.readline())
+
+    def event(self, line):
+        # updates the state, returns ("out"|"err", text) for output events, None otherwise
+        if not line:
+            if self.returncode is None:
+                self.returncode = -1            # connection lost
+            return None
+        event = json.loads(line)
+        if event["event"] == "started":
+            self.pid = event["pid"]
+        elif event["event"] == "exit":
+            self.returncode = event["code"]
+            self.Usage = event.get("usage")
+        elif event["event"] == "out":
+            return event["stream"], event["data"]
+
+    def output(self):
+        # yields (stream, text) until the command exits
+        while self.returncode is None:
+            out = self.event(self.File.readline())
+            if out is not None:
+                yield out
+        if self.Sock is not None:
+            self.Sock.close()
+
+    async def aoutput(self):
+        while self.returncode is None:
+            out = self.event(await self.Reader.readline())
+            if out is not None:
+                yield out
+        if self.Writer is not None:
+            self.Writer.close()
+
+    def kill(self, grace=None):
+        # grace: seconds between SIGTERM and SIGKILL on the agent, default: the agent's KillGrace
+        message = (json.dumps({"op":"kill", "grace":grace}) + "\n").encode("utf-8")
+        try:
+            if self.Writer is not None:
+                self.Writer.write(message)
+            elif self.Sock is not None:
+                self.Sock.sendall(message)
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import os, json, glob, hashlib, shutil, time, tempfile
+from pythreader import Primitive, synchronized
+from .environment import declared
+
+#
+# Content-addressed cache of command results. A command with -inputs=<glob>,... and/or -outputs=<glob>,...
+# is looked up by the hash of its command line, the environment variables set by the script, working
+# directory, the globs and the contents of the input files. On a hit, the recorded output files, stdout
+# and stderr are restored and the command is not run. Results of the commands which succeeded are stored.
+#
+# Cache directory layout:
+#
+#   <dir>/<key[:2]>/<key>/entry.json   - {"command": ..., "exit_code": 0, "outputs": [path, ...], "size": ...}
+#                         stdout, stderr
+#                         files/<path> - output files, paths relative to the working directory
+#
+# The modification time of entry.json is the last use time. When the total size goes above the limit,
+# least recently used entries are removed.
+#
+
+def split_globs(text):
+    return tuple(g.strip() for g in (text or "").split(",") if g.strip())
+
+def expand(globs):
+    # sorted list of files matching the globs. Directories are expanded into the files they contain
+    files = set()
+    for pattern in globs:
+        for path in glob.glob(pattern, recursive=True):
+            if os.path.isdir(path):
+                for top, _, names in os.walk(path):
+                    files.update(os.path.join(top, name) for name in names)
+            elif os.path.isfile(path):
+                files.add(path)
+    return sorted(os.path.normpath(path) for path in files)
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(top, name)) for top, _, names in os.walk(path) for name in names)
+
+
+class ResultCache(Primitive):
+
+    ChunkSize = 1024*1024
+
+    def __init__(self, directory, max_size=None):
+        Primitive.__init__(self, name=directory)
+        self.Dir = directory
+        self.MaxSize = max_size             # bytes or None
+        self.FileHashes = {}                # (path, size, mtime) -> hash, inputs shared by steps are read once
+        self.Hits = self.Misses = self.Stored = self.Evicted = 0
+        self.RestoredBytes = 0
+        self.Entries = {}                   # key -> [last use time, size]
+        self.Size = 0
+        os.makedirs(directory, exist_ok=True)
+        for prefix in os.scandir(directory):
+            if prefix.is_dir() and len(prefix.name) == 2:
+                for entry in os.scandir(prefix.path):
+                    try:
+                        with open(os.path.join(entry.path, "entry.json"), "r") as f:
+                            size = json.load(f)["size"]
+                        used = os.path.getmtime(os.path.join(entry.path, "entry.json"))
+                    except (OSError, ValueError, KeyError):
+                        continue        # partially stored or removed by another run
+                    self.Entries[entry.name] = [used, size]
+                    self.Size += size
+        self.evict()                        # the limit may be lower than in the previous run
+
+    def file_hash(self, path):
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns)
+        digest = self.FileHashes.get(key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                while data := f.read(self.ChunkSize):
+                    h.update(data)
+            digest = self.FileHashes[key] = h.hexdigest()
+        return digest
+
+    def key(self, step):
+        h = hashlib.sha256()
+        h.update(json.dumps([step.Command, sorted(declared(step.RunEnv).items()), os.getcwd(),
+            step.Inputs, step.Outputs]).encode("utf-8"))
+        for path in expand(step.Inputs):
+            h.update(json.dumps([path, self.file_hash(path)]).encode("utf-8"))
+        return h.hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.Dir, key[:2], key)
+
+    def fetch(self, key):
+        # restores the output files of the entry into the working directory.
+        # Returns the entry dict, with the entry directory as "dir", or None
+        path = self.entry_dir(key)
+        try:
+            with open(os.path.join(path, "entry.json"), "r") as f:
+                entry = json.load(f)
+            os.utime(os.path.join(path, "entry.json"))
+            for output in entry["outputs"]:
+                dirname = os.path.dirname(output)
+                if dirname:
+                    os.makedirs(dirname, exist_ok=True)
+                tmp = output + ".director-tmp"
+                shutil.copy2(os.path.join(path, "files", output), tmp)
+                os.replace(tmp, output)
+        except (OSError, ValueError, KeyError):
+            with self:
+                self.Misses += 1        # not there, or evicted by another run meanwhile
+            return None
+        entry["dir"] = path
+        with self:
+            self.Hits += 1
+            self.RestoredBytes += entry["size"]
+            if key in self.Entries:
+                self.Entries[key][0] = time.time()
+        return entry
+
+    def store(self, key, step):
+        # entry is built in a temporary directory and renamed, so concurrent runs never see it incomplete
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.Dir)
+        try:
+            outputs = expand(step.Outputs)
+            for path in outputs:
+                if os.path.isabs(path) or path.startswith(".." + os.sep):
+                    raise ValueError(f"Output outside of the working directory: {path}")
+                dest = os.path.join(tmp, "files", path)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(path, dest)
+            for name, buf in (("stdout", step.Out), ("stderr", step.Err)):
+                if buf.LostBytes:
+                    raise ValueError(f"{name} is incomplete, spool file could not be written")
+                with open(os.path.join(tmp, name), "w", encoding="utf-8") as f:
+                    f.writelines(buf.lines())
+            size = dir_size(tmp)
+            with open(os.path.join(tmp, "entry.json"), "w") as f:
+                json.dump({"command": step.Command, "exit_code": step.ExitCode, "outputs": outputs, "size": size}, f)
+            path = self.entry_dir(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                return          # stored by another step or run meanwhile
+            tmp = None
+        finally:
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+        with self:
+            if key not in self.Entries:
+                self.Entries[key] = [time.time(), size]
+                self.Size += size
+            self.Stored += 1
+        self.evict()
+
+    @synchronized
+    def evict(self):
+        if self.MaxSize is None or self.Size <= self.MaxSize:
+            return
+        for key, (used, size) in sorted(self.Entries.items(), key=lambda item: item[1][0]):
+            if self.Size <= self.MaxSize:
+                break
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            del self.Entries[key]
+            self.Size -= size
+            self.Evicted += 1
+
+    @synchronized
+    def stats(self):
+        return {
+            "hits":             self.Hits,
+            "misses":           self.Misses,
+            "stored":           self.Stored,
+            "evicted":          self.Evicted,
+            "restored_bytes":   self.RestoredBytes,
+            "entries":          len(self.Entries),
+            "size":             self.Size
+        }
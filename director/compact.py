@@ -0,0 +1,101 @@
+import math
+from array import array
+from threading import RLock
+
+#
+# Compact representation of the step tree, for scripts with 100k+ steps.
+#
+# Locks. Steps do not have a lock each. Steps at the same level of the tree share StripesPerLevel
+# locks, chosen by the step identity. The locks are always taken from the top of the tree down:
+# a group may lock its children, but a step never locks its parent, its siblings or a step in
+# another branch while holding its own lock. So two steps at one level sharing a lock can not
+# deadlock, they only sometimes wait for each other.
+#
+# State. Status, start and end time and exit code of the children of a group are kept in arrays
+# owned by the group, see StepTable. The step has a reference to the table and its row index.
+#
+
+StripesPerLevel = 16
+Stripes = []                # level -> [RLock]
+StripesLock = RLock()
+
+def step_lock(level, key):
+    if level >= len(Stripes):
+        with StripesLock:
+            while level >= len(Stripes):
+                Stripes.append([RLock() for _ in range(StripesPerLevel)])
+    return Stripes[level][key % StripesPerLevel]
+
+
+class StepTable(object):
+    #
+    # Struct-of-arrays storage for the steps of a group:
+    #   Status      - bytearray of codes in Statuses
+    #   StartT      - array of doubles, NaN for None
+    #   EndT        - array of doubles, NaN for None
+    #   ExitCode    - array of 64 bit integers, NoExitCode for None
+    #
+
+    __slots__ = ("Status", "StartT", "EndT", "ExitCode")
+
+    Statuses = [None, "ok", "failed", "killed", "cancelled"]
+    StatusCodes = {status: code for code, status in enumerate(Statuses)}
+    NoExitCode = -2**63
+    Defaults = {"Status": None, "StartT": None, "EndT": None, "ExitCode": 0}
+
+    def __init__(self, n):
+        self.Status = bytearray(n)
+        self.StartT = array("d", [math.nan]) * n
+        self.EndT = array("d", [math.nan]) * n
+        self.ExitCode = array("q", [0]) * n
+
+    def attach(self, steps):
+        # moves the state of the steps into this table
+        for i, step in enumerate(steps):
+            values = [(name, getattr(step, name)) for name in self.Defaults]
+            step.Table, step.Index = self, i
+            for name, value in values:
+                self.set(name, i, value)
+        return self
+
+    def get(self, name, i):
+        value = getattr(self, name)[i]
+        if name == "Status":
+            return self.Statuses[value]
+        elif name == "ExitCode":
+            return None if value == self.NoExitCode else value
+        return None if math.isnan(value) else value
+
+    def set(self, name, i, value):
+        if name == "Status":
+            code = self.StatusCodes.get(value)
+            if code is None:
+                with StripesLock:
+                    code = self.StatusCodes.setdefault(value, len(self.Statuses))
+                    if code == len(self.Statuses):
+                        self.Statuses.append(value)
+            value = code
+        elif name == "ExitCode":
+            value = self.NoExitCode if value is None else value
+        else:
+            value = math.nan if value is None else value
+        getattr(self, name)[i] = value
+
+
+def column(name):
+    # Step property stored in the StepTable of its group. A step which is not in a group
+    # gets a table of its own when the value is first changed from the default
+    default = StepTable.Defaults[name]
+
+    def get(step):
+        table = step.Table
+        return default if table is None else table.get(name, step.Index)
+
+    def set(step, value):
+        if step.Table is None:
+            if value == default:
+                return
+            StepTable(1).attach([step])
+        step.Table.set(name, step.Index, value)
+
+    return property(get, set)
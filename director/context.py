@@ -0,0 +1,31 @@
+import os
+from .output import OutputBuffer
+from .events import EventLog
+from .logwriter import LogWriter
+
+class Context(object):
+    #
+    # Run-wide settings shared by all steps of the script
+    #
+
+    def __init__(self, stream=False, tail_size=64*1024, spool_dir=None, journal=None, resources=None, agents=None, fast_spawn=True, shell_workers=False, log=None, cache=None, history=None, cwd=None, kill_grace=1.0):
+        self.Stream = stream                # forward command output lines as they arrive
+        self.TailSize = tail_size           # bytes of each output stream to keep in memory
+        self.SpoolDir = spool_dir           # if None, spool files are temporary
+        if spool_dir is not None:
+            os.makedirs(spool_dir, exist_ok=True)       # OSError if it can not be created
+        self.Journal = journal              # Journal object or None
+        self.Resources = resources          # global ResourcePool or None
+        self.Agents = agents                # AgentPool or None, run commands on director agents
+        self.FastSpawn = fast_spawn         # run commands without shell syntax without /bin/sh
+        self.ShellWorkers = shell_workers   # run commands of parallel groups in long-lived shells, one per slot
+        self.Events = EventLog()            # step state transitions, served by the status server
+        self.Log = log if log is not None else LogWriter()      # all log output goes through it
+        self.Cache = cache                  # ResultCache or None, see cache.py
+        self.History = history              # DurationHistory or None, see history.py
+        self.Cwd = cwd                      # working directory of the commands, None - the current one
+        self.KillGrace = kill_grace         # seconds between SIGTERM and SIGKILL, see reaper.py
+        self.Groups = {}                    # path -> running ParallelGroup, see Step.blocked()
+
+    def output_buffer(self, name):
+        return OutputBuffer(self.TailSize, self.SpoolDir, name, keep=self.SpoolDir is not None)
@@ -0,0 +1,254 @@
+import sys, os, json, socket, stat, signal, threading, time, getopt
+
+#
+# director serve: one long-lived process running scripts submitted over a unix socket.
+#
+#   director serve [--socket=<path>] [--cpus=<n>] [--mem=<size>] [--resources=<name>=<n>,...]
+#                   [--history=<file>|--no-history]
+#   director --daemon [--socket=<path>] [options] <script>      - run the script in the daemon
+#   director status [--socket=<path>]                           - state of the runs in the daemon
+#
+# All runs share the parser, which is loaded once, the duration history and one resource pool, so
+# the host-wide CPU budget (--cpus, default: number of CPUs) applies to all scripts run at the same time.
+# Commands run in the working directory and with the environment of the client.
+#
+# Protocol: the client sends one JSON line and reads JSON lines until the connection is closed:
+#
+#   {"run": {"script": <text>, "name": <path>, "cwd": ..., "env": {...}, "options": {...}}}
+#       -> {"log": <text>} ... {"exit": "ok"|"failed", "summary": <text>}
+#       -> {"error": <message>}             - the script could not be parsed
+#   {"status": true}
+#       -> {"pid": ..., "resources": {...}, "runs": [{"id", "name", "cwd", "started", "state"}, ...]}
+#
+# If the client disconnects, e.g. on Ctrl-C, its run is killed.
+#
+
+# options of the client passed to the daemon, paths are made absolute by the client
+RunOptions = ["-q", "-s", "--engine", "--tail-size", "--spool-dir", "-j", "--resume", "--always-shell",
+    "--summary", "--trace", "--log-json", "--log-dir", "--kill-grace"]
+PathOptions = ["--spool-dir", "-j", "--trace", "--log-json", "--log-dir"]
+
+def default_socket():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "director.sock")
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "director", "director.sock")
+
+def send(sock, message):
+    sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        sock.close()
+        raise OSError(f"Can not connect to director daemon at {path}: {e.strerror or e}") from None
+    return sock
+
+
+class ClientStream(object):
+    #
+    # Output stream of the LogWriter of a run, sends the log to the client
+    #
+
+    def __init__(self, sock):
+        self.Sock = sock
+        self.Lock = threading.Lock()
+
+    def send(self, message):
+        with self.Lock:
+            send(self.Sock, message)
+
+    def write(self, text):
+        self.send({"log": text})
+
+    def flush(self):
+        pass
+
+
+class Daemon(object):
+
+    def __init__(self, path, resources, history):
+        self.Path = path
+        self.Resources = resources          # ResourcePool shared by all runs
+        self.History = history              # DurationHistory or None
+        self.Runs = {}                      # id -> (request, start time, Script)
+        self.NextId = 1
+        self.Lock = threading.Lock()
+
+    def serve(self):
+        directory = os.path.dirname(self.Path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.Path) and stat.S_ISSOCK(os.stat(self.Path).st_mode):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.Path)
+                raise OSError(f"director daemon is already running at {self.Path}")
+            except ConnectionRefusedError:
+                os.remove(self.Path)        # left by a daemon which did not exit cleanly
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.Path)
+        os.chmod(self.Path, 0o600)          # commands run as the daemon user
+        sock.listen(64)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        print("director daemon:", self.Path, "pid:", os.getpid(), file=sys.stderr)
+        try:
+            while True:
+                conn, _ = sock.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True, name="director daemon client").start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+            try:    os.remove(self.Path)
+            except OSError: pass
+            with self.Lock:
+                runs = list(self.Runs.values())
+            for _, _, script in runs:
+                script.kill()
+
+    def handle(self, conn):
+        with conn:
+            try:
+                with conn.makefile("rb") as f:
+                    request = json.loads(f.readline())
+                if "run" in request:
+                    self.run(conn, request["run"])
+                elif "status" in request:
+                    send(conn, self.status())
+                else:
+                    send(conn, {"error": "unknown request"})
+            except (OSError, ValueError):
+                pass                # the client went away or sent garbage
+
+    def context(self, request, out):
+        from .context import Context
+        from .journal import Journal
+        from .logwriter import LogWriter
+        from .resources import parse_size
+        options = request.get("options", {})
+        journal = options.get("-j")
+        return Context(
+            stream = "-s" in options,
+            tail_size = parse_size(options.get("--tail-size", "64k")),
+            spool_dir = options.get("--spool-dir"),
+            journal = Journal(journal, "--resume" in options) if journal else None,
+            resources = self.Resources,
+            fast_spawn = "--always-shell" not in options,
+            log = LogWriter(out=out, json_path=options.get("--log-json"), step_dir=options.get("--log-dir")),
+            history = self.History,
+            cwd = request.get("cwd"),
+            kill_grace = float(options.get("--kill-grace", 1.0))
+        )
+
+    def run(self, conn, request):
+        from .director import Script
+        from .usage import summary, write_trace
+        options = request.get("options", {})
+        out = ClientStream(conn)
+        try:
+            script = Script(request["script"], context=self.context(request, out))
+        except Exception as e:
+            out.send({"error": f"{request.get('name')}: {e}"})
+            return
+        with self.Lock:
+            run_id = self.NextId
+            self.NextId += 1
+            self.Runs[run_id] = (request, time.time(), script)
+        done = threading.Event()
+        threading.Thread(target=self.watch, args=(conn, script, done), daemon=True, name="director daemon watch").start()
+        try:
+            status = script.run("-q" in options, options.get("--engine", "threads"), env=request.get("env"))
+        finally:
+            done.set()
+            with self.Lock:
+                del self.Runs[run_id]
+        result = {"exit": status}
+        if "--trace" in options:
+            write_trace(script.Tree, options["--trace"])
+        if "--summary" in options:
+            result["summary"] = summary(script.Tree)
+        out.send(result)
+
+    def watch(self, conn, script, done):
+        # the client sends nothing after the request, so recv() returns only when it disconnects
+        try:
+            conn.recv(1)
+        except OSError:
+            pass
+        if not done.is_set():
+            script.kill()
+
+    def status(self):
+        with self.Lock:
+            runs = sorted(self.Runs.items())
+        return {
+            "pid":          os.getpid(),
+            "resources":    self.Resources.dump_state(),
+            "runs":         [
+                {
+                    "id":       run_id,
+                    "name":     request.get("name"),
+                    "cwd":      request.get("cwd"),
+                    "started":  started,
+                    "state":    script.Tree.dump_state()
+                }
+                for run_id, (request, started, script) in runs
+            ]
+        }
+
+
+def serve(argv):
+    from .resources import ResourcePool, parse_size, parse_resources
+    from .history import DurationHistory, default_path
+    opts, args = getopt.getopt(argv, "h?", ["help", "socket=", "cpus=", "mem=", "resources=", "history=", "no-history"])
+    opts = dict(opts)
+    if args or "-?" in opts or "-h" in opts or "--help" in opts:
+        from .director import Usage
+        print(Usage)
+        sys.exit(2)
+    resources = ResourcePool(
+        cpus = int(opts.get("--cpus", os.cpu_count() or 1)),
+        mem = parse_size(opts["--mem"]) if "--mem" in opts else None,
+        resources = parse_resources(opts.get("--resources", ""))
+    )
+    history = None if "--no-history" in opts else DurationHistory(opts.get("--history") or default_path())
+    from .grammar import Parser
+    Parser.lark_parser()                    # loaded once for all runs
+    from .reaper import Reaper
+    Reaper.enable_subreaper()               # orphans of commands of all runs are reaped
+    Daemon(opts.get("--socket") or default_socket(), resources, history).serve()
+
+def submit(path, request):
+    # runs the script in the daemon, returns the exit code for the client
+    sock = connect(path)
+    with sock:
+        send(sock, {"run": request})
+        with sock.makefile("rb") as f:
+            for line in f:
+                message = json.loads(line)
+                if "log" in message:
+                    sys.stdout.write(message["log"])
+                    sys.stdout.flush()
+                elif "error" in message:
+                    print(message["error"], file=sys.stderr)
+                    return 2
+                elif "exit" in message:
+                    if "summary" in message:
+                        print(message["summary"])
+                    return 0 if message["exit"] == "ok" else 1
+    print("director daemon closed the connection", file=sys.stderr)
+    return 1
+
+def status(argv):
+    opts, args = getopt.getopt(argv, "", ["socket="])
+    opts = dict(opts)
+    sock = connect(opts.get("--socket") or default_socket())
+    with sock:
+        send(sock, {"status": True})
+        with sock.makefile("rb") as f:
+            print(json.dumps(json.loads(f.readline()), indent=2))
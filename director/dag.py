@@ -0,0 +1,153 @@
+from .groups import SequentialGroup, ParallelGroup, SweepGroup, Command
+
+#
+# Dependencies between steps declared with -id=<name> and -after=<name>,<name>...
+#
+# The script is represented as a graph of events: start and end of each step. An edge u -> v
+# means that u must happen before v:
+#
+#   start(step) -> end(step)                        for commands and sweeps, with the weight of the step duration estimate
+#   start(group) -> start(child)
+#   end(child) -> end(group)
+#   end(previous child) -> start(child)             in sequential groups
+#   end(dependency) -> start(step)                  for each step listed in -after
+#
+# A cycle in this graph means that the script can never finish. The rank of a step is the longest
+# path from its start to the end of the script. Parallel groups start ready steps with higher
+# rank first.
+#
+# Commands connected with -stdin=<name> (see pipes.py) start together, so each of them depends
+# on the dependencies of all of them.
+#
+# Elements of a sweep are created while it runs, so the steps of its body can not be referred to or
+# wait for other steps. -id, -after and -stdin in the body are rejected.
+#
+# Resources in -uses must be pools given with --resources, when the script runs with resource pools.
+#
+
+def check_resources(step):
+    resources = step.Context.Resources
+    if resources is not None and isinstance(step, Command):
+        resources.check(step.Needs, step.Title)
+
+def check_sweep(sweep):
+    for step in sweep.MakeElement(sweep.Level + 1).walk():
+        check_resources(step)
+        if step.Id is not None or step.After or getattr(step, "StdinFrom", None) is not None:
+            raise ValueError(f"-id, -after and -stdin can not be used in the body of {sweep.Title}: {step.Title}")
+        if isinstance(step, SweepGroup):
+            check_sweep(step)
+
+def resolve(tree):
+    steps = list(tree.walk())
+    for step in steps:
+        check_resources(step)
+        if isinstance(step, SweepGroup):
+            check_sweep(step)
+    ids = {}
+    for step in steps:
+        if step.Id is not None:
+            if step.Id in ids:
+                raise ValueError(f"Duplicate step id: {step.Id}")
+            ids[step.Id] = step
+    dependents = {}
+    for step in steps:
+        if step.After:
+            step.Dependencies = []
+        for name in step.After:
+            dep = ids.get(name)
+            if dep is None:
+                raise ValueError(f"Unknown step id in -after of {step.Title}: {name}")
+            step.Dependencies.append(dep)
+            dependents.setdefault(dep, []).append(step)
+    for dep, after in dependents.items():
+        dep.Dependents = after
+    resolve_pipes(steps, ids)
+    compute_ranks(steps)
+
+def resolve_pipes(steps, ids):
+    parents = {}
+    for step in steps:
+        for child in getattr(step, "Steps", ()):
+            parents[child] = step
+    for step in steps:
+        if not isinstance(step, Command) or step.StdinFrom is None:
+            continue
+        producer = ids.get(step.StdinFrom)
+        if producer is None:
+            raise ValueError(f"Unknown step id in -stdin of {step.Title}: {step.StdinFrom}")
+        parent = parents.get(step)
+        if not isinstance(producer, Command) or parents.get(producer) is not parent \
+                or not isinstance(parent, ParallelGroup) or isinstance(parent, SweepGroup):
+            raise ValueError(f"-stdin of {step.Title}: {step.StdinFrom} must be a command in the same parallel group")
+        step.Producer = producer
+        producer.Consumers += (step,)
+    for step in steps:
+        if not isinstance(step, Command):
+            continue
+        producer = step.Producer
+        while producer is not None and producer is not step:
+            producer = producer.Producer
+        if producer is step:
+            raise ValueError(f"Circular -stdin: {step.Title}")
+        if step.Producer is not None or not step.Consumers:
+            continue
+        members = step.pipeline()
+        dependencies = []
+        needs = {}
+        for member in members:
+            for dep in member.Dependencies:
+                if dep in members:
+                    raise ValueError(f"{member.Title} can not wait for {dep.Title}, they are connected with -stdin")
+                if dep not in dependencies:
+                    dependencies.append(dep)
+            for name, amount in member.Needs.items():
+                needs[name] = needs.get(name, 0) + amount
+        for member in members:
+            member.Dependencies = dependencies
+            member.Needs = {}
+        step.Needs = needs          # resources of the whole pipeline are acquired by the first command
+
+def compute_ranks(steps):
+    index = {id(step): i for i, step in enumerate(steps)}
+    start = lambda step: 2*index[id(step)]
+    end = lambda step: 2*index[id(step)] + 1
+    n = 2*len(steps)
+    edges = [[] for _ in range(n)]          # node -> [(node, weight)]
+    for step in steps:
+        children = getattr(step, "Steps", None)
+        if children:
+            for child in children:
+                edges[start(step)].append((start(child), 0.0))
+                edges[end(child)].append((end(step), 0.0))
+            if isinstance(step, SequentialGroup):
+                for previous, child in zip(children[:-1], children[1:]):
+                    edges[end(previous)].append((start(child), 0.0))
+        else:
+            edges[start(step)].append((end(step), step.estimate()))
+        for dep in step.Dependencies:
+            edges[end(dep)].append((start(step), 0.0))
+
+    # topological order
+    indegree = [0]*n
+    for node_edges in edges:
+        for v, _ in node_edges:
+            indegree[v] += 1
+    order = [u for u in range(n) if indegree[u] == 0]
+    i = 0
+    while i < len(order):
+        for v, _ in edges[order[i]]:
+            indegree[v] -= 1
+            if indegree[v] == 0:
+                order.append(v)
+        i += 1
+    if len(order) < n:
+        blocked = [steps[u//2] for u in range(0, n, 2) if indegree[u] > 0 and steps[u//2].After]
+        raise ValueError("Circular dependencies: " + ", ".join(step.Id or step.Title for step in blocked))
+
+    # longest path to the end of the script
+    remaining = [0.0]*n
+    for u in reversed(order):
+        remaining[u] = max((w + remaining[v] for v, w in edges[u]), default=0.0)
+    for step in steps:
+        step.Rank = remaining[start(step)]
@@ -1,77 +1,370 @@
-import sys, traceback, os, signal, time, textwrap, json
-from pythreader import Task, Primitive, synchronized, TaskQueue
-from .parser import Parser, convert
+import sys, traceback, os, signal, time, textwrap, json, socket, stat
 
 #
-# Dependencies
+# Dependencies. The modules of the package are imported when a script is run in this process, not for
+# the client of the daemon, see daemon.py. lark is imported only to parse a script which was not parsed
+# before, see parser.parse(), webpie only when the status server is requested with -p, asyncio only by
+# the asyncio engine
 #
 
 if sys.version_info[:2] < (3,11):
     print("Pytbon version 3.11 or later is required", file=sys.stderr)
     sys.exit(1)
 
-try:
-    import lark
-except ModuleNotFoundError:
-    import sys
-    print("lark library needs to be installed.\nPlease use 'pip install lark'.", file=sys.stderr)
-    sys.exit(1)
-
-try:
-    import webpie
-except ModuleNotFoundError:
-    import sys
-    print("webpie library needs to be installed.\nPlease use 'pip install webpie'.", file=sys.stderr)
-    sys.exit(1)
+Usage = """
+director [options] <script>
+    -q                      - quiet
+    -p <port>               - run HTTP status server on the port, 0 - on any free port
+    -p unix:<path>          - run HTTP status server on the unix socket
+    -s                      - stream command output as it arrives
+    --engine=(threads|asyncio)  - execution engine, default: threads
+    --tail-size=<bytes>     - amount of each command output to keep in memory, default 64k
+    --spool-dir=<dir>       - directory to keep spooled command output in
+    -j <file>               - write journal of completed steps to the file
+    --resume                - skip commands recorded as completed in the journal,
+                              default journal file: <script>.journal
+    --cpus=<n>              - number of CPU slots for the whole script
+    --mem=<size>            - memory budget for the whole script, e.g. 16G
+    --resources=<name>=<n>,...  - custom resource pools, e.g. db=4,gpu=2
+    --agents=<host>:<port>:<slots>,...  - run commands on director agents, e.g. node1:8890:8,node2:8890:8
+    --always-shell          - run all commands with /bin/sh, even those without shell syntax
+    --shell-workers         - run commands of parallel groups in long-lived shells, one per slot
+    --summary               - print run summary: CPU time, memory, I/O, slot utilization, longest commands
+    --trace=<file>          - write Chrome trace (chrome://tracing, Perfetto) of the run to the file
+    --log-json=<file>       - append structured log of step events to the file, one JSON record per line
+    --log-dir=<dir>         - write log and output of each step to <dir>/<step path>.log
+    --cache=<dir>           - result cache directory for commands with -inputs or -outputs
+    --cache-size=<size>     - result cache size limit, least recently used results are removed, default 10G
+    --history=<file>        - file with command durations from the previous runs,
+                              default: ~/.cache/director/durations.json
+    --no-history            - do not use or record command durations
+    --plan                  - do not run the script, print predicted durations of its steps
+    --watch                 - run the script again when the script or the -inputs of its commands change,
+                              only the affected commands run
+    --kill-grace=<seconds>  - time between SIGTERM and SIGKILL for killed commands, default: 1
+    --daemon                - run the script in the director daemon, see below
+    --socket=<path>         - unix socket of the daemon, default: $XDG_RUNTIME_DIR/director.sock
+                              or ~/.cache/director/director.sock
 
-from webpie import HTTPServer, WPApp, WPHandler
+director serve [options]    - run the daemon, scripts run with --daemon share its parser and resources
+    --socket=<path>
+    --cpus=<n>              - number of CPU slots for all scripts, default: number of CPUs
+    --mem=<size>            - memory budget for all scripts
+    --resources=<name>=<n>,...
+    --history=<file>
+    --no-history
 
-Usage = """
-director [-q] <script>
+director status [--socket=<path>]   - print state of the scripts running in the daemon
 """
 
-class Script(WPApp):
+class Script(object):
 
-    def __init__(self, text, port=8888):
-        parsed = Parser().parse(text)
+    def __init__(self, text, port=None, context=None):
+        from pythreader import Primitive
+        from .parser import parse, convert
+        from .context import Context
+        from . import dag
+        parsed = parse(text)
         #print("parsed:", parsed.pretty())
-        self.Tree = convert(parsed)
-        
+        self.Context = context or Context()
+        self.Tree = convert(parsed, context=self.Context)
+        self.Tree.set_path("0")
+        dag.resolve(self.Tree)
+        self.Snapshot = (None, None, None)      # (events version, JSON text, predicted end time)
+        self.SnapshotLock = Primitive()
+        self.StatusAddress = None
+        self.HTTPServer = self.status_server(port) if port is not None else None
+        self.Loop = None                        # event loop of the asyncio engine while it runs the tree
+
+    def status_server(self, port):
+        # port: TCP port number, 0 - any free port, or "unix:<path>". The socket is bound here, so a busy port
+        # is reported before the script starts
         try:
-            from webpie import HTTPServer, WPApp, WPHandler
-            self.HTTPServer = HTTPServer(port, self, daemon=True)
-            WPApp.__init__(self, self.status_request)            
+            from webpie import HTTPServer, WPApp
         except ModuleNotFoundError:
             print("Can not import webpie module. HTTP status server will not be running. Use 'pip install webpie' to enable the HTTP server.", file=sys.stderr)
-            self.HTTPServer = None
+            return None
+        if isinstance(port, str) and port.startswith("unix:"):
+            path = port[5:]
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.remove(path)         # left by a previous run
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            self.StatusAddress = port
+            port = 0
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("", int(port)))
+            port = sock.getsockname()[1]
+            self.StatusAddress = f"http://localhost:{port}/"
+        sock.listen(10)
+
+        class StatusServer(HTTPServer):
+            def connection_accepted(self, csock, caddr):
+                # the address of a unix socket client is "", webpie expects (host, port)
+                HTTPServer.connection_accepted(self, csock, caddr or ("unix", 0))
 
-    def run(self, quiet):
-        self.Tree.update_run_env(os.environ)
+        return StatusServer(port, WPApp(self.status_request), sock=sock, daemon=True)
+
+    def run(self, quiet, engine="threads", env=None):
+        # env: environment of the commands, default: of this process
+        self.Tree.update_run_env(dict(os.environ if env is None else env))
         if self.HTTPServer is not None:
             self.HTTPServer.start()
-        result = self.Tree.run(quiet)
+        if engine == "asyncio":
+            import asyncio
+            result = asyncio.run(self.arun(quiet))
+        else:
+            result = self.Tree.run(quiet)
+        self.Context.Events.close()
+        self.Context.Log.close()
         if self.HTTPServer is not None:
             self.HTTPServer.close()
+            if self.StatusAddress.startswith("unix:"):
+                try:    os.remove(self.StatusAddress[5:])
+                except OSError: pass
+        if self.Context.Journal is not None:
+            self.Context.Journal.close()
+        if self.Context.History is not None:
+            self.Context.History.save()
         return result
 
+    async def arun(self, quiet):
+        import asyncio
+        self.Loop = asyncio.get_running_loop()
+        try:
+            return await self.Tree.arun(quiet)
+        finally:
+            self.Loop = None
+
+    def kill(self):
+        # kills the run, may be called from any thread. The steps run by the asyncio engine are
+        # not thread-safe, they are killed by its event loop
+        loop = self.Loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.Tree.kill)
+                return
+            except RuntimeError:
+                pass                            # the loop is closed, the run has ended
+        self.Tree.kill()
+
     def status_request(self, request, relpath, **args):
-        info = self.Tree.dump_state()
-        return json.dumps(info), "text/json"
+        #
+        #   /           - snapshot of the whole tree, with the events version it corresponds to
+        #   /events?since=<version>&timeout=<seconds>
+        #               - long-poll: state transitions after the version, waits for new ones up to the timeout
+        #   /stream?since=<version>
+        #               - same as Server-Sent Events
+        #
+        relpath = (relpath or "").strip("/")
+        since = int(args.get("since", 0))
+        if relpath == "events":
+            timeout = min(float(args.get("timeout", 30)), 300)
+            version, events, truncated = self.Context.Events.since(since, timeout)
+            return json.dumps({"version":version, "events":events, "truncated":truncated}), "text/json"
+        elif relpath == "stream":
+            since = int(request.headers.get("Last-Event-ID", since))
+            return self.event_stream(since), "text/event-stream", {"Cache-Control": "no-cache"}
+        return self.snapshot(), "text/json"
+
+    def snapshot(self):
+        # the tree is walked only when something has changed since the last snapshot. Until then, the predicted
+        # end time does not change, unless the running steps take longer than expected
+        with self.SnapshotLock:
+            version = self.Context.Events.Version
+            if self.Snapshot[0] != version:
+                now = time.time()
+                info = self.Tree.dump_state()
+                info["version"] = version
+                end_time = now + self.Tree.predict(now) if self.Context.History is not None else None
+                info["predicted_end_time"] = end_time
+                self.Snapshot = (version, json.dumps(info), end_time)
+            _, text, end_time = self.Snapshot
+        if end_time is None:
+            return text
+        return '{"eta": %.1f, ' % (max(0.0, end_time - time.time()),) + text[1:]
+
+    def plan(self):
+        # predicted durations of the steps, with the parallel groups starting the longest steps first
+        history = self.Context.History
+        lines = []
+        unknown = commands = 0
+        for step in self.Tree.walk():
+            mark = ""
+            if hasattr(step, "Command"):
+                commands += 1
+                if history is None or not history.known(step.Command):
+                    unknown += 1
+                    mark = " (no history)"
+            lines.append("%10s  %s%s%s" % (step.pretty_time(step.predict()), step.Indent, step.Title, mark))
+        lines.append("")
+        lines.append("predicted time: %s" % (self.Tree.pretty_time(self.Tree.predict()),))
+        if unknown:
+            lines.append("%d of %d commands have no history, %s is assumed for each of them" % (unknown, commands,
+                self.Tree.pretty_time(history.DefaultEstimate if history is not None else 1.0)))
+        return "\n".join(lines)
 
+    def event_stream(self, since):
+        events_log = self.Context.Events
+        while True:
+            version, events, truncated = events_log.since(since, 15)
+            if truncated:
+                yield "event: truncated\ndata: {}\n\n"
+            for event in events:
+                yield f"id: {event['version']}\nevent: {event['state']}\ndata: {json.dumps(event)}\n\n"
+            if not events:
+                if events_log.Closed:
+                    break
+                yield ": keep-alive\n\n"
+            since = version
+
+
+def run_in_daemon(opts, script_path):
+    from . import daemon
+    unsupported = [opt for opt in opts if opt not in daemon.RunOptions + ["--daemon", "--socket"]]
+    if unsupported:
+        print("Options not supported with --daemon:", " ".join(unsupported), file=sys.stderr)
+        sys.exit(2)
+    if "--resume" in opts and "-j" not in opts:
+        opts["-j"] = script_path + ".journal"
+    for opt in daemon.PathOptions:
+        if opt in opts:
+            opts[opt] = os.path.abspath(opts[opt])
+    try:
+        text = open(script_path, "r").read()
+        status = daemon.submit(opts.get("--socket") or daemon.default_socket(), {
+            "script":   text,
+            "name":     os.path.abspath(script_path),
+            "cwd":      os.getcwd(),
+            "env":      dict(os.environ),
+            "options":  {opt: opts[opt] for opt in daemon.RunOptions if opt in opts}
+        })
+    except OSError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    except KeyboardInterrupt:
+        sys.exit(1)             # the daemon kills the run when the connection is closed
+    sys.exit(status)
 
 def main():
     import getopt
 
-    opts, args = getopt.getopt(sys.argv[1:], "h?qp:", ["--help"])
+    if sys.argv[1:2] in (["serve"], ["status"]):
+        from . import daemon
+        try:
+            if sys.argv[1] == "serve":
+                daemon.serve(sys.argv[2:])
+            else:
+                daemon.status(sys.argv[2:])
+        except (ValueError, OSError, getopt.GetoptError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(2)
+        return
+
+    opts, args = getopt.getopt(sys.argv[1:], "h?qp:sj:", ["help", "tail-size=", "spool-dir=", "engine=", "resume", "cpus=", "mem=", "resources=", "agents=", "summary", "trace=", "always-shell", "shell-workers", "log-json=", "log-dir=", "cache=", "cache-size=", "history=", "no-history", "plan", "daemon", "socket=", "kill-grace=", "watch"])
     opts = dict(opts)
     if len(args) != 1 or "-?" in opts or "-h" in opts or "--help" in opts:
         print(Usage)
         sys.exit(2)
 
+    if "--daemon" in opts:
+        run_in_daemon(opts, args[0])
+
+    if "--watch" in opts:
+        unsupported = [opt for opt in opts if opt in ("-p", "-j", "--resume", "--plan")]
+        if unsupported:
+            print("Options not supported with --watch:", " ".join(unsupported), file=sys.stderr)
+            sys.exit(2)
+
+    from .context import Context
+    from .journal import Journal
+    from .cache import ResultCache
+    from .history import DurationHistory, default_path
+    from .resources import ResourcePool, parse_size, parse_resources
+    from .agent import AgentPool
+    from .usage import summary, write_trace
+    from .logwriter import LogWriter
+
+
     quiet = "-q" in opts
-    port = int(opts.get("-p", 8888))
-    script = Script(open(args[0], "r").read(), port)
-    status = script.run(quiet)
+    engine = opts.get("--engine", "threads")
+    if engine not in ("threads", "asyncio"):
+        print("Unknown engine:", engine, file=sys.stderr)
+        print(Usage)
+        sys.exit(2)
+    port = opts.get("-p")
+    if port is not None and not port.startswith("unix:"):
+        port = int(port)
+    resume = "--resume" in opts
+    journal = opts.get("-j")
+    if resume and journal is None:
+        journal = args[0] + ".journal"
+    resources = None
+    if "--cpus" in opts or "--mem" in opts or "--resources" in opts:
+        resources = ResourcePool(
+            cpus = int(opts["--cpus"]) if "--cpus" in opts else None,
+            mem = parse_size(opts["--mem"]) if "--mem" in opts else None,
+            resources = parse_resources(opts.get("--resources", ""))
+        )
+    agents = AgentPool.parse(opts["--agents"]) if "--agents" in opts else None
+    cache = ResultCache(opts["--cache"], parse_size(opts.get("--cache-size", "10G"))) if "--cache" in opts else None
+    history = None if "--no-history" in opts else DurationHistory(opts.get("--history") or default_path())
+
+    def make_context(journal):
+        # shared resources, a new log for each run in the watch mode
+        return Context(
+            stream = "-s" in opts,
+            tail_size = parse_size(opts.get("--tail-size", "64k")),
+            spool_dir = opts.get("--spool-dir"),
+            journal = journal,
+            resources = resources,
+            agents = agents,
+            fast_spawn = "--always-shell" not in opts,
+            shell_workers = "--shell-workers" in opts,
+            log = LogWriter(json_path=opts.get("--log-json"), step_dir=opts.get("--log-dir")),
+            cache = cache,
+            history = history,
+            kill_grace = float(opts.get("--kill-grace", 1.0))
+        )
+
+    def report(script, status):
+        if "--trace" in opts:
+            write_trace(script.Tree, opts["--trace"])
+        if "--summary" in opts:
+            print(summary(script.Tree))
+
+    from .reaper import Reaper
+    Reaper.enable_subreaper()
+
+    if "--watch" in opts:
+        from .watch import Watcher
+        status = Watcher(args[0], make_context, quiet, engine, report).run()
+        sys.exit(0 if status in ("ok", None) else 1)
+
+    try:
+        context = make_context(Journal(journal, resume) if journal else None)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    try:
+        script = Script(open(args[0], "r").read(), port, context)
+    except ModuleNotFoundError as e:
+        if e.name != "lark":
+            raise
+        print("lark library needs to be installed.\nPlease use 'pip install lark'.", file=sys.stderr)
+        sys.exit(1)
+    except (ValueError, OSError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    if port == 0 and script.StatusAddress is not None:
+        print("status server:", script.StatusAddress, file=sys.stderr)
+    if "--plan" in opts:
+        print(script.plan())
+        sys.exit(0)
+    status = script.run(quiet, engine)
+    report(script, status)
     if status != "ok":
         sys.exit(1)
 
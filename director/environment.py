@@ -0,0 +1,72 @@
+from collections.abc import Mapping
+
+#
+# Layered run environments. The environment of a step with "env" statements is a layer with its own
+# variables on top of the environment of the enclosing group, which is shared, not copied. A step without
+# "env" statements uses the environment of the group as is. The flat dict is built only when a command
+# is started, see flat().
+#
+
+
+class LayeredEnv(Mapping):
+
+    __slots__ = ("Parent", "Layer")
+
+    def __init__(self, parent, layer):
+        self.Parent = parent            # Mapping: LayeredEnv, dict or os.environ
+        self.Layer = layer              # dict, variables set by this layer
+
+    def __getitem__(self, name):
+        env = self
+        while isinstance(env, LayeredEnv):
+            if name in env.Layer:
+                return env.Layer[name]
+            env = env.Parent
+        return env[name]
+
+    def flatten(self):
+        layers = []
+        env = self
+        while isinstance(env, LayeredEnv):
+            layers.append(env.Layer)
+            env = env.Parent
+        out = dict(env)
+        for layer in reversed(layers):
+            out.update(layer)
+        return out
+
+    def __iter__(self):
+        return iter(self.flatten())
+
+    def __len__(self):
+        return len(self.flatten())
+
+
+def layer(outer, env):
+    # environment with the variables from env on top of outer. "$NAME" in the value of NAME
+    # is replaced with the value of NAME in outer, or "" if it is not there
+    if not env:
+        return outer
+    outer = outer if outer is not None else {}
+    variables = {}
+    for name, value in env.items():
+        if "$" + name in value:
+            value = value.replace("$" + name, outer.get(name, ""))
+        variables[name] = value
+    return LayeredEnv(outer, variables)
+
+def flat(env):
+    # dict for starting a process
+    return env.flatten() if isinstance(env, LayeredEnv) else env
+
+def declared(env):
+    # variables set by the script, without the environment the script was started with. Used to
+    # identify commands across runs, so changes of unrelated variables, e.g. OLDPWD, do not matter
+    layers = []
+    while isinstance(env, LayeredEnv):
+        layers.append(env.Layer)
+        env = env.Parent
+    out = {}
+    for variables in reversed(layers):
+        out.update(variables)
+    return out
@@ -0,0 +1,58 @@
+import time
+from collections import deque
+from pythreader import Primitive, synchronized
+
+
+class EventLog(Primitive):
+    #
+    # Versioned log of step state transitions:
+    #
+    #   {"version": 12, "time": ..., "path": "0/3/1", "title": ..., "type": "Command",
+    #       "state": "started"|"retrying"|"ok"|"failed"|"killed"|"cancelled"|"multiplicity", "exit_code": ...}
+    #
+    # Version is the number of events recorded so far. Only the last MaxEvents events are kept,
+    # a reader which falls further behind gets truncated=True and should re-read the snapshot.
+    #
+
+    MaxEvents = 100000
+
+    def __init__(self):
+        Primitive.__init__(self)
+        self.Events = deque(maxlen=self.MaxEvents)
+        self.Version = 0
+        self.Closed = False
+
+    @synchronized
+    def append(self, step, state):
+        self.Version += 1
+        self.Events.append({
+            "version":      self.Version,
+            "time":         time.time(),
+            "path":         step.Path,
+            "title":        step.Title,
+            "type":         type(step).__name__,
+            "state":        state,
+            "exit_code":    step.ExitCode
+        })
+        self.wakeup()
+
+    @synchronized
+    def since(self, version, timeout=None):
+        # returns (version, [events after the version], truncated). Waits up to timeout
+        # for new events if there are none yet
+        t1 = None if timeout is None else time.time() + timeout
+        while self.Version <= version and not self.Closed:
+            delta = None if t1 is None else t1 - time.time()
+            if delta is not None and delta <= 0:
+                break
+            self.sleep(delta)
+        first = self.Version - len(self.Events)         # version of the event before Events[0]
+        truncated = version < first
+        skip = max(0, version - first)
+        return self.Version, [self.Events[i] for i in range(skip, len(self.Events))], truncated
+
+    @synchronized
+    def close(self):
+        # the script is done, there will be no more events
+        self.Closed = True
+        self.wakeup()
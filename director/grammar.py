@@ -0,0 +1,109 @@
+from lark import Tree, Lark, Transformer
+from .parser import Node, grammar, cache_path
+
+#
+# The lark transformer building the Node tree of the script. It is imported only when a script
+# needs to be parsed, see parser.parse()
+#
+
+class Parser(Transformer):
+
+    LarkParser = None           # built once, the transformer runs inline while parsing
+
+    @classmethod
+    def lark_parser(cls):
+        if cls.LarkParser is None:
+            cls.LarkParser = Lark(grammar, start="script", parser="lalr",
+                transformer=cls(), cache=cache_path())
+        return cls.LarkParser
+
+    def parse(self, text):
+        return self.lark_parser().parse(text)
+
+    def sequential(self, args):
+        opts = None
+        steps = []
+        env = None
+        for arg in args:
+            if arg.Type == "options":
+                opts = arg["opts"]
+                env = arg["env"]
+            elif arg.Type == "steps":
+                steps = arg.Children
+            else:
+                steps = [arg]           # single step
+        return Node("sequential", steps, env=env, opts=opts)
+    
+    def parallel(self, args):
+        opts = None
+        steps = []
+        env = None
+        for arg in args:
+            if arg.Type == "options":
+                opts = arg["opts"]
+                env = arg["env"]
+            elif arg.Type == "steps":
+                steps = arg.Children
+            else:
+                steps = [arg]           # single step
+        return Node("parallel", steps, env=env, opts=opts)
+    
+    def command(self, args):
+        opts = None
+        env = None
+        if isinstance(args[0], Node) and args[0].Type == "options":
+            opts = args[0]["opts"]
+            env = args[0]["env"]
+            cmd = args[1].value.strip()
+        else:
+            cmd = args[0].value.strip()
+        return Node("command", command=cmd, env=env, opts=opts)
+    
+    def step(self, args):
+        #print("step: args:", args)
+        assert len(args) == 2 and args[0].Type == "options"
+        opts = args[0]["opts"].copy()
+        env = args[0]["env"].copy()
+        
+        opts.update(args[1].get("opts") or {})
+        env.update(args[1].get("env") or {})
+        args[1]["opts"] = opts
+        args[1]["env"] = env
+        return args[1]
+    
+    def env(self, args):
+        #print("env: args:", args)
+        name = args[1].value.strip()
+        if args[2].type == "STRING":
+            value = args[2].value[1:-1]         # remove quotes
+        else:
+            value = args[2].value.strip()
+        return Node("env", env={name:value})
+    
+    def opt(self, args):
+        name = args[0].value.strip()
+        if args[1].type == "STRING":
+            value = args[1].value[1:-1]         # remove quotes
+        else:
+            value = args[1].value.strip()
+        return Node("opt", opt={name:value})
+    
+    def concurrency(self, args):
+        n = int(args[0].strip())
+        return Node("opt", data={"concurrency": int(args[0].value)})
+    
+    def options(self, nodes):
+        env = {}
+        opts = {}
+        for node in nodes:
+            if node.Type == "opt":
+                opts.update(node["opt"])
+            elif node.Type == "env":
+                env.update(node["env"])
+        return Node("options", opts=opts, env=env)
+    
+    def __default__(self, type, args, meta):
+        if type.startswith("_"):
+            # lark internal rule, to be expanded by the parser
+            return Tree(type, args, meta)
+        return Node(str(type), args)
@@ -1,32 +1,222 @@
-import subprocess, time, textwrap, traceback, os, sys, signal
+import subprocess, time, textwrap, traceback, os, sys, signal, selectors, threading
+from collections import deque
 from subprocess import Popen
 from textwrap import indent
-from pythreader import Task, Primitive, synchronized, TaskQueue
+from pythreader import Task, synchronized, TaskQueue
+from .context import Context
+from .resources import ResourcePool
+from .agent import RemoteProcess
+from .usage import rusage_dict, aggregate_usage
+from .spawn import spawn
+from .workers import WorkerPool
+from .compact import step_lock, StepTable, column
+from .environment import layer, flat
+from .policy import StepPolicy, percentile
+from .cache import split_globs
+from .adaptive import AdaptiveLimit
+from .history import schedule
+from .pipes import connect
+from .reaper import Reaper
 
 
-class Step(Primitive):
-    
+def running_loop():
+    # the event loop, when called by the asyncio engine. asyncio is imported only by the asyncio engine
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is None:
+        return None
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class Step(object):
+    #
+    # Steps use __slots__ and a lock shared with other steps at the same level, see compact.py.
+    # Status, StartT, EndT and ExitCode are stored in the StepTable of the group.
+    #
+
+    __slots__ = ("Title", "Context", "Killed", "Env", "Level", "RunEnv", "Path", "Skipped", "Id", "After",
+        "Dependencies", "Dependents", "Rank", "Watchers", "Done", "Usage", "Exception", "Lock", "Table", "Index")
+
     LevelIndent = "  "
-    LogLock = Primitive()
 
-    def __init__(self, config, env, level):
+    Status = column("Status")
+    StartT = column("StartT")
+    EndT = column("EndT")
+    ExitCode = column("ExitCode")
+
+    def __init__(self, config, env, level, context=None):
         self.Title = config.get("title")
-        Primitive.__init__(self, name=self.Title)
+        self.Lock = step_lock(level, hash(self))
+        self.Table = self.Index = None
+        self.Context = context if context is not None else Context()
         self.Killed = False
-        self.Env = env
-        self.Status = None
-        self.StartT = self.EndT = self.Elapsed = None
+        self.Env = env or None
         self.Level = level
-        self.Indent = self.LevelIndent * level
         self.RunEnv = None
-        self.ExitCode = 0
+        self.Path = None
+        self.Skipped = False
+        self.Id = config.get("id")
+        self.After = tuple(name.strip() for name in config.get("after", "").split(",") if name.strip())
+        self.Dependencies = ()          # steps listed in -after, resolved by dag.resolve()
+        self.Dependents = ()            # steps which have this step in -after
+        self.Rank = 0.0                 # longest path from the beginning of this step to the end of the script
+        self.Watchers = None            # callbacks to call when the step is done
+        self.Done = False
+        self.Usage = None               # resource usage, see usage.py
+        self.Exception = None
+
+    def __enter__(self):
+        return self.Lock.__enter__()
+
+    def __exit__(self, *params):
+        return self.Lock.__exit__(*params)
+
+    @property
+    def Elapsed(self):
+        if self.StartT is None or self.EndT is None:
+            return None
+        return self.EndT - self.StartT
+
+    @property
+    def Indent(self):
+        return self.LevelIndent * self.Level
 
     def run(self, quiet = False):
+        ready = self.wait_for_dependencies()
         self.StartT = time.time()
-        self.Status = self._run(quiet)
+        if ready:
+            self.event("started")
+        self.Status = self._run(quiet) if ready else self.dependency_failed(quiet)
         self.EndT = time.time()
-        self.Elapsed = self.EndT - self.StartT
+        self.journal()
+        self.event(self.Status)
+        self.finished()
         return self.Status             # "ok" or "failed" or "cancelled"
+
+    async def arun(self, quiet = False):
+        # same as run(), used by the asyncio engine
+        ready = await self.await_dependencies()
+        self.StartT = time.time()
+        if ready:
+            self.event("started")
+        self.Status = (await self._arun(quiet)) if ready else self.dependency_failed(quiet)
+        self.EndT = time.time()
+        self.journal()
+        self.event(self.Status)
+        self.finished()
+        return self.Status
+
+    def walk(self):
+        yield self
+
+    def watch(self, callback):
+        # callback(step) will be called when the step is done, or right away if it is done already
+        with self:
+            if not self.Done:
+                if self.Watchers is None:
+                    self.Watchers = []
+                self.Watchers.append(callback)
+                return
+        callback(self)
+
+    def finished(self):
+        self.Context.Log.end_step(self.Path)
+        with self:
+            self.Done = True
+            watchers, self.Watchers = self.Watchers or [], None
+        for callback in watchers:
+            callback(self)
+
+    def cancel(self):
+        # the step will not run because the group it belongs to has stopped
+        if self.StartT is None and not self.Done:
+            self.Status = "cancelled"
+            self.ExitCode = None
+            self.event(self.Status)
+            self.finished()
+
+    def dependencies_state(self):
+        # None: some dependencies are not done yet, True: all succeeded, False: some did not
+        if not all(dep.Done for dep in self.Dependencies):
+            return None
+        return all(dep.Status == "ok" for dep in self.Dependencies)
+
+    def wait_for_dependencies(self):
+        if not self.Dependencies:
+            return True
+        event = threading.Event()
+        for dep in self.Dependencies:
+            dep.watch(lambda _: event.set())
+        if (state := self.dependencies_state()) is None:
+            self.blocked(True)
+            while (state := self.dependencies_state()) is None:
+                event.wait()
+                event.clear()
+            self.blocked(False)
+        return state
+
+    async def await_dependencies(self):
+        import asyncio
+        if not self.Dependencies:
+            return True
+        event = asyncio.Event()
+        for dep in self.Dependencies:
+            dep.watch(lambda _: event.set())
+        if (state := self.dependencies_state()) is None:
+            self.blocked(True)
+            while (state := self.dependencies_state()) is None:
+                await event.wait()
+                event.clear()
+            self.blocked(False)
+        return state
+
+    def blocked(self, waiting):
+        # a step inside a child of a parallel group waits for its -after dependencies. The child does not
+        # count against -multiplicity of the group meanwhile, so the dependencies can get its slot
+        parts = self.Path.split("/")
+        for i in range(1, len(parts)):
+            group = self.Context.Groups.get("/".join(parts[:i]))
+            if group is not None:
+                group.child_blocked("/".join(parts[:i+1]), waiting)
+
+    def dependency_failed(self, quiet):
+        if not quiet:
+            self.log("cancelled:", self.Title, "(dependency failed)", timestamp=True)
+        self.ExitCode = None
+        return "cancelled"
+
+    def estimate(self):
+        # expected duration of a command, used to find the critical path
+        return 1.0
+
+    def predict(self, now=None):
+        # expected time to the end of the step: whole duration if now is None, otherwise the time
+        # from now, given the current state of the step
+        if now is not None and self.Done:
+            return 0.0
+        return self.estimate()
+
+    def use_workers(self, pool):
+        # pool: WorkerPool of the parallel group the step runs in
+        pass
+
+    def pipeline(self):
+        # the steps started together with this one, see pipes.py
+        return [self]
+
+    def event(self, state):
+        self.Context.Events.append(self, state)
+        self.Context.Log.event(self, state)
+
+    def journal(self):
+        if self.Context.Journal is not None and not self.Skipped:
+            self.Context.Journal.record(self)
+
+    def set_path(self, path):
+        # path identifies the step in the tree, e.g. "0/3/1"
+        self.Path = path
         
     def kill(self):
         raise NotImplementedError()
@@ -58,13 +248,8 @@ class Step(Primitive):
         return env
         
     def combine_env(self, env):
-        env = (env or {}).copy()
-        for name, value in (self.Env or {}).items():
-            if "$" + name in value:
-                v = env.get(name, "")
-                value = value.replace("$" + name, v)
-            env[name] = value
-        return env
+        # the step environment on top of env, see environment.py
+        return layer(env, self.Env)
         
     def indent(self, text, extra_indent = ""):
         return indent(text, self.Indent + extra_indent)
@@ -83,12 +268,10 @@ class Step(Primitive):
         parts = [str(p) for p in parts]
         if indent and parts:
             parts[0] = textwrap.indent(parts[0], indent)
-        with self.LogLock:
-            if timestamp:
-                print("%s:" % (time.ctime(t),), *parts, **kv)
-            else:
-                print(*parts, **kv)
-                
+        if timestamp:
+            parts.insert(0, "%s:" % (time.ctime(t),))
+        self.Context.Log.write(kv.get("sep", " ").join(parts) + kv.get("end", "\n"), self.Path)
+
 
     @staticmethod
     def pretty_time(t):
@@ -115,125 +298,820 @@ class StepTask(Task):
         return self.Step.run(self.Quiet)
 
 class Command(Step):
-    
-    def __init__(self, config, env, level, command):
-        Step.__init__(self, config, env, level)
+
+    __slots__ = ("Command", "Process", "ProcessStartT", "Out", "Err", "Needs", "Local", "Workers",
+        "Policy", "Timer", "TimedOut", "Pause", "Attempts", "Original", "Copy", "Winner", "Inputs", "Outputs",
+        "CacheKey", "Cached", "StdinFrom", "Producer", "Consumers", "PipeIn", "PipeOut", "Termination")
+
+    def __init__(self, config, env, level, command, context=None):
+        Step.__init__(self, config, env, level, context)
         self.Command = command
         self.Title = self.Title or self.Command
         self.Process = None
+        self.ProcessStartT = None
         self.Out = None
         self.Err = None
-        
+        self.Needs = ResourcePool.step_needs(config)
+        self.Local = config.get("local", "no") in ("yes", "true")     # do not send to agents
+        self.Workers = None             # WorkerPool, if the command runs in a shell worker
+        self.Policy = StepPolicy.from_config(config)       # -timeout, -retries, -speculate, see policy.py
+        self.Timer = None               # kills the process on timeout
+        self.TimedOut = False
+        self.Pause = None               # threading.Event or asyncio.Event, interrupts the delay between retries
+        self.Attempts = 1
+        self.Original = None            # for a speculative copy: the command it is a copy of
+        self.Copy = None                # speculative copy of this command, started by the parallel group
+        self.Winner = None              # the copy, if it finished first
+        self.Inputs = split_globs(config.get("inputs"))        # -inputs and -outputs, see cache.py
+        self.Outputs = split_globs(config.get("outputs"))
+        self.CacheKey = None            # set if the result is to be stored in the result cache
+        self.Cached = False             # the result was restored from the cache
+        self.StdinFrom = config.get("stdin")        # -stdin=<id>, see pipes.py
+        self.Producer = None            # the command whose stdout is the stdin of this one, resolved by dag.resolve()
+        self.Consumers = ()             # commands reading the stdout of this one
+        self.PipeIn = None              # pipe file descriptors, open between connect() and spawn()
+        self.PipeOut = None
+        self.Termination = None         # set when the process is killed, see reaper.py
+
     @synchronized
     def dump_state(self):
         status = self.Status if self.Status else (
             "running" if self.Process is not None
             else "pending"
         )
-        return {"type":"command", "status":status, "title":self.Title}
+        state = {"type":"command", "status":status, "title":self.Title}
+        if self.Skipped:
+            state["skipped"] = True
+        if self.Cached:
+            state["cached"] = True
+        if isinstance(self.Process, RemoteProcess):
+            state["agent"] = str(self.Process.Agent)
+        if self.Usage:
+            state["usage"] = self.Usage
+        if self.Attempts > 1:
+            state["attempt"] = self.Attempts
+        if self.TimedOut:
+            state["timed_out"] = True
+        if self.Copy is not None:
+            state["speculative_copy"] = self.Copy.Path
+        if self.Producer is not None:
+            state["stdin"] = self.Producer.Path
+        if self.Termination is not None:
+            state["termination"] = self.Termination.dump()
+        if self.Out is not None:
+            state["stdout"] = self.Out.tail()
+            state["stderr"] = self.Err.tail()
+        return state
 
     def update_run_env(self, outer):
         self.RunEnv = self.combine_env(outer)
 
+    def estimate(self):
+        # seconds, from the durations of the previous runs, see history.py
+        history = self.Context.History
+        return history.estimate(self.Command) if history is not None else 1.0
+
+    def predict(self, now=None):
+        if now is not None and (self.Done or self.EndT is not None):
+            return 0.0
+        estimate = self.estimate()
+        if now is not None and self.ProcessStartT is not None:
+            return max(0.0, estimate - (now - self.ProcessStartT))
+        return estimate
+
     def __str__(self):
         process = self.Process
         pid = process.pid if process is not None else ""
         return f"Command {self.Title}"
         
+    def resumed(self, quiet):
+        # True if the command completed in one of the previous runs recorded in the journal
+        journal = self.Context.Journal
+        if journal is None or not journal.completed(self):
+            return False
+        self.Skipped = True
+        self.ExitCode = 0
+        self.Status = "ok"
+        if not quiet:
+            self.log("skipped:", self.Title, "(completed in previous run)", timestamp=True)
+        return True
+
     def _run(self, quiet):
+        if self.resumed(quiet) or self.cached(quiet):
+            return self.Status
+        while True:
+            status = self.run_once(quiet)
+            delay = self.retry_delay(status, quiet)
+            if delay is None:
+                break
+            with self:
+                if self.Pause is None:
+                    self.Pause = threading.Event()
+            self.Pause.wait(delay)          # if killed meanwhile, the next attempt ends right away
+        if status == "ok" and self.CacheKey is not None:
+            self.store_result(quiet)
+        return self.outcome(status, quiet)
+
+    async def _arun(self, quiet):
+        # the cache reads and copies files, it is used in a thread not to block the event loop
+        import asyncio
+        if self.resumed(quiet) or await asyncio.to_thread(self.cached, quiet):
+            return self.Status
+        while True:
+            status = await self.arun_once(quiet)
+            delay = self.retry_delay(status, quiet)
+            if delay is None:
+                break
+            if self.Pause is None:
+                self.Pause = asyncio.Event()
+            try:
+                await asyncio.wait_for(self.Pause.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        if status == "ok" and self.CacheKey is not None:
+            await asyncio.to_thread(self.store_result, quiet)
+        return self.outcome(status, quiet)
+
+    def cached(self, quiet):
+        # True if the result was restored from the result cache
+        cache = self.Context.Cache
+        if cache is None or self.piped() or not (self.Inputs or self.Outputs):
+            return False
+        try:
+            self.CacheKey = cache.key(self)
+        except OSError as e:
+            if not quiet:
+                self.log("not cached:", self.Title, "error reading inputs:", e, timestamp=True)
+            return False
+        entry = cache.fetch(self.CacheKey)
+        if entry is None:
+            return False
+        stream = self.Context.Stream and not quiet
+        self.Out = self.Context.output_buffer("out")
+        self.Err = self.Context.output_buffer("err")
+        try:
+            for name, buf in (("out", self.Out), ("err", self.Err)):
+                with open(os.path.join(entry["dir"], "std" + name), "rb") as f:
+                    while data := f.read(buf.ChunkSize):
+                        lines = buf.feed(data)
+                        if stream:
+                            self.log_lines(name, lines)
+                lines = buf.flush()
+                if stream:
+                    self.log_lines(name, lines)
+        except OSError:
+            self.Out.close()
+            self.Err.close()
+            return False                # evicted by another run meanwhile, the command will run
+        self.Cached = True
+        self.ExitCode = entry["exit_code"]
+        self.Status = "ok"
+        try:
+            if not quiet:
+                self.log("cached:", self.Title, "(result restored from cache)", timestamp=True)
+                if not stream:
+                    self.log_output("stdout", self.Out)
+                    self.log_output("stderr", self.Err)
+        finally:
+            self.Out.close()
+            self.Err.close()
+        return True
+
+    def store_result(self, quiet):
+        # called after the command succeeded. ended() leaves the output buffers open for it
+        try:
+            self.Context.Cache.store(self.CacheKey, self)
+        except (OSError, ValueError) as e:
+            if not quiet:
+                self.log("not cached:", self.Title, e, timestamp=True)
+        finally:
+            self.Out.close()
+            self.Err.close()
+
+    def run_once(self, quiet):
+        resources = self.Context.Resources
+        if resources is None:
+            return self.execute(quiet)
+        if self.is_killed or not resources.acquire(self, self.Needs):
+            return self.Status          # killed while waiting for resources
+        try:
+            return self.execute(quiet)
+        finally:
+            resources.release(self.Needs)
+
+    async def arun_once(self, quiet):
+        resources = self.Context.Resources
+        if resources is None:
+            return await self.aexecute(quiet)
+        if self.is_killed or not await resources.aacquire(self, self.Needs):
+            return self.Status
+        try:
+            return await self.aexecute(quiet)
+        finally:
+            resources.release(self.Needs)
+
+    def retry_delay(self, status, quiet):
+        # seconds to wait before the next attempt, or None if there will be no more attempts
+        policy = self.Policy
+        if status in ("ok", "killed") or policy is None or self.Attempts > policy.Retries or self.Winner is not None \
+                or self.piped():
+            return None
+        delay = policy.Backoff * 2**(self.Attempts - 1)
+        if not quiet:
+            self.log("retrying:", self.Title, "in %s, attempt %d of %d" % (self.pretty_time(delay), self.Attempts + 1, policy.Retries + 1),
+                timestamp=True)
+        with self:
+            self.Attempts += 1
+            self.Status = None              # running again
+        self.event("retrying")
+        return delay
+
+    def outcome(self, status, quiet):
+        # the status of the command, or of its speculative copy if the copy finished first
+        with self:
+            winner = self.Winner
+        if winner is None:
+            return status
+        self.Killed = False
+        self.ExitCode = winner.ExitCode
+        self.Usage = aggregate_usage([self.Usage, winner.Usage])
+        self.Out, self.Err = winner.Out, winner.Err
+        if not quiet:
+            self.log("speculative copy finished first:", self.Title, "status:", winner.Status, timestamp=True)
+        return winner.Status
+
+    def duplicate(self):
+        # speculative copy of the command, see ParallelGroup.speculate()
+        copy = Command({"title": self.Title + " (copy)"}, self.Env, self.Level, self.Command, self.Context)
+        copy.Needs, copy.Local, copy.Workers, copy.RunEnv = self.Needs, self.Local, self.Workers, self.RunEnv
+        copy.Policy = StepPolicy(timeout=self.Policy.Timeout)
+        copy.Original = self
+        copy.set_path(self.Path + "~copy")
+        return copy
+
+    def supersede(self, copy):
+        # the speculative copy finished first
+        with self:
+            self.Winner = copy
+        self.kill()
+
+    def journal(self):
+        if self.Original is None:
+            Step.journal(self)
+
+    def spawned(self, pid):
+        # called with the step locked, right after self.Process is set
+        self.ProcessStartT = time.time()
+        self.TimedOut = False
+        self.Context.Log.event(self, "spawned", pid)
+        if self.Policy is not None and self.Policy.Timeout is not None:
+            loop = running_loop()
+            if loop is not None:
+                self.Timer = loop.call_later(self.Policy.Timeout, self.timed_out)
+            else:
+                self.Timer = threading.Timer(self.Policy.Timeout, self.timed_out)
+                self.Timer.daemon = True
+                self.Timer.start()
+
+    def timed_out(self):
+        with self:
+            if self.Killed or self.Process is None or self.Process.returncode is not None:
+                return
+            self.TimedOut = True
+            self.kill_process()
+
+    def remote(self):
+        return self.Context.Agents is not None and not self.Local and not self.piped()
+
+    def use_workers(self, pool):
+        self.Workers = pool
+
+    def piped(self):
+        return self.Producer is not None or bool(self.Consumers)
+
+    def pipeline(self):
+        members = [self]
+        for consumer in self.Consumers:
+            members += consumer.pipeline()
+        return members
+
+    def close_pipes(self):
+        # the process has its own copies of the pipe ends, or will never be started
+        with self:
+            fds, self.PipeIn, self.PipeOut = (self.PipeIn, self.PipeOut), None, None
+        for fd in fds:
+            if fd is not None:
+                os.close(fd)
+
+    def finished(self):
+        self.close_pipes()
+        Step.finished(self)
+
+    def execute(self, quiet):
+        if self.remote():
+            return self.execute_remote(quiet)
+        if self.Workers is not None and not self.piped():
+            return self.execute_worker(quiet)
         with self:
             if self.is_killed:
                 return self.Status
-            else:
+            t0 = time.time()
+            self.Exception = None
+            self.Out = self.Context.output_buffer("out")
+            self.Err = self.Context.output_buffer("err")
+        # the lock is shared with other steps, do not hold it while the process is being created
+        process = self.spawn()
+        with self:
+            self.Process = process
+            self.spawned(process.pid)
+            if self.is_killed:
+                self.kill_process()
+            elif not quiet:
+                self.log("started:", self.Title, "pid:", process.pid, timestamp=True)
+        try:
+            self.read_output(quiet)
+        except:
+            self.execution_error()
+        try:
+            self.reap(*os.wait4(self.Process.pid, 0))
+        except:
+            self.execution_error()
+        return self.ended(quiet, time.time() - t0)
+
+    async def aexecute(self, quiet):
+        import asyncio
+        if self.remote():
+            return await self.aexecute_remote(quiet)
+        if self.Workers is not None and not self.piped():
+            return await self.aexecute_worker(quiet)
+        with self:
+            if self.is_killed:
+                return self.Status
+            t0 = time.time()
+            self.Exception = None
+            self.Out = self.Context.output_buffer("out")
+            self.Err = self.Context.output_buffer("err")
+        process = self.spawn()
+        with self:
+            self.Process = process
+            self.spawned(process.pid)
+            if self.is_killed:
+                self.kill_process()         # killed while the process was being created
+            elif not quiet:
+                self.log("started:", self.Title, "pid:", process.pid, timestamp=True)
+        try:
+            stream = self.Context.Stream and not quiet
+            loop = asyncio.get_running_loop()
+            readers = []
+            for pipe, buf, name in ((process.stdout, self.Out, "out"), (process.stderr, self.Err, "err")):
+                if pipe is not None:            # stdout of a producer goes to the pipe, see pipes.py
+                    reader = asyncio.StreamReader(limit=buf.ChunkSize)
+                    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+                    readers.append(self.aread_output(reader, buf, name, stream))
+            await asyncio.gather(*readers)
+        except:
+            self.execution_error()
+        try:
+            self.reap(*(await self.await_exit(process.pid)))
+        except:
+            self.execution_error()
+        return self.ended(quiet, time.time() - t0)
+
+    def spawn(self):
+        try:
+            process = spawn(self.Command, flat(self.RunEnv), self.Context.FastSpawn, self.Context.Cwd, self.PipeIn, self.PipeOut)
+        finally:
+            self.close_pipes()
+        Reaper.register(process.pid)        # reaped by execute() or aexecute(), not by the reaper thread
+        return process
+
+    async def await_exit(self, pid):
+        # waits for the process to exit without blocking the event loop, returns os.wait4() result
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if not hasattr(os, "pidfd_open"):
+            return await loop.run_in_executor(None, os.wait4, pid, 0)
+        pidfd = os.pidfd_open(pid)
+        try:
+            exited = asyncio.Event()
+            loop.add_reader(pidfd, exited.set)
+            try:
+                await exited.wait()
+            finally:
+                loop.remove_reader(pidfd)
+        finally:
+            os.close(pidfd)
+        return os.wait4(pid, 0)
+
+    def reap(self, pid, status, rusage):
+        # the process is reaped with os.wait4() to get its resource usage, so Popen does not know it exited
+        self.Process.returncode = os.waitstatus_to_exitcode(status)
+        self.Usage = rusage_dict(rusage)
+        Reaper.unregister(pid)
+
+    def execute_remote(self, quiet):
+        agents = self.Context.Agents
+        agent = None if self.is_killed else agents.acquire(self)
+        if agent is None:
+            return self.Status          # killed while waiting for an agent
+        try:
+            with self:
+                if self.is_killed:
+                    return self.Status
                 t0 = time.time()
-                self.Process = Popen(self.Command, shell=True,
-                            stdin=subprocess.DEVNULL,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                            env=self.RunEnv, process_group=0)
-                if not quiet:
-                    self.log("started:", self.Title, "pid:", self.Process.pid, timestamp=True)
+                self.Exception = None
+                self.Out = self.Context.output_buffer("out")
+                self.Err = self.Context.output_buffer("err")
+            process = RemoteProcess(agent)
+            try:
+                process.start(self.Command, flat(self.RunEnv))
+            except OSError as e:
+                process.returncode = -1
+                self.log("error connecting to agent", agent, ":", e)
+            with self:
+                self.Process = process
+                self.spawned(process.pid)
+                if self.is_killed:
+                    process.kill()          # killed while connecting
+                elif not quiet and process.pid is not None:
+                    self.log("started:", self.Title, "agent:", agent, "pid:", process.pid, timestamp=True)
+            try:
+                for name, text in process.output():
+                    self.feed_output(name, text.encode("utf-8"), quiet)
+                self.feed_output(None, None, quiet)
+            except:
+                self.execution_error()
+            self.Usage = process.Usage
+            return self.ended(quiet, time.time() - t0)
+        finally:
+            agents.release(agent)
+
+    async def aexecute_remote(self, quiet):
+        agents = self.Context.Agents
+        agent = None if self.is_killed else await agents.aacquire(self)
+        if agent is None:
+            return self.Status
         try:
-            out, err = self.Process.communicate()
+            with self:
+                if self.is_killed:
+                    return self.Status
+                t0 = time.time()
+                self.Exception = None
+                self.Out = self.Context.output_buffer("out")
+                self.Err = self.Context.output_buffer("err")
+            process = RemoteProcess(agent)
+            try:
+                await process.astart(self.Command, flat(self.RunEnv))
+            except OSError as e:
+                process.returncode = -1
+                self.log("error connecting to agent", agent, ":", e)
+            with self:
+                self.Process = process
+                self.spawned(process.pid)
+                if self.is_killed:
+                    process.kill()          # killed while connecting
+                elif not quiet and process.pid is not None:
+                    self.log("started:", self.Title, "agent:", agent, "pid:", process.pid, timestamp=True)
+            try:
+                async for name, text in process.aoutput():
+                    self.feed_output(name, text.encode("utf-8"), quiet)
+                self.feed_output(None, None, quiet)
+            except:
+                self.execution_error()
+            self.Usage = process.Usage
+            return self.ended(quiet, time.time() - t0)
+        finally:
+            agents.release(agent)
+
+    def execute_worker(self, quiet):
+        with self:
+            if self.is_killed:
+                return self.Status
+            t0 = time.time()
+            self.Exception = None
+            self.Out = self.Context.output_buffer("out")
+            self.Err = self.Context.output_buffer("err")
+        # as in execute(), the worker shell is not started and the command is not sent under the shared lock
+        worker = self.Workers.get()
+        try:
+            process = worker.start(self.Command, flat(self.RunEnv))
         except:
-            out = err = b""
-        t1 = time.time()
-        self.Out = out.decode("utf-8")
-        self.Err = err.decode("utf-8")
+            worker.Dead = True              # the worker shell is gone
+            self.Workers.release(worker)
+            raise
+        with self:
+            self.Process = process
+            self.spawned(worker.pid)
+            if self.is_killed:
+                self.kill_process()         # killed while the command was being sent
+            elif not quiet:
+                self.log("started:", self.Title, "in", worker, timestamp=True)
+        try:
+            worker.output(lambda name, data: self.feed_output(name, data, quiet))
+            self.feed_output(None, None, quiet)
+        except:
+            self.execution_error(stop=False)
+        finally:
+            self.Workers.release(worker)
+        return self.ended(quiet, time.time() - t0)
+
+    async def aexecute_worker(self, quiet):
+        with self:
+            if self.is_killed:
+                return self.Status
+            t0 = time.time()
+            self.Exception = None
+            self.Out = self.Context.output_buffer("out")
+            self.Err = self.Context.output_buffer("err")
+        # as in execute(), the worker shell is not started and the command is not sent under the shared lock
+        worker = self.Workers.get()
+        try:
+            process = worker.start(self.Command, flat(self.RunEnv))
+        except:
+            worker.Dead = True              # the worker shell is gone
+            self.Workers.release(worker)
+            raise
+        with self:
+            self.Process = process
+            self.spawned(worker.pid)
+            if self.is_killed:
+                self.kill_process()         # killed while the command was being sent
+            elif not quiet:
+                self.log("started:", self.Title, "in", worker, timestamp=True)
+        try:
+            await worker.aoutput(lambda name, data: self.feed_output(name, data, quiet))
+            self.feed_output(None, None, quiet)
+        except:
+            self.execution_error(stop=False)
+        finally:
+            self.Workers.release(worker)
+        return self.ended(quiet, time.time() - t0)
+
+    def execution_error(self, stop=True):
+        # reading the output or waiting for the process failed. The command fails, and is stopped
+        # so that waiting for it does not block on a full pipe
+        traceback.print_exc()
+        self.Exception = sys.exc_info()
+        if stop:
+            with self:
+                if self.Process is not None and not self.Killed:
+                    self.kill_process()
+
+    def feed_output(self, name, data, quiet):
+        # name=None: end of output
+        stream = self.Context.Stream and not quiet
+        if name is None:
+            outputs = [("out", self.Out.flush()), ("err", self.Err.flush())]
+        else:
+            buf = self.Out if name == "out" else self.Err
+            outputs = [(name, buf.feed(data))]
+        if stream:
+            for name, lines in outputs:
+                self.log_lines(name, lines)
+
+    def ended(self, quiet, elapsed):
+        with self:
+            if self.Timer is not None:
+                self.Timer.cancel()
+                self.Timer = None
+            if self.Termination is not None:
+                self.Termination.EndT = time.time()
         self.ExitCode = self.Process.returncode
         status = "ok"
         if self.is_killed:
             status = "killed"
             self.ExitCode = None
-        elif self.ExitCode:
-            status = "failed"
+        elif self.Exception is not None or self.ExitCode is None or self.TimedOut or self.ExitCode and not (self.Consumers and self.ExitCode in (-signal.SIGPIPE, 128 + signal.SIGPIPE)):
+            status = "failed"           # a producer may be stopped by SIGPIPE when its consumers exit
         self.Status = status
+        if status == "ok" and self.Context.History is not None:
+            self.Context.History.record(self.Command, elapsed)
 
-        if not quiet:
-            self.log("%s command:" % ("done" if self.Status=="ok" else "failed",), self.Title, timestamp=True)
-            self.log("status:", self.Status, "exit code:", self.ExitCode)
-            self.log("elapsed time:", self.pretty_time(t1 - t0))
-            out = out.strip()
-            err = err.strip()
-    
-            if out:
-                self.log()
-                self.log("-- stdout: ------")
-                self.log(self.Out)
-                self.log("-----------------")
-            if err:
-                self.log()
-                self.log("-- stderr: ------")
-                self.log(self.Err)
-                self.log("-----------------")
-
+        try:
+            if not quiet:
+                self.log("%s command:" % ("done" if self.Status=="ok" else "failed",), self.Title, timestamp=True)
+                if self.TimedOut:
+                    self.log("timed out after", self.pretty_time(self.Policy.Timeout))
+                termination = self.Termination
+                if termination is not None:
+                    how = "SIGKILL after %s" % (self.pretty_time(termination.Grace),) if termination.Escalated else "SIGTERM"
+                    self.log("terminated in", self.pretty_time(termination.Latency), f"({how})")
+                if self.Exception is not None:
+                    self.log("error:", self.Exception[1])
+                for buf in (self.Out, self.Err):
+                    if buf.SpoolError is not None:
+                        self.log("can not write spool file:", buf.SpoolError, "-", buf.LostBytes, "bytes of output lost")
+                self.log("status:", self.Status, "exit code:", self.ExitCode)
+                self.log("elapsed time:", self.pretty_time(elapsed))
+                if not self.Context.Stream:
+                    self.log_output("stdout", self.Out)
+                    self.log_output("stderr", self.Err)
+        finally:
+            if self.Status != "ok" or self.CacheKey is None:
+                self.Out.close()
+                self.Err.close()
         return self.Status
-        
+
+    def read_output(self, quiet):
+        #
+        # Reads stdout and stderr as they arrive, keeping only the tail of each stream in memory.
+        # In streaming mode, forwards the lines to the log with the step prefix.
+        #
+        stream = self.Context.Stream and not quiet
+        with selectors.DefaultSelector() as selector:
+            if self.Process.stdout is not None:         # None if it goes to a pipe, see pipes.py
+                selector.register(self.Process.stdout, selectors.EVENT_READ, (self.Out, "out"))
+            selector.register(self.Process.stderr, selectors.EVENT_READ, (self.Err, "err"))
+            while selector.get_map():
+                for key, _ in selector.select():
+                    buf, name = key.data
+                    data = os.read(key.fd, buf.ChunkSize)
+                    if data:
+                        lines = buf.feed(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        lines = buf.flush()
+                    if stream:
+                        self.log_lines(name, lines)
+
+    async def aread_output(self, reader, buf, name, stream):
+        while True:
+            data = await reader.read(buf.ChunkSize)
+            lines = buf.feed(data) if data else buf.flush()
+            if stream:
+                self.log_lines(name, lines)
+            if not data:
+                break
+
+    def log_lines(self, name, lines):
+        # lines read at once are logged as one message
+        if lines:
+            prefix = f"[{self.Title}] {name}: "
+            self.Context.Log.write("".join(prefix + line + "\n" for line in lines), self.Path)
+
+    def log_output(self, name, buf):
+        if buf:
+            self.log()
+            self.log(f"-- {name}: ------")
+            if buf.spilled:
+                # log the spooled part without loading it into memory, in chunks of about ChunkSize
+                indent = self.Indent + self.LogOffset
+                chunk, size = [], 0
+                for line in buf.lines():
+                    chunk.append(indent + line)
+                    size += len(line)
+                    if size >= buf.ChunkSize:
+                        self.Context.Log.write("".join(chunk), self.Path)
+                        chunk, size = [], 0
+                chunk.append("\n")
+                self.Context.Log.write("".join(chunk), self.Path)
+            else:
+                self.log(buf.tail())
+            self.log("-----------------")
+
+    def kill_process(self):
+        try:
+            if isinstance(self.Process, RemoteProcess):
+                self.Process.kill(self.Context.KillGrace)       # the agent kills the process group
+            elif self.Process.returncode is None:
+                # the process is reaped by execute() or aexecute(). Popen.kill() would poll it.
+                # The signals are sent by the reaper thread, with all other processes being killed
+                self.Termination = Reaper.terminate(self.Process.pid, self.Context.KillGrace)
+        except:
+            #print("exception killing command:", self)
+            traceback.print_exc()
+
     @synchronized
     def kill(self):
         #print("Command.kill(): self.Killed:", self.Killed, "  self.Process:", self.Process)
         if not self.Killed and self.Process is not None:
-            #print("Command.kill()...")
-            try:    
-                os.killpg(self.Process.pid, signal.SIGINT)
-                self.Process.kill()
-                self.Process.communicate()
-            except:
-                #print("exception killing command:", self)
-                traceback.print_exc()
-                pass
+            self.kill_process()
         self.killed()
+        if self.Pause is not None:
+            self.Pause.set()                # waiting to retry
+        if self.Process is None:
+            if self.Context.Resources is not None:
+                self.Context.Resources.cancel(self)         # waiting for resources
+            if self.Context.Agents is not None:
+                self.Context.Agents.cancel(self)            # waiting for an agent
 
 class ParallelGroup(Step):
-    
-    def __init__(self, config, env, level, steps=[]):
-        Step.__init__(self, config, env, level)
+
+    __slots__ = ("Multiplicity", "Queue", "Steps", "ShotDown", "Running", "Waiting", "Dispatched", "Quiet",
+        "Loop", "Changed", "Tasks", "Workers", "Failed", "Durations", "Adaptive", "Blocked", "CopyFailed",
+        "Precedence")
+
+    MinSamples = 5              # durations of the steps which succeeded needed for -speculate
+
+    def __init__(self, config, env, level, steps=[], context=None):
+        Step.__init__(self, config, env, level, context)
         self.Title = self.Title or "parallel group #%04x" % (id(self) % 256,)
-        self.Queue = TaskQueue(config.get("multiplicity", 5), delegate=self)
+        multiplicity = str(config.get("multiplicity", 5))
+        self.Adaptive = AdaptiveLimit(multiplicity) if multiplicity.startswith("auto") else None     # see adaptive.py
+        self.Multiplicity = self.Adaptive.Limit if self.Adaptive is not None else int(multiplicity)
+        self.Queue = None               # TaskQueue, created when run by the threads engine
         self.Steps = steps
+        StepTable(len(steps)).attach(steps)
         self.ShotDown = False
+        self.Failed = False
+        self.Running = set()
+        self.Waiting = ()               # steps not dispatched yet, longest remaining path first
+        self.Dispatched = 0             # dispatched and not ended yet
+        self.Blocked = {}               # path of a running child -> number of its steps waiting for -after
+        self.CopyFailed = set()         # running commands whose speculative copy failed, they are not copied again
+        self.Precedence = None          # {child index: [child index, ...]}, see precedence()
+        self.Quiet = False
+        self.Loop = None                # event loop, when run by the asyncio engine
+        self.Changed = None             # threading.Event or asyncio.Event, set when the group state changes
+        self.Tasks = None               # running asyncio tasks. The event loop keeps only weak references to them
+        self.Durations = None           # deque of the recent durations of the steps which succeeded
+        self.Workers = WorkerPool() if self.Context.ShellWorkers else None
+        if self.Workers is not None:
+            for step in steps:
+                step.use_workers(self.Workers)
 
     @synchronized
     def dump_state(self):
-        running = self.Queue.activeTasks()
-        running_steps = [task.Step for task in running]
         steps = []
         for step in self.Steps:
             step_dump = step.dump_state()
-            if step in running_steps:
-                step_dump["status"] = "running"
+            if step in self.Running:
+                if step_dump["status"] in (None, "pending"):
+                    step_dump["status"] = "running"
             elif step.Status is None:
                 step_dump["status"] = "pending"
             steps.append(step_dump)
-        return {"type":"sequential", "status":self.Status, "title":self.Title, "steps":steps}
+        state = {"type":"sequential", "status":self.Status, "title":self.Title, "steps":steps}
+        if self.Usage:
+            state["usage"] = self.Usage
+        self.dump_concurrency(state)
+        return state
+
+    def dump_concurrency(self, state):
+        state["multiplicity"] = self.Multiplicity
+        if self.Adaptive is not None:
+            state["concurrency"] = self.Adaptive.dump()
         
     def update_run_env(self, outer):
         self.RunEnv = self.combine_env(outer)
         for step in self.Steps:
             step.update_run_env(self.RunEnv)
 
+    def set_path(self, path):
+        self.Path = path
+        for i, step in enumerate(self.Steps):
+            step.set_path(f"{path}/{i}")
+
+    def walk(self):
+        yield self
+        for step in self.Steps:
+            yield from step.walk()
+
+    def estimate(self):
+        return 0.0          # empty group
+
+    def predict(self, now=None):
+        # the steps already started hold their slots, the others start longest remaining path first
+        if now is not None and self.Done:
+            return 0.0
+        steps = self.Steps
+        order = sorted(range(len(steps)), key=lambda i: (now is None or steps[i].StartT is None, -steps[i].Rank))
+        precedence = self.precedence()
+        after = None
+        if precedence:
+            position = {i: k for k, i in enumerate(order)}
+            after = [[position[j] for j in precedence.get(i, ())] for i in order]
+        return schedule([steps[i].predict(now) for i in order], self.Multiplicity, after)
+
+    def precedence(self):
+        # {i: [j, ...]}: child i, or a step inside it, has -after for child j or a step inside it.
+        # The whole child i is predicted to start after the whole child j
+        if self.Precedence is None:
+            owner = {}
+            for i, child in enumerate(self.Steps):
+                for step in child.walk():
+                    owner[id(step)] = i
+            precedence = {}
+            for i, child in enumerate(self.Steps):
+                for step in child.walk():
+                    for dep in step.Dependencies:
+                        j = owner.get(id(dep), i)
+                        if j != i and j not in precedence.setdefault(i, []):
+                            precedence[i].append(j)
+            self.Precedence = precedence
+        return self.Precedence
+
+    def cancel(self):
+        for step in self.Steps:
+            step.cancel()
+        Step.cancel(self)
+
     @synchronized
     def taskFailed(self, queue, task, exc_type, exc_value, tb):
         step = task.Step
+        self.Running.discard(step)
+        self.Dispatched -= 1
         self.log(self.Indent + f"EXCEPTION in {step.Title}:", timestamp=True)
         traceback.print_exc(exc_type, exc_value, tb)
         self.log("")
@@ -241,10 +1119,37 @@ class ParallelGroup(Step):
         if step.ExitCode is not None:
             self.ExitCode = step.ExitCode
         self.shutdown()
+        self.notify()
 
     @synchronized
     def taskEnded(self, queue, task, status):
-        step = task.Step
+        self.Dispatched -= 1
+        self.step_ended(task.Step, status)
+
+    @synchronized
+    def step_ended(self, step, status):
+        self.Running.discard(step)
+        if isinstance(step, Command) and step.Original is not None:
+            # speculative copy. If it succeeded while the original is still running, it replaces the original.
+            # Otherwise it is dropped and the original runs to its own end
+            original = step.Original
+            if not original.Done:
+                if status == "ok":
+                    original.supersede(step)
+                else:
+                    with original:
+                        original.Copy = None
+                    self.CopyFailed.add(original)
+            self.dispatch()
+            self.notify()
+            return
+        if isinstance(step, Command) and step.Copy is not None and not step.Copy.Done:
+            step.Copy.kill()
+        self.CopyFailed.discard(step)
+        if status == "ok" and step.Elapsed is not None:
+            if self.Durations is None:
+                self.Durations = deque(maxlen=1000)
+            self.Durations.append(step.Elapsed)
         #print("step ended:", status, "code:", step.ExitCode)
         if status != "ok":
             self.Status = "failed"
@@ -253,7 +1158,124 @@ class ParallelGroup(Step):
             if status != "killed" and step.ExitCode is not None:
                 self.ExitCode = step.ExitCode
         #print("step ended: self.ExitCode ->", self.ExitCode)
-    
+        self.dispatch()
+        self.notify()
+
+    def dependency_ended(self, step):
+        # called by a step in another group, so the group is not locked here. The steps
+        # are dispatched by _run() or _arun()
+        self.notify()
+
+    @synchronized
+    def dispatch(self):
+        #
+        # Starts ready steps while there are free slots. Among the ready steps, those with the
+        # longest remaining path to the end of the script go first. A pipeline takes one free slot
+        # to start and then runs all its commands, see pipes.py
+        #
+        while not self.ShotDown and self.busy() < self.Multiplicity:
+            step, state = self.next_step()
+            if step is None:
+                return          # nothing is ready
+            members = step.pipeline()
+            if not state:
+                for member in members:
+                    member.StartT = time.time()
+                    member.Status = member.dependency_failed(self.Quiet)
+                    member.event(member.Status)
+                    member.finished()
+                    self.step_ended(member, member.Status)
+                continue
+            if len(members) > 1:
+                connect(members)
+            for member in members:
+                self.launch(member)
+
+    def launch(self, step):
+        self.Dispatched += 1
+        self.Running.add(step)
+        if self.Loop is not None:
+            task = self.Loop.create_task(self.arun_step(step))
+            self.Tasks.add(task)
+            task.add_done_callback(self.Tasks.discard)
+        else:
+            self.Queue.append(StepTask(step, self.Quiet))
+
+    def speculate(self):
+        #
+        # Starts copies of the running commands with -speculate=<percent> which run longer than
+        # the percentile of the durations of the steps which succeeded. Copies take only free slots
+        # when there are no more steps to start. Returns seconds until the next check, or None
+        #
+        if self.ShotDown or self.Durations is None or len(self.Durations) < self.MinSamples:
+            return None
+        now = time.time()
+        next_check = None
+        for step in list(self.Running):
+            policy = step.Policy if isinstance(step, Command) else None
+            if policy is None or policy.Speculate is None or step.Original is not None or step.Copy is not None \
+                    or step in self.CopyFailed or step.ProcessStartT is None or step.piped():
+                continue
+            delay = step.StartT + percentile(self.Durations, policy.Speculate) - now
+            if delay > 0:
+                next_check = delay if next_check is None else min(next_check, delay)
+            elif self.busy() < self.Multiplicity and not self.has_waiting():
+                step.Copy = step.duplicate()
+                if not self.Quiet:
+                    self.log("speculative copy:", step.Title, timestamp=True)
+                self.launch(step.Copy)
+        return next_check
+
+    def adapt(self):
+        # adjusts the multiplicity, see adaptive.py. Returns seconds until the next adjustment, or None
+        if self.Adaptive is None or self.ShotDown:
+            return None
+        change = self.Adaptive.adjust(self.busy(), self.has_waiting())
+        if change is not None:
+            self.Multiplicity, reason = change
+            if not self.Quiet:
+                self.log("multiplicity:", self.Multiplicity, f"({reason})", timestamp=True)
+            self.event("multiplicity")
+            self.dispatch()
+        return self.Adaptive.next_check()
+
+    def next_step(self):
+        # returns (step, dependencies state) for the next ready step, or (None, None)
+        for i, step in enumerate(self.Waiting):
+            state = step.dependencies_state()
+            if state is not None:
+                del self.Waiting[i]
+                return step, state
+        return None, None
+
+    def has_waiting(self):
+        return bool(self.Waiting)
+
+    def busy(self):
+        # slots taken: dispatched steps, except those waiting for -after dependencies
+        return self.Dispatched - len(self.Blocked)
+
+    def child_blocked(self, path, waiting):
+        with self:
+            count = self.Blocked.get(path, 0) + (1 if waiting else -1)
+            if count > 0:
+                self.Blocked[path] = count
+            else:
+                self.Blocked.pop(path, None)
+            if self.Queue is not None:
+                self.Queue.NWorkers = self.capacity() + len(self.Blocked)
+        self.notify()
+
+    def notify(self):
+        if self.Loop is not None:
+            self.Loop.call_soon_threadsafe(self.Changed.set)
+        elif self.Changed is not None:
+            self.Changed.set()
+
+    @synchronized
+    def is_complete(self):
+        return self.Dispatched == 0 and (self.ShotDown or not self.has_waiting())
+
     def kill(self):
         self.shutdown()
         self.Status = "killed"
@@ -261,41 +1283,273 @@ class ParallelGroup(Step):
     @synchronized
     def shutdown(self):
         #print("stopping:", self.Title)
-        self.Queue.hold()
-        for task in self.Queue.waitingTasks():
-            self.Queue.cancel(task)
-        for task in self.Queue.activeTasks():
-            step = task.Step
+        queue = self.Queue
+        if queue is not None:
+            queue.hold()
+            for task in queue.waitingTasks():
+                queue.cancel(task)
+                self.Dispatched -= 1
+                task.Step.cancel()
+        for step in list(self.Running):
             if not step.Killed and step.Status is None:
                 #print("killing:", task)
                 step.kill()
-        self.Queue.release()
+        if queue is not None:
+            queue.release()
         self.ShotDown = True
-        
+        for step in self.Waiting:
+            step.cancel()
+        self.Waiting = deque()
+        self.notify()
+
+    def start(self, quiet):
+        with self:
+            self.Status = "ok"
+            self.Quiet = quiet
+            if not quiet:
+                self.log("started:", self.Title, timestamp=True)
+            # consumers of pipes are started with their producers
+            self.Waiting = deque(sorted((step for step in self.Steps if not (isinstance(step, Command) and step.Producer is not None)),
+                key=lambda step: -step.Rank))
+            self.Context.Groups[self.Path] = self
+        # watch() locks the dependency, which can be anywhere in the tree, so not under the group lock
+        for step in self.Steps:
+            for dep in step.Dependencies:
+                if dep not in self.Steps:
+                    dep.watch(self.dependency_ended)
+
+    def capacity(self):
+        # most steps running at once: the limit, plus the rest of a pipeline started with one free slot
+        limit = self.Adaptive.Max if self.Adaptive is not None else self.Multiplicity
+        return limit + max((len(step.pipeline()) - 1 for step in self.Steps), default=0)
+
     def _run(self, quiet):
-        self.Status = "ok"
-        if not quiet:
-            self.log("started:", self.Title, timestamp=True)
         t0 = time.time()
-        for step in self.Steps:
-            self.Queue.append(StepTask(step, quiet))
-        self.Queue.join()
-        t1 = time.time()
+        self.Queue = TaskQueue(self.capacity(), delegate=self)
+        self.Changed = threading.Event()
+        self.start(quiet)
+        while True:
+            with self:
+                self.dispatch()
+                if self.is_complete():
+                    break
+                timeout = min((t for t in (self.speculate(), self.adapt()) if t is not None), default=None)
+            self.Changed.wait(timeout)
+            self.Changed.clear()
+        return self.ended(quiet, time.time() - t0)
+
+    async def _arun(self, quiet):
+        import asyncio
+        t0 = time.time()
+        self.Loop = asyncio.get_running_loop()
+        self.Changed = asyncio.Event()
+        self.Tasks = set()
+        self.start(quiet)
+        while True:
+            with self:
+                self.dispatch()
+                if self.is_complete():
+                    break
+                timeout = min((t for t in (self.speculate(), self.adapt()) if t is not None), default=None)
+            try:
+                await asyncio.wait_for(self.Changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.Changed.clear()
+        return self.ended(quiet, time.time() - t0)
+
+    async def arun_step(self, step):
+        try:
+            status = await step.arun(self.Quiet)
+        except:
+            traceback.print_exc()
+            status = "failed"
+        with self:
+            self.Dispatched -= 1
+            self.step_ended(step, status)
+
+    def ended(self, quiet, elapsed):
+        self.Context.Groups.pop(self.Path, None)
+        self.Usage = aggregate_usage(step.Usage for step in self.Steps)
+        if self.Workers is not None:
+            self.Workers.close()
         if not quiet:
             self.log("%s group:" % ("done" if self.Status=="ok" else "failed",), self.Title, timestamp=True)
             self.log("status:", self.Status, "exit code:", self.ExitCode)
-            self.log("elapsed time:", self.pretty_time(t1 - t0))
+            self.log("elapsed time:", self.pretty_time(elapsed))
             self.log("")
         if self.Status == "killed":
-            self.StatusCoce = None
+            self.ExitCode = None
         return self.Status
 
+class SweepGroup(ParallelGroup):
+    #
+    # Parallel group running its body once for each combination of parameter values:
+    #
+    #   { -foreach=i:1..100000
+    #       command $i
+    #   }
+    #
+    #   { -matrix="n:1..10 mode:fast,slow"
+    #       command $n $mode
+    #   }
+    #
+    # Elements are created only when there is a free slot for them and dropped when they end,
+    # so the memory does not depend on the number of elements. Each element is the body of the group,
+    # a single step or a sequential group of the body steps, with the parameters added to its environment.
+    #
+
+    __slots__ = ("Parameters", "Total", "MakeElement", "Created", "Counts", "ElementEstimate")
+
+    def __init__(self, config, env, level, make_element, context=None):
+        ParallelGroup.__init__(self, config, env, level, [], context=context)
+        self.Title = config.get("title") or "sweep #%04x" % (id(self) % 256,)
+        self.Parameters = parse_sweep(config.get("foreach", "") + " " + config.get("matrix", ""))
+        self.Total = 1
+        for name, values in self.Parameters:
+            self.Total *= len(values)
+        self.MakeElement = make_element         # make_element(level) -> new Step
+        self.Created = 0
+        self.Counts = {}                        # status -> number of ended elements
+        self.ElementEstimate = None
+
+    @synchronized
+    def dump_state(self):
+        running = []
+        for step in self.Running:
+            step_dump = step.dump_state()
+            if step_dump["status"] in (None, "pending"):
+                step_dump["status"] = "running"
+            running.append(step_dump)
+        state = {"type":"sweep", "status":self.Status, "title":self.Title,
+            "total":self.Total, "pending":self.Total - self.Created, "running":len(self.Running),
+            "ended":dict(self.Counts), "steps":running}
+        if self.Usage:
+            state["usage"] = self.Usage
+        self.dump_concurrency(state)
+        return state
+
+    def walk(self):
+        yield self
+        for step in list(self.Running):
+            yield from step.walk()
+
+    def estimate(self):
+        return self.predict()
+
+    def predict(self, now=None):
+        if now is not None and self.Done:
+            return 0.0
+        if self.ElementEstimate is None:
+            self.ElementEstimate = self.MakeElement(self.Level + 1).predict()
+        running, pending = [], self.Total
+        if now is not None:
+            with self:
+                running, pending = list(self.Running), self.Total - self.Created
+        # elements do not wait for each other, -after can not be used in the body, see dag.py.
+        # Pending elements beyond the first round are counted as evenly spread over the slots
+        m = max(1, self.Multiplicity)
+        first = min(pending, m)
+        return schedule([step.predict(now) for step in running] + [self.ElementEstimate] * first, m) \
+            + (pending - first) * self.ElementEstimate / m
+
+    def element_parameters(self, index):
+        # parameter values of the element, the last parameter changes fastest
+        params = {}
+        for name, values in reversed(self.Parameters):
+            index, i = divmod(index, len(values))
+            params[name] = values[i]
+        return dict(reversed(params.items()))
+
+    def next_step(self):
+        if self.Created >= self.Total:
+            return None, None
+        step = self.MakeElement(self.Level + 1)
+        params = self.element_parameters(self.Created)
+        step.Env = dict(step.Env or {}, **params)
+        step.Title = "%s [%s]" % (step.Title, " ".join(f"{name}={value}" for name, value in params.items()))
+        step.set_path(f"{self.Path}/{self.Created}")
+        if self.Workers is not None:
+            step.use_workers(self.Workers)
+        step.update_run_env(self.RunEnv)
+        self.Created += 1
+        return step, True
+
+    def has_waiting(self):
+        return self.Created < self.Total
+
+    @synchronized
+    def step_ended(self, step, status):
+        if not isinstance(step, Command) or step.Original is None:
+            self.Counts[status] = self.Counts.get(status, 0) + 1
+            self.Usage = aggregate_usage([self.Usage, step.Usage])
+        ParallelGroup.step_ended(self, step, status)
+
+    @synchronized
+    def shutdown(self):
+        ParallelGroup.shutdown(self)
+        cancelled = self.Total - self.Created
+        if cancelled:
+            self.Counts["cancelled"] = self.Counts.get("cancelled", 0) + cancelled
+            self.Created = self.Total
+
+    def ended(self, quiet, elapsed):
+        usage = self.Usage
+        status = ParallelGroup.ended(self, quiet, elapsed)
+        self.Usage = usage          # elements are not kept in self.Steps
+        return status
+
+    def cancel(self):
+        Step.cancel(self)
+
+
+def parse_sweep(text):
+    # "i:1..10 mode:fast,slow" -> [("i", ["1", ... "10"]), ("mode", ["fast", "slow"])]
+    # a..b..step is a range of integers, with optional step. Otherwise a comma separated list of values.
+    parameters = []
+    for item in text.split():
+        name, sep, spec = item.partition(":")
+        if not sep or not name:
+            raise ValueError(f"Invalid sweep parameter: {item}, expected <name>:<values>")
+        if ".." in spec:
+            try:
+                bounds = [int(x) for x in spec.split("..")]
+            except ValueError:
+                raise ValueError(f"Invalid range in sweep parameter: {item}")
+            first, last = bounds[:2]
+            step = bounds[2] if len(bounds) > 2 else (1 if last >= first else -1)
+            values = range(first, last + (1 if step > 0 else -1), step)
+            values = RangeValues(values)
+        else:
+            values = spec.split(",")
+        parameters.append((name, values))
+    return parameters
+
+
+class RangeValues(object):
+    # range of integers as strings, without materializing the list
+
+    __slots__ = ("Range",)
+
+    def __init__(self, r):
+        self.Range = r
+
+    def __len__(self):
+        return len(self.Range)
+
+    def __getitem__(self, i):
+        return str(self.Range[i])
+
+
 class SequentialGroup(Step):
-    
-    def __init__(self, config, external_env, level, steps = []):
-        Step.__init__(self, config, external_env, level)
+
+    __slots__ = ("Steps", "RunningStep")
+
+    def __init__(self, config, external_env, level, steps = [], context=None):
+        Step.__init__(self, config, external_env, level, context)
         self.Title = self.Title or "sequential group #%04x" % (id(self) % 256,)
         self.Steps = steps
+        StepTable(len(steps)).attach(steps)
         self.RunningStep = None
     
     @synchronized
@@ -308,34 +1562,88 @@ class SequentialGroup(Step):
             elif step.Status is None:
                 step_dump["status"] = "pending"
             steps.append(step_dump)
-        return {"type":"sequential", "status":self.Status, "title":self.Title, "steps":steps}
+        state = {"type":"sequential", "status":self.Status, "title":self.Title, "steps":steps}
+        if self.Usage:
+            state["usage"] = self.Usage
+        return state
 
     def update_run_env(self, outer):
         self.RunEnv = self.combine_env(outer)
         for step in self.Steps:
             step.update_run_env(self.RunEnv)
 
+    def set_path(self, path):
+        self.Path = path
+        for i, step in enumerate(self.Steps):
+            step.set_path(f"{path}/{i}")
+
+    def use_workers(self, pool):
+        # the steps run one at a time in the slot of the enclosing parallel group
+        for step in self.Steps:
+            step.use_workers(pool)
+
+    def walk(self):
+        yield self
+        for step in self.Steps:
+            yield from step.walk()
+
+    def estimate(self):
+        return 0.0          # empty group
+
+    def predict(self, now=None):
+        if now is not None and self.Done:
+            return 0.0
+        return sum(step.predict(now) for step in self.Steps)
+
+    def cancel(self):
+        for step in self.Steps:
+            step.cancel()
+        Step.cancel(self)
+
     def _run(self, quiet):
         if not quiet:
             self.log("started:", self.Title, timestamp=True)
         t0 = time.time()
         for step in self.Steps:
             with self:
-                if self.Status is None:
-                    self.RunningStep = step
-                    with self.unlock:
-                        status = step.run()
-                        if step.ExitCode is not None:
-                            self.ExitCode = step.ExitCode
-                    if status != "ok":
-                        self.Status = "killed"
-        t1 = time.time()
+                if self.Status is not None:
+                    step.cancel()
+                    continue
+                self.RunningStep = step
+            status = step.run(quiet)
+            with self:
+                if step.ExitCode is not None:
+                    self.ExitCode = step.ExitCode
+                if status != "ok":
+                    self.Status = "killed"
+        return self.ended(quiet, time.time() - t0)
+
+    async def _arun(self, quiet):
+        if not quiet:
+            self.log("started:", self.Title, timestamp=True)
+        t0 = time.time()
+        for step in self.Steps:
+            with self:
+                if self.Status is not None:
+                    step.cancel()
+                    continue
+                self.RunningStep = step
+            status = await step.arun(quiet)
+            with self:
+                if step.ExitCode is not None:
+                    self.ExitCode = step.ExitCode
+                if status != "ok":
+                    self.Status = "killed"
+        return self.ended(quiet, time.time() - t0)
+
+    def ended(self, quiet, elapsed):
         if self.Status is None:
             self.Status = "ok"
+        self.Usage = aggregate_usage(step.Usage for step in self.Steps)
         if not quiet:
             self.log("%s group:" % ("done" if self.Status=="ok" else "failed",), self.Title, timestamp=True)
             self.log("status:", self.Status, "exit code:", self.ExitCode)
-            self.log("elapsed time:", self.pretty_time(t1 - t0))
+            self.log("elapsed time:", self.pretty_time(elapsed))
             self.log("")
         return self.Status
 
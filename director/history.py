@@ -0,0 +1,119 @@
+import os, json, time, heapq, hashlib, tempfile
+from pythreader import Primitive, synchronized
+
+#
+# Durations of commands from the previous runs. Commands are identified by the hash of the command line,
+# so the elements of a sweep share one entry. The file is a JSON object:
+#
+#   {"<hash>": {"mean": <seconds>, "n": <number of runs>, "t": <time of the last run>}, ...}
+#
+# The mean is exponentially weighted, recent runs count more. Only successful runs are recorded.
+# The file keeps up to MaxEntries commands, those not run for the longest time are removed first.
+# A command not run before is estimated to take DefaultEstimate seconds.
+# The durations are used as Step.estimate(), so the parallel groups start the longest steps first,
+# and to predict the time to the end of the script, see Step.predict().
+#
+
+def default_path():
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_dir, "director", "durations.json")
+
+def command_key(command):
+    return hashlib.sha1(command.encode("utf-8")).hexdigest()
+
+def schedule(durations, slots, after=None):
+    #
+    # Makespan of the durations started in the given order, each as soon as one of the slots is free.
+    # after[i]: indexes of the durations which must end before duration i starts, e.g. -after. Of the
+    # ready ones, the first in the order starts. If none is ready when a slot is free, the slot waits
+    # for the one ready first
+    #
+    n = len(durations)
+    ends = [0.0] * max(1, min(slots, n))
+    if not after or not any(after):
+        for duration in durations:
+            heapq.heapreplace(ends, ends[0] + duration)
+        return max(ends)
+    finish = [0.0] * n
+    waiting = [len(deps) for deps in after]
+    dependents = [[] for _ in range(n)]
+    for i, deps in enumerate(after):
+        for j in deps:
+            dependents[j].append(i)
+    ready = [i for i in range(n) if not waiting[i]]         # heap of indexes, ready at time 0
+    later = []                                              # heap of (ready time, index)
+    for _ in range(n):
+        t = ends[0]
+        while later and later[0][0] <= t:
+            heapq.heappush(ready, heapq.heappop(later)[1])
+        if ready:
+            i = heapq.heappop(ready)
+        else:
+            t, i = heapq.heappop(later)
+        finish[i] = t + durations[i]
+        heapq.heapreplace(ends, finish[i])
+        for k in dependents[i]:
+            waiting[k] -= 1
+            if not waiting[k]:
+                heapq.heappush(later, (max(finish[j] for j in after[k]), k))
+    return max(ends)
+
+class DurationHistory(Primitive):
+
+    Alpha = 0.3                 # weight of the last run in the mean
+    MaxEntries = 5000
+    DefaultEstimate = 1.0       # seconds, for commands not run before
+
+    def __init__(self, path):
+        Primitive.__init__(self, name=path)
+        self.Path = path
+        self.Entries = self.load()
+        self.Updated = {}       # entries recorded by this run
+
+    def load(self):
+        try:
+            with open(self.Path, "r") as f:
+                entries = json.load(f)
+            if all({"mean", "n", "t"} <= entry.keys() for entry in entries.values()):
+                return entries
+        except (OSError, ValueError, AttributeError):
+            pass
+        return {}                   # not there or not in this format, the history starts over
+
+    def known(self, command):
+        return command_key(command) in self.Entries
+
+    def estimate(self, command):
+        # seconds
+        entry = self.Entries.get(command_key(command))
+        return entry["mean"] if entry is not None else self.DefaultEstimate
+
+    @synchronized
+    def record(self, command, seconds):
+        key = command_key(command)
+        entry = self.Entries.get(key)
+        if entry is None:
+            entry = {"mean": seconds, "n": 1, "t": int(time.time())}
+        else:
+            entry = {"mean": entry["mean"] + self.Alpha * (seconds - entry["mean"]), "n": entry["n"] + 1,
+                "t": int(time.time())}
+        self.Entries[key] = self.Updated[key] = entry
+
+    @synchronized
+    def save(self):
+        # entries recorded by other runs meanwhile are kept
+        if not self.Updated:
+            return
+        entries = self.load()
+        entries.update(self.Updated)
+        if len(entries) > self.MaxEntries:
+            entries = dict(heapq.nlargest(self.MaxEntries, entries.items(), key=lambda item: item[1]["t"]))
+        directory = os.path.dirname(self.Path) or "."
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix=".durations-", dir=directory)
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.Path)
+        except OSError:
+            pass                # history is optional
@@ -0,0 +1,75 @@
+import json, os, hashlib
+from pythreader import Primitive, synchronized
+from .environment import declared
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def env_hash(env):
+    return text_hash(json.dumps(sorted((env or {}).items())))
+
+
+class Journal(Primitive):
+    #
+    # Append-only journal of step completions, one JSON record per line:
+    #
+    #   {"path": "0/3/1", "type": "command", "command_hash": ..., "env_hash": ...,
+    #       "status": "ok", "exit_code": 0, "started": ..., "ended": ..., "elapsed": ..., "usage": {...}}
+    #
+    # With resume=True, the records of the previous runs are loaded and the commands recorded
+    # as "ok" with the same path, command and environment are not run again. Only the variables
+    # set by the script count, not those inherited from the shell.
+    #
+
+    def __init__(self, path, resume=False):
+        Primitive.__init__(self, name=path)
+        self.Path = path
+        self.Done = {}              # path -> last record
+        if resume and os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue        # partially written line, e.g. when the previous run was killed
+                    self.Done[record["path"]] = record
+        self.File = open(path, "a")
+
+    @staticmethod
+    def step_hashes(step):
+        command = getattr(step, "Command", None)
+        return (text_hash(command) if command is not None else None), env_hash(declared(step.RunEnv))
+
+    def completed(self, step):
+        if step.piped():
+            return False                # the other commands of the pipeline may run, see pipes.py
+        record = self.Done.get(step.Path)
+        if record is None or record.get("status") != "ok":
+            return False
+        command_hash, env_hash = self.step_hashes(step)
+        return record.get("command_hash") == command_hash and record.get("env_hash") == env_hash
+
+    @synchronized
+    def record(self, step):
+        command_hash, env_hash = self.step_hashes(step)
+        record = {
+            "path":         step.Path,
+            "type":         type(step).__name__,
+            "command_hash": command_hash,
+            "env_hash":     env_hash,
+            "status":       step.Status,
+            "exit_code":    step.ExitCode,
+            "started":      step.StartT,
+            "ended":        step.EndT,
+            "elapsed":      step.Elapsed,
+            "usage":        step.Usage
+        }
+        self.File.write(json.dumps(record) + "\n")
+        self.File.flush()
+
+    @synchronized
+    def close(self):
+        if self.File is not None:
+            self.File.close()
+            self.File = None
@@ -0,0 +1,137 @@
+import sys, os, json, time, queue, threading, atexit
+
+#
+# All log output of the script goes through one writer thread. Steps put complete messages into
+# a bounded queue and go on, so they are not slowed down by a slow terminal or pipe unless
+# the queue is full. The writer takes everything there is in the queue and writes it with one
+# write() and flush() per destination.
+#
+# Destinations:
+#   out         - human readable log, default: sys.stdout
+#   json_path   - optional JSON-lines structured log, one record per step event:
+#                   {"time": ..., "path": "0/3/1", "title": ..., "event": "started"|"spawned"|"ok"|...,
+#                       "pid": ..., "exit_code": ...}
+#   step_dir    - optional directory for per-step log files: <dir>/<path with "/" replaced by ".">.log
+#                   with the log messages and output of the step. The file is open while the step runs.
+#
+
+class LogWriter(object):
+
+    QueueSize = 10000
+    BatchSize = 1000
+
+    def __init__(self, out=None, json_path=None, step_dir=None):
+        self.Out = out                  # None: sys.stdout at the time of writing
+        self.JSON = open(json_path, "a") if json_path else None
+        self.StepDir = step_dir
+        if step_dir:
+            os.makedirs(step_dir, exist_ok=True)
+        self.StepFiles = {}             # path -> open file, used by the writer thread only
+        self.Queue = queue.Queue(self.QueueSize)
+        self.Thread = None
+        self.AtExit = False
+        self.Lock = threading.Lock()
+
+    def put(self, item):
+        if self.Thread is None:
+            with self.Lock:
+                if self.Thread is None:
+                    self.Thread = threading.Thread(target=self.run, daemon=True, name="director log writer")
+                    self.Thread.start()
+                    if not self.AtExit:
+                        atexit.register(self.close)
+                        self.AtExit = True
+        self.Queue.put(item)
+
+    def write(self, text, path=None):
+        # human readable text. If path is given, the text goes to the step log file too
+        self.put(("out", text, path))
+
+    def event(self, step, event, pid=None):
+        if self.JSON is not None:
+            self.put(("json", json.dumps({
+                "time":         time.time(),
+                "path":         step.Path,
+                "title":        step.Title,
+                "event":        event,
+                "pid":          pid,
+                "exit_code":    step.ExitCode
+            }) + "\n", None))
+
+    def end_step(self, path):
+        if self.StepDir:
+            self.put(("end", None, path))
+
+    def flush(self):
+        # waits until everything logged so far is written
+        if self.Thread is not None:
+            done = threading.Event()
+            self.put(("flush", done, None))
+            done.wait()
+
+    def close(self):
+        with self.Lock:
+            thread, self.Thread = self.Thread, None
+            if self.AtExit:
+                atexit.unregister(self.close)       # the daemon creates a writer per run
+                self.AtExit = False
+        if thread is not None:
+            self.Queue.put(("stop", None, None))
+            thread.join()
+
+    def step_file(self, path):
+        f = self.StepFiles.get(path)
+        if f is None:
+            f = self.StepFiles[path] = open(os.path.join(self.StepDir, path.replace("/", ".") + ".log"), "a")
+        return f
+
+    def run(self):
+        while True:
+            items = [self.Queue.get()]
+            try:
+                while len(items) < self.BatchSize:
+                    items.append(self.Queue.get_nowait())
+            except queue.Empty:
+                pass
+            out = []
+            flushed = []
+            stop = False
+            for kind, data, path in items:
+                if kind == "out":
+                    out.append(data)
+                    if path is not None and self.StepDir:
+                        try:
+                            self.step_file(path).write(data)
+                        except OSError:
+                            pass
+                elif kind == "json":
+                    self.JSON.write(data)
+                elif kind == "end":
+                    f = self.StepFiles.pop(path, None)
+                    if f is not None:
+                        f.close()
+                elif kind == "flush":
+                    flushed.append(data)
+                elif kind == "stop":
+                    stop = True
+            try:
+                if out:
+                    stream = self.Out or sys.stdout
+                    stream.write("".join(out))
+                    stream.flush()
+                if self.JSON is not None:
+                    self.JSON.flush()
+                for f in self.StepFiles.values():
+                    f.flush()
+            except (OSError, ValueError):
+                pass                    # the log goes to a closed pipe, the steps should go on anyway
+            for done in flushed:
+                done.set()
+            if stop:
+                for f in self.StepFiles.values():
+                    f.close()
+                self.StepFiles = {}
+                if self.JSON is not None:
+                    self.JSON.close()
+                    self.JSON = None
+                return
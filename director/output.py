@@ -0,0 +1,113 @@
+import os, tempfile
+from collections import deque
+
+
+class OutputBuffer(object):
+    #
+    # Keeps the last TailSize bytes of a command output stream in memory.
+    # Older lines are spilled to the spool file, so the memory usage does not depend on
+    # the amount of output the command produces. If the spool file can not be written, e.g. the disk
+    # is full, the lines which do not fit in the tail are dropped and replaced by a note.
+    #
+
+    ChunkSize = 64*1024
+
+    def __init__(self, tail_size=64*1024, spool_dir=None, name="out", keep=False):
+        self.TailSize = tail_size
+        self.SpoolDir = spool_dir
+        self.Name = name
+        self.Keep = keep
+        self.Tail = deque()             # (line, size in bytes)
+        self.TailBytes = 0
+        self.Spool = None
+        self.SpoolPath = None
+        self.SpooledBytes = 0
+        self.SpoolError = None          # OSError from the spool file, the output is not spooled after it
+        self.LostBytes = 0              # dropped after the spool error
+        self.Partial = b""
+
+    def feed(self, data):
+        # data: bytes as read from the pipe. Returns list of complete lines decoded
+        data = self.Partial + data
+        lines = data.split(b"\n")
+        self.Partial = lines[-1]
+        lines = lines[:-1]
+        if len(self.Partial) > self.TailSize:
+            # very long line without newline - do not let it grow forever
+            lines.append(self.Partial)
+            self.Partial = b""
+        out = []
+        for line in lines:
+            text = line.decode("utf-8", errors="replace")
+            self.append(text + "\n", len(line) + 1)
+            out.append(text)
+        return out
+
+    def flush(self):
+        # called at EOF. Returns the last incomplete line, if any
+        if self.Partial:
+            line = self.Partial.decode("utf-8", errors="replace")
+            self.append(line, len(self.Partial))
+            self.Partial = b""
+            return [line]
+        return []
+
+    def append(self, line, size):
+        self.Tail.append((line, size))
+        self.TailBytes += size
+        while self.TailBytes > self.TailSize and len(self.Tail) > 1:
+            old, old_size = self.Tail.popleft()
+            self.TailBytes -= old_size
+            if self.SpoolError is not None or not self.spill(old, old_size):
+                self.LostBytes += old_size
+
+    def spill(self, line, size):
+        try:
+            if self.Spool is None:
+                fd, self.SpoolPath = tempfile.mkstemp(prefix="director-", suffix="." + self.Name, dir=self.SpoolDir)
+                self.Spool = os.fdopen(fd, "w", encoding="utf-8")
+            self.Spool.write(line)
+        except OSError as e:
+            self.SpoolError = e         # e.g. no space left
+            return False
+        self.SpooledBytes += size
+        return True
+
+    @property
+    def spilled(self):
+        # True if the output is not all in the tail
+        return self.SpooledBytes > 0 or self.LostBytes > 0
+
+    def tail(self):
+        return "".join(line for line, _ in self.Tail)
+
+    def lines(self):
+        # iterates over the whole output, reading the spooled part from the file
+        if self.SpoolPath is not None:
+            if self.Spool is not None:
+                self.Spool.flush()
+            with open(self.SpoolPath, "r", encoding="utf-8") as f:
+                yield from f
+        if self.LostBytes:
+            yield f"[{self.LostBytes} bytes lost: {self.SpoolError}]\n"
+        for line, _ in self.Tail:
+            yield line
+
+    def text(self):
+        return "".join(self.lines())
+
+    def __bool__(self):
+        # True if there is anything but white space in the output
+        return self.spilled or any(line.strip() for line, _ in self.Tail)
+
+    def close(self):
+        if self.Spool is not None:
+            try:
+                self.Spool.close()
+            except OSError:
+                pass
+            self.Spool = None
+            if not self.Keep:
+                try:    os.remove(self.SpoolPath)
+                except OSError: pass
+                self.SpoolPath = None
@@ -1,7 +1,6 @@
-import pprint
-from lark import Tree, Lark, Transformer
-import textwrap
-from .groups import Command, ParallelGroup, SequentialGroup
+import os, hashlib, pickle, tempfile
+from .groups import Command, ParallelGroup, SequentialGroup, SweepGroup
+from .version import Version
 
 grammar = """
 ?script: step
@@ -26,12 +25,15 @@ options : option+
 
 opt: "-" CNAME "=" value 
 
-env: "env" CNAME "=" value 
+env: ENV CNAME "=" value 
 
 ?value : (WORD|STRING)
 
 CMD: /[a-zA-Z0-9.\/][^\r\n\#]*/x
 
+// "env" is a keyword only when followed by NAME=, otherwise it is the beginning of a command
+ENV.3: /env(?=[ \\t]+[a-zA-Z_]\\w*[ \\t]*=)/
+
 %import common.CNAME
 %import common.INT
 %import common.NEWLINE
@@ -41,16 +43,30 @@ CMD: /[a-zA-Z0-9.\/][^\r\n\#]*/x
 %ignore NEWLINE
 %ignore WS
 
-COMMENT.4: "#" /[^\r\n]+/x? NEWLINE
+COMMENT.4: /#[^\\r\\n]*/
 %ignore COMMENT
 
-WORD.1 : /[^ ]+/
+WORD.1 : /[^\\s]+/
 STRING.2 : /("(?!"").*?(?<!\\\\)(\\\\\\\\)*?"|'(?!'').*?(?<!\\\\)(\\\\\\\\)*?')/i
 UNQUOTED_STRING : /[a-z0-9:%$@_^.%*?-]+/i
 
 """
 
-parser = Lark(grammar, start="script")
+def cache_dir(name):
+    # directory in the user cache, or None if it can not be created
+    directory = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "director", name)
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    return directory
+
+def cache_path():
+    # LALR tables are cached on disk. Lark verifies the grammar hash when loading the cache
+    directory = cache_dir("")
+    if directory is None:
+        return False
+    return os.path.join(directory, f"parser-{Version}.lark")
 
 
 class Node(object):
@@ -86,109 +102,89 @@ class Node(object):
     def pretty(self):
         return "\n".join(self.format())
 
-class Parser(Transformer):
-    
-    def parse(self, text):
-        parsed = Lark(grammar, start="script").parse(text)
-        #print(parsed.pretty())
-        return self.transform(parsed)
-
-    def sequential(self, args):
-        opts = None
-        steps = []
-        env = None
-        for arg in args:
-            if arg.Type == "options":
-                opts = arg["opts"]
-                env = arg["env"]
-            elif arg.Type == "steps":
-                steps = arg.Children
-        return Node("sequential", steps, env=env, opts=opts)
-    
-    def parallel(self, args):
-        opts = None
-        steps = []
-        env = None
-        for arg in args:
-            if arg.Type == "options":
-                opts = arg["opts"]
-                env = arg["env"]
-            elif arg.Type == "steps":
-                steps = arg.Children
-        return Node("parallel", steps, env=env, opts=opts)
-    
-    def command(self, args):
-        opts = None
-        env = None
-        if isinstance(args[0], Node) and args[0].Type == "options":
-            opts = args[0]["opts"]
-            env = args[0]["env"]
-            cmd = args[1].value.strip()
-        else:
-            cmd = args[0].value.strip()
-        return Node("command", command=cmd, env=env, opts=opts)
-    
-    def step(self, args):
-        #print("step: args:", args)
-        assert len(args) == 2 and args[0].Type == "options"
-        opts = args[0]["opts"].copy()
-        env = args[0]["env"].copy()
-        
-        opts.update(args[1].get("opts") or {})
-        env.update(args[1].get("env") or {})
-        args[1]["opts"] = opts
-        args[1]["env"] = env
-        return args[1]
-    
-    def env(self, args):
-        #print("env: args:", args)
-        name = args[0].value.strip()
-        if args[1].type == "STRING":
-            value = args[1].value[1:-1]         # remove quotes
-        else:
-            value = args[1].value.strip()
-        return Node("env", env={name:value})
-    
-    def opt(self, args):
-        name = args[0].value.strip()
-        if args[1].type == "STRING":
-            value = args[1].value[1:-1]         # remove quotes
-        else:
-            value = args[1].value.strip()
-        return Node("opt", opt={name:value})
-    
-    def concurrency(self, args):
-        n = int(args[0].strip())
-        return Node("opt", data={"concurrency": int(args[0].value)})
-    
-    def options(self, nodes):
-        env = {}
-        opts = {}
-        for node in nodes:
-            if node.Type == "opt":
-                opts.update(node["opt"])
-            elif node.Type == "env":
-                env.update(node["env"])
-        return Node("options", opts=opts, env=env)
-    
-    def __default__(self, type, args, meta):
-        return Node(type.value, args)
-
-def convert(node, level=0):
+ParsedCacheSize = 1000           # parse trees kept on disk
+ParsedCacheMaxText = 256*1024   # larger scripts are not cached
+ParsedCacheFormat = "1"         # change when the Node class changes
+
+def source_hash():
+    # hash of the sources the parse tree depends on: the transformer in grammar.py and this module
+    # with the grammar and the Node class, so that trees built by an edited parser are not reused
+    h = hashlib.sha1(ParsedCacheFormat.encode("utf-8"))
+    for name in ("grammar.py", "parser.py"):
+        try:
+            with open(os.path.join(os.path.dirname(__file__), name), "rb") as f:
+                h.update(f.read())
+        except OSError:
+            h.update(Version.encode("utf-8"))
+    return h.hexdigest()
+
+def parse(text):
+    #
+    # Returns the parse tree of the script. Trees of small scripts are cached on disk, so a script
+    # run before is not parsed again and lark is not even imported.
+    #
+    path = None
+    directory = cache_dir("parsed") if len(text) <= ParsedCacheMaxText else None
+    if directory:
+        key = hashlib.sha1("\0".join([Version, source_hash(), text]).encode("utf-8")).hexdigest()
+        path = os.path.join(directory, key + ".pickle")
+        try:
+            with open(path, "rb") as f:
+                tree = pickle.load(f)
+            os.utime(path)
+            return tree
+        except Exception:
+            pass                # not there, or written by another version of the Node class
+    from .grammar import Parser
+    tree = Parser().parse(text)
+    if path:
+        try:
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(tree, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+            entries = os.listdir(directory)
+            if len(entries) > ParsedCacheSize:
+                # remove the least recently used half
+                entries = sorted((os.path.getmtime(os.path.join(directory, name)), name) for name in entries)
+                for _, name in entries[:len(entries)//2]:
+                    os.remove(os.path.join(directory, name))
+        except (OSError, pickle.PicklingError):
+            pass
+    return tree
+
+def __getattr__(name):
+    # Parser needs lark, it is imported only when used
+    if name == "Parser":
+        from .grammar import Parser
+        return Parser
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def convert(node, level=0, context=None):
     #
     # Recursively converts the Node tree into Director tasks tree
     #
     
 
     if node.Type == "command":
-        return Command(node["opts"] or {}, node["env"] or {}, level, node["command"])
+        return Command(node["opts"] or {}, node["env"] or {}, level, node["command"], context=context)
+    elif node.Type == "parallel" and ("foreach" in (node["opts"] or {}) or "matrix" in (node["opts"] or {})):
+        # sweep elements are converted from the body nodes when they are about to run
+        return SweepGroup(node["opts"], node["env"] or {}, level,
+            lambda level: convert_body(node.Children, level, context), context=context)
     elif node.Type == "parallel":
-        tasks = [convert(t, level+1) for t in node.Children]
-        return ParallelGroup(node["opts"] or {}, node["env"] or {}, level, tasks)
+        tasks = [convert(t, level+1, context) for t in node.Children]
+        return ParallelGroup(node["opts"] or {}, node["env"] or {}, level, tasks, context=context)
     elif node.Type == "sequential":
-        tasks = [convert(t, level+1) for t in node.Children]
-        return SequentialGroup(node["opts"] or {}, node["env"] or {}, level, tasks)
+        tasks = [convert(t, level+1, context) for t in node.Children]
+        return SequentialGroup(node["opts"] or {}, node["env"] or {}, level, tasks, context=context)
     else:
         raise ValueError("convert: unknown node type: " + node.Type)
 
         
+
+def convert_body(nodes, level, context):
+    # body of a sweep element: the step or a sequential group of the steps
+    if len(nodes) == 1:
+        return convert(nodes[0], level, context)
+    return SequentialGroup({}, {}, level, [convert(node, level+1, context) for node in nodes], context=context)
@@ -0,0 +1,89 @@
+import os, threading, fcntl
+
+#
+# Streaming pipes between commands of a parallel group:
+#
+#   {
+#       ( -id=extract
+#           zcat data.gz
+#       )
+#       ( -stdin=extract
+#           sort -o sorted.txt
+#       )
+#       ( -stdin=extract
+#           grep -c error
+#       )
+#   }
+#
+# A command with -stdin=<id> reads the stdout of the command with that id, which must be in the same
+# parallel group. A producer with its consumers, and their consumers, is a pipeline. Its commands run
+# at the same time, so the data goes through OS pipes instead of temporary files:
+#
+#   - one consumer: the stdout of the producer is a pipe to the stdin of the consumer
+#   - several consumers: a tee thread copies the data into a pipe per consumer. The producer is paced
+#     by the slowest consumer. When only one consumer is left, the rest is moved with splice(2)
+#
+# The pipeline starts when a slot of the group is free and the dependencies of all its commands are
+# met, and then takes as many slots as it has commands. Resources (-cpus, -mem, -uses) of all the
+# commands are acquired at once by the first one. If a command of the pipeline fails, the group is
+# shut down as usual and the other commands are killed. A producer killed by SIGPIPE because all its
+# consumers exited, e.g. "head", succeeds.
+#
+# Commands in pipelines are always run locally, and are not resumed from the journal, cached, retried
+# or speculated. In the watch mode, a pipeline is skipped only as a whole, see watch.py.
+#
+
+PipeSize = 1024*1024            # pipe buffer, limited by /proc/sys/fs/pipe-max-size
+ChunkSize = 64*1024
+
+def make_pipe():
+    r, w = os.pipe()
+    try:
+        fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, PipeSize)
+    except (OSError, AttributeError):
+        pass                    # not Linux, or above the limit; the default is 64K
+    return r, w
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def tee(source, outputs):
+    # copies the source pipe into the outputs until the end of the data or until all consumers are gone
+    try:
+        while outputs:
+            if len(outputs) == 1 and hasattr(os, "splice"):
+                while os.splice(source, outputs[0], PipeSize):
+                    pass
+                break
+            data = os.read(source, ChunkSize)
+            if not data:
+                break
+            for fd in outputs[:]:
+                try:
+                    write_all(fd, data)
+                except OSError:
+                    os.close(fd)            # the consumer exited or was killed
+                    outputs.remove(fd)
+    except OSError:
+        pass                                # the last consumer exited while splicing
+    finally:
+        os.close(source)                    # the producer gets SIGPIPE if nobody reads
+        for fd in outputs:
+            os.close(fd)
+
+def connect(members):
+    # creates the pipes between the commands of the pipeline, right before they are started.
+    # The commands close their ends after spawning the processes, see Command.close_pipes()
+    for producer in members:
+        consumers = producer.Consumers
+        if len(consumers) == 1:
+            consumers[0].PipeIn, producer.PipeOut = make_pipe()
+        elif consumers:
+            source, producer.PipeOut = make_pipe()
+            outputs = []
+            for consumer in consumers:
+                consumer.PipeIn, w = make_pipe()
+                outputs.append(w)
+            threading.Thread(target=tee, args=(source, outputs), daemon=True, name="director tee").start()
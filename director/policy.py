@@ -0,0 +1,62 @@
+import math
+
+#
+# Straggler handling options of a command:
+#
+#   -timeout=<time>         - kill the command if it runs longer, it fails then
+#   -retries=<n>            - run a failed command again up to n times
+#   -backoff=<time>         - delay before the first retry, doubled for each next one, default 1s
+#   -speculate=<percent>    - when the command runs longer than the given percentile of durations
+#                             of its siblings which succeeded, start a copy of it in a free slot
+#                             of the parallel group. The first to finish wins, the other one is killed.
+#                             For idempotent commands only.
+#
+# <time> is seconds, or a number with s, m or h suffix, e.g. 90, 1.5m, 2h.
+#
+
+def parse_duration(text):
+    text = str(text).strip().lower()
+    scale = {"s": 1, "m": 60, "h": 3600}.get(text[-1:])
+    if scale is not None:
+        text = text[:-1]
+    try:
+        return float(text) * (scale or 1)
+    except ValueError:
+        raise ValueError(f"Invalid time: {text}")
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, min(len(values), math.ceil(p * len(values) / 100.0)) - 1)]
+
+
+class StepPolicy(object):
+
+    __slots__ = ("Timeout", "Retries", "Backoff", "Speculate")
+
+    Cache = {}          # commands with the same options share the policy
+
+    def __init__(self, timeout=None, retries=0, backoff=1.0, speculate=None):
+        self.Timeout = timeout
+        self.Retries = retries
+        self.Backoff = backoff
+        self.Speculate = speculate
+
+    @staticmethod
+    def from_config(config):
+        # None if the command has none of the options
+        key = tuple(config.get(name) for name in ("timeout", "retries", "backoff", "speculate"))
+        if key == (None, None, None, None):
+            return None
+        policy = StepPolicy.Cache.get(key)
+        if policy is None:
+            timeout, retries, backoff, speculate = key
+            speculate = float(speculate) if speculate is not None else None
+            if speculate is not None and not 0 < speculate <= 100:
+                raise ValueError(f"Invalid -speculate value: {speculate}, expected percentile between 0 and 100")
+            policy = StepPolicy.Cache.setdefault(key, StepPolicy(
+                timeout = parse_duration(timeout) if timeout is not None else None,
+                retries = int(retries or 0),
+                backoff = parse_duration(backoff) if backoff is not None else 1.0,
+                speculate = speculate
+            ))
+        return policy
@@ -0,0 +1,218 @@
+import os, time, signal, threading, heapq
+
+#
+# Termination of killed commands and reaping of stray processes.
+#
+# Command.kill() does not signal the process under the step and group locks, it hands the process
+# group to the reaper thread. The thread takes all requests there are at once, e.g. all running commands
+# of a failed parallel group, finds their descendants in /proc with one scan, including those which left
+# the process group, and sends SIGTERM to all of them. Processes still alive after the grace period
+# (--kill-grace, default: 1 second, 0 - right away) get SIGKILL.
+#
+# The director command and the daemon make the process a child subreaper (PR_SET_CHILD_SUBREAPER,
+# Reaper.enable_subreaper()): descendants of commands whose parents exited are re-parented to it instead
+# of init. While they run, they are found by their process group. When they exit, the thread reaps them,
+# so they do not pile up as zombies in a long-running director (see daemon.py). Only the processes
+# adopted this way are reaped: zombies in the process group of a command, and children which were seen
+# with another parent by an earlier scan. Commands are reaped by their steps, other children of the
+# process - shell workers, processes of an application using the package - are left to their owners.
+# The package used as a library does not change the process-wide subreaper state unless asked to.
+#
+
+PR_SET_CHILD_SUBREAPER = 36
+
+def enable_subreaper():
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except (OSError, AttributeError):
+        return False                # not Linux
+
+def process_table():
+    # {pid: (ppid, pgid, state, start time)} from /proc, or None if it is not available
+    try:
+        names = os.listdir("/proc")
+    except OSError:
+        return None
+    table = {}
+    for name in names:
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat", "rb") as f:
+                    data = f.read()
+            except OSError:
+                continue            # exited meanwhile
+            fields = data[data.rindex(b")")+2:].split()        # the command name may have spaces and ")"
+            table[int(name)] = (int(fields[1]), int(fields[2]), fields[0], int(fields[19]))
+    return table if table else None
+
+def signal_process(pid, sig, group=False):
+    try:
+        if group:
+            os.killpg(pid, sig)
+        else:
+            os.kill(pid, sig)
+        return True
+    except OSError:
+        return False                # gone already
+
+
+class Termination(object):
+    #
+    # Killed command, the reaper thread fills it in
+    #
+
+    def __init__(self, pid, grace):
+        self.Pid = pid              # process group leader
+        self.Grace = grace
+        self.RequestT = time.time()
+        self.SignalT = None         # SIGTERM sent
+        self.EndT = None            # the command ended, set by Command.ended()
+        self.Strays = []            # [(pid, start time)] of descendants outside of the process group
+        self.Escalated = False      # SIGKILL was needed
+
+    @property
+    def Latency(self):
+        return None if self.EndT is None else self.EndT - self.RequestT
+
+    def dump(self):
+        return {
+            "latency":      self.Latency,
+            "signalled":    None if self.SignalT is None else self.SignalT - self.RequestT,
+            "strays":       len(self.Strays),
+            "escalated":    self.Escalated
+        }
+
+
+class ProcessReaper(object):
+
+    ReapInterval = 1.0
+
+    def __init__(self):
+        self.Lock = threading.Condition()
+        self.Requests = []          # new Terminations
+        self.Deadlines = []         # heap of (time, n, Termination) waiting for SIGKILL
+        self.Count = 0
+        self.Commands = set()       # pids of commands not reaped by their steps yet
+        self.Groups = set()         # process groups of the commands, with or without running processes
+        self.Adopted = {}           # {pid: start time} of children re-parented to this process
+        self.Table = {}             # process table of the last scan
+        self.Subreaper = False
+        self.Thread = None
+
+    def start(self):
+        # called with the lock held
+        if self.Thread is None:
+            self.Thread = threading.Thread(target=self.run, daemon=True, name="director reaper")
+            self.Thread.start()
+
+    def enable_subreaper(self):
+        # adopt orphaned descendants of commands and reap them, returns False if it is not supported
+        with self.Lock:
+            if not self.Subreaper:
+                self.Subreaper = enable_subreaper()
+                if self.Subreaper:
+                    self.start()
+                    self.Lock.notify()
+            return self.Subreaper
+
+    def register(self, pid):
+        with self.Lock:
+            self.Commands.add(pid)
+            if self.Subreaper:
+                self.Groups.add(pid)        # commands are process group leaders
+
+    def unregister(self, pid):
+        with self.Lock:
+            self.Commands.discard(pid)
+
+    def terminate(self, pid, grace):
+        # returns the Termination, signals are sent by the thread
+        termination = Termination(pid, grace)
+        with self.Lock:
+            self.start()
+            self.Requests.append(termination)
+            self.Lock.notify()
+        return termination
+
+    def run(self):
+        while True:
+            with self.Lock:
+                if not self.Requests:
+                    timeout = self.ReapInterval if self.Subreaper else None
+                    if self.Deadlines:
+                        delay = max(0.0, self.Deadlines[0][0] - time.time())
+                        timeout = delay if timeout is None else min(timeout, delay)
+                    self.Lock.wait(timeout)
+                requests, self.Requests = self.Requests, []
+            table = process_table()
+            if requests:
+                self.signal_all(requests, table)
+            due = []
+            while self.Deadlines and self.Deadlines[0][0] <= time.time():
+                due.append(heapq.heappop(self.Deadlines)[2])
+            if due:
+                self.escalate(due, process_table() if requests else table)
+            if self.Subreaper and table is not None:
+                self.reap(table)
+
+    def signal_all(self, requests, table):
+        if table is not None:
+            children = {}
+            for pid, (ppid, _, _, _) in table.items():
+                children.setdefault(ppid, []).append(pid)
+            for termination in requests:
+                stack = list(children.get(termination.Pid, ()))
+                while stack:
+                    pid = stack.pop()
+                    _, pgid, _, start = table[pid]
+                    if pgid != termination.Pid:
+                        termination.Strays.append((pid, start))
+                    stack.extend(children.get(pid, ()))
+        for termination in requests:
+            signal_process(termination.Pid, signal.SIGTERM, group=True)
+            for pid, _ in termination.Strays:
+                signal_process(pid, signal.SIGTERM)
+            termination.SignalT = time.time()
+            self.Count += 1
+            heapq.heappush(self.Deadlines, (termination.SignalT + termination.Grace, self.Count, termination))
+
+    def escalate(self, terminations, table):
+        for termination in terminations:
+            if table is None:
+                if termination.EndT is None:
+                    termination.Escalated = signal_process(termination.Pid, signal.SIGKILL, group=True)
+                continue
+            strays = dict(termination.Strays)
+            for pid, (_, pgid, state, start) in table.items():
+                if state != b"Z" and (pgid == termination.Pid or strays.get(pid) == start):
+                    if signal_process(pid, signal.SIGKILL):
+                        termination.Escalated = True
+
+    def reap(self, table):
+        me = os.getpid()
+        previous, self.Table = self.Table, table
+        alive = {pgid for _, pgid, _, _ in table.values()}
+        with self.Lock:
+            self.Groups = {pgid for pgid in self.Groups if pgid in self.Commands or pgid in alive}
+            groups = self.Groups - self.Commands
+            zombies = []
+            for pid, (ppid, pgid, state, start) in table.items():
+                if ppid != me or pid in self.Commands:
+                    continue
+                seen = previous.get(pid)
+                if seen is not None and seen[0] != me and seen[3] == start:
+                    self.Adopted[pid] = start
+                if state == b"Z" and (pgid in groups or self.Adopted.get(pid) == start):
+                    zombies.append(pid)
+            self.Adopted = {pid: start for pid, start in self.Adopted.items()
+                            if pid in table and table[pid][3] == start}
+        for pid in zombies:
+            try:
+                os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                pass
+            self.Adopted.pop(pid, None)
+
+Reaper = ProcessReaper()
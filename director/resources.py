@@ -0,0 +1,168 @@
+import threading
+from pythreader import Primitive, synchronized
+
+
+def parse_size(text):
+    # "100", "64k", "4M", "2G" -> number of bytes
+    text = text.strip().upper()
+    if text.endswith("B"):
+        text = text[:-1]
+    mult = 1
+    if text and text[-1] in "KMGT":
+        mult = 1024 ** ("KMGT".index(text[-1]) + 1)
+        text = text[:-1]
+    return int(float(text) * mult)
+
+def parse_resources(text):
+    # "db=4,gpu=2" -> {"db":4, "gpu":2}. Amount defaults to 1: "db,gpu=2" -> {"db":1, "gpu":2}
+    out = {}
+    for item in text.split(","):
+        item = item.strip()
+        if item:
+            name, _, amount = item.partition("=")
+            out[name.strip()] = int(amount) if amount else 1
+    return out
+
+
+class ResourcePool(Primitive):
+    #
+    # Global resource pools shared by all steps of the script, regardless of the group nesting:
+    #   cpus        - number of CPU slots, each command uses 1 unless it has -cpus=N
+    #   mem         - memory budget in bytes, used by commands with -mem=<size>
+    #   named       - custom resources, e.g. db=4, used by commands with -uses=db or -uses=db:2
+    # A pool with capacity None is not limited.
+    #
+    # A step starts only when all the resources it needs fit. Waiting steps are served in the order
+    # of arrival: the resources a waiting step needs are reserved for it, so a later step which needs
+    # the same pool starts only if it fits next to the reservations of all earlier waiting steps.
+    # Steps needing other pools are not held up.
+    #
+
+    def __init__(self, cpus=None, mem=None, resources={}):
+        Primitive.__init__(self)
+        self.Capacity = dict(resources)
+        self.Capacity["cpus"] = cpus
+        self.Capacity["mem"] = mem
+        self.Used = {name: 0 for name in self.Capacity}
+        self.Waiters = []           # [(step, needs, wake)], wake(granted) is called when resolved
+        self.Reserved = {}          # name -> amount needed by the waiting steps
+
+    NeedsCache = {}             # steps with the same options share the needs dict, which is never modified
+
+    @staticmethod
+    def step_needs(config):
+        key = (config.get("cpus"), config.get("mem"), config.get("uses"))
+        needs = ResourcePool.NeedsCache.get(key)
+        if needs is None:
+            needs = {"cpus": int(config.get("cpus", 1))}
+            if "mem" in config:
+                needs["mem"] = parse_size(config["mem"])
+            for name, amount in parse_resources(config.get("uses", "").replace(":", "=")).items():
+                needs[name] = needs.get(name, 0) + amount
+            needs = ResourcePool.NeedsCache.setdefault(key, needs)
+        return needs
+
+    def check(self, needs, title):
+        # raises ValueError for a resource which is not in the pool
+        for name in needs:
+            if name not in self.Capacity:
+                raise ValueError(f"Unknown resource in -uses of {title}: {name}")
+
+    def effective(self, needs):
+        # drop unlimited pools and clamp to capacity, so that a request never waits forever
+        out = {}
+        for name, amount in needs.items():
+            capacity = self.Capacity.get(name)
+            if capacity is not None and amount > 0:
+                out[name] = min(amount, capacity)
+        return out
+
+    def fits(self, needs, reserved):
+        return all(self.Used[name] + reserved.get(name, 0) + amount <= self.Capacity[name]
+                    for name, amount in needs.items())
+
+    def take(self, needs):
+        for name, amount in needs.items():
+            self.Used[name] += amount
+
+    @staticmethod
+    def reserve(reserved, needs):
+        for name, amount in needs.items():
+            reserved[name] = reserved.get(name, 0) + amount
+
+    @synchronized
+    def request(self, step, needs, wake):
+        # returns True if granted immediately, otherwise wake(granted) will be called later
+        if self.fits(needs, self.Reserved):
+            self.take(needs)
+            return True
+        self.Waiters.append((step, needs, wake))
+        self.reserve(self.Reserved, needs)
+        return False
+
+    def acquire(self, step, needs):
+        # blocks until the resources are granted. Returns False if cancelled
+        needs = self.effective(needs)
+        if not needs:
+            return True
+        event = threading.Event()
+        result = []
+        def wake(granted):
+            result.append(granted)
+            event.set()
+        if self.request(step, needs, wake):
+            return True
+        event.wait()
+        return result[0]
+
+    async def aacquire(self, step, needs):
+        # same as acquire(), for the asyncio engine
+        import asyncio
+        needs = self.effective(needs)
+        if not needs:
+            return True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def wake(granted):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(granted))
+        if self.request(step, needs, wake):
+            return True
+        return await future
+
+    @synchronized
+    def release(self, needs):
+        for name, amount in self.effective(needs).items():
+            self.Used[name] -= amount
+        self.wake_waiters()
+
+    def wake_waiters(self):
+        # called with the lock held, the reservations are rebuilt in the order of arrival
+        waiters = []
+        reserved = {}
+        for step, needs, wake in self.Waiters:
+            if self.fits(needs, reserved):
+                self.take(needs)
+                wake(True)
+            else:
+                waiters.append((step, needs, wake))
+                self.reserve(reserved, needs)
+        self.Waiters = waiters
+        self.Reserved = reserved
+
+    @synchronized
+    def cancel(self, step):
+        waiters = []
+        for waiter in self.Waiters:
+            if waiter[0] is step:
+                waiter[2](False)
+            else:
+                waiters.append(waiter)
+        self.Waiters = waiters
+        self.wake_waiters()                 # the steps after it may fit now
+
+    @synchronized
+    def dump_state(self):
+        return {
+            name: {"capacity": capacity, "used": self.Used[name]}
+            for name, capacity in self.Capacity.items() if capacity is not None
+        } | {"waiting": len(self.Waiters)}
@@ -0,0 +1,112 @@
+import os, shlex, shutil, subprocess, signal
+from subprocess import Popen
+
+#
+# Process creation for commands.
+#
+# A command without shell syntax, e.g. "/bin/echo hello" or "python script.py 'a b'", is split into
+# arguments here and started with os.posix_spawn(), without /bin/sh in between. Anything else -
+# pipes, redirections, variables, globs, builtins, etc. - is run by the shell as before.
+#
+
+ShellChars = set("|&;<>()$`\\*?[]{}~!#\n\r")
+ShellWords = {
+    # builtins and keywords which mean something different or do not exist as programs
+    ".", ":", "alias", "bg", "break", "builtin", "case", "cd", "command", "continue", "declare", "do", "done",
+    "elif", "else", "esac", "eval", "exec", "exit", "export", "fg", "fi", "for", "function", "getopts",
+    "hash", "if", "jobs", "let", "local", "read", "readonly", "return", "select", "set", "shift", "source",
+    "then", "time", "trap", "type", "typeset", "ulimit", "umask", "unalias", "unset", "until", "wait", "while"
+}
+
+def has_shell_syntax(command):
+    # True if the command has shell syntax outside of quotes, or expansions inside double quotes
+    quote = None
+    for c in command:
+        if quote == "'":
+            if c == "'":
+                quote = None
+        elif quote == '"':
+            if c == '"':
+                quote = None
+            elif c in "$`\\":
+                return True
+        elif c in "'\"":
+            quote = c
+        elif c in ShellChars:
+            return True
+    return quote is not None            # unbalanced quotes
+
+def simple_command(command):
+    # returns the list of arguments if the command can be run without the shell, otherwise None
+    if has_shell_syntax(command):
+        return None
+    argv = shlex.split(command)
+    if not argv or argv[0] in ShellWords or "=" in argv[0]:
+        return None
+    return argv
+
+
+class SpawnedProcess(object):
+    #
+    # Process started with os.posix_spawn(). Has the parts of Popen interface used by Command:
+    # pid, stdout, stderr and returncode, which is set by whoever reaps the process
+    #
+
+    def __init__(self, path, argv, env, stdin=None, stdout=None):
+        out_r, out_w = os.pipe() if stdout is None else (None, stdout)
+        err_r, err_w = os.pipe()
+        null = os.open(os.devnull, os.O_RDONLY) if stdin is None else None
+        try:
+            self.pid = os.posix_spawn(path, argv, env,
+                file_actions = [
+                    (os.POSIX_SPAWN_DUP2, stdin if stdin is not None else null, 0),
+                    (os.POSIX_SPAWN_DUP2, out_w, 1),
+                    (os.POSIX_SPAWN_DUP2, err_w, 2)
+                ],
+                setpgroup = 0,
+                setsigdef = (signal.SIGPIPE, signal.SIGXFSZ)     # ignored by python, restored like Popen does
+            )
+        except:
+            if out_r is not None:
+                os.close(out_r)
+            os.close(err_r)
+            raise
+        finally:
+            # the pipe ends are not inheritable, only the duplicates survive the exec.
+            # stdin and stdout given by the caller are closed by the caller
+            if null is not None:
+                os.close(null)
+            if stdout is None:
+                os.close(out_w)
+            os.close(err_w)
+        self.stdout = os.fdopen(out_r, "rb", buffering=0) if out_r is not None else None
+        self.stderr = os.fdopen(err_r, "rb", buffering=0)
+        self.returncode = None
+
+
+def spawn(command, env, fast=True, cwd=None, stdin=None, stdout=None):
+    # starts the command in its own process group with stdout and stderr piped and stdin from /dev/null.
+    # posix_spawn() can not change the directory, so with cwd the command is started by Popen, still without the shell.
+    # stdin, stdout: file descriptors of the pipes between commands, see pipes.py. Then process.stdout is None
+    if env is None:
+        env = os.environ
+    argv = simple_command(command) if fast else None
+    if argv is not None:
+        if cwd is not None and os.sep in argv[0]:
+            path = shutil.which(os.path.join(cwd, argv[0]))        # relative to the command directory
+        else:
+            path = shutil.which(argv[0], path=env.get("PATH", os.defpath))
+        if path is not None:
+            try:
+                if cwd is None:
+                    return SpawnedProcess(path, argv, env, stdin, stdout)
+                return Popen(argv, executable=path, cwd=cwd,
+                    stdin=stdin if stdin is not None else subprocess.DEVNULL,
+                    stdout=stdout if stdout is not None else subprocess.PIPE, stderr=subprocess.PIPE,
+                    env=env, process_group=0)
+            except OSError:
+                pass                # let the shell report the error
+    return Popen(command, shell=True, cwd=cwd,
+                stdin=stdin if stdin is not None else subprocess.DEVNULL,
+                stdout=stdout if stdout is not None else subprocess.PIPE, stderr=subprocess.PIPE,
+                env=env, process_group=0)
@@ -0,0 +1,145 @@
+import json, time
+
+#
+# Per-step resource usage, run summary and Chrome trace export
+#
+# Usage of a command is a dict:
+#   {"user": CPU user seconds, "sys": CPU system seconds, "maxrss": max RSS in KB,
+#       "inblock": blocks read, "oublock": blocks written}
+# Usage of a group is the sum of its commands usage, except maxrss which is the largest
+# max RSS of a single command.
+#
+
+def rusage_dict(ru):
+    return {
+        "user":     ru.ru_utime,
+        "sys":      ru.ru_stime,
+        "maxrss":   ru.ru_maxrss,
+        "inblock":  ru.ru_inblock,
+        "oublock":  ru.ru_oublock
+    }
+
+def aggregate_usage(usages):
+    total = None
+    for usage in usages:
+        if usage:
+            if total is None:
+                total = dict(usage)
+            else:
+                for name, value in usage.items():
+                    total[name] = max(total[name], value) if name == "maxrss" else total[name] + value
+    return total
+
+def command_spans(tree):
+    # [(start, end, command)] for the commands which have run a process
+    return sorted((
+            (step.ProcessStartT, step.EndT, step)
+            for step in tree.walk()
+            if getattr(step, "ProcessStartT", None) is not None and step.EndT is not None
+        ), key=lambda span: span[0])
+
+def assign_slots(spans):
+    # greedy interval partitioning: each span goes to the lowest numbered slot free at its start.
+    # Returns [(slot, start, end, step)] and the number of slots used
+    slot_ends = []
+    out = []
+    for t0, t1, step in spans:
+        for slot, end in enumerate(slot_ends):
+            if end <= t0:
+                break
+        else:
+            slot = len(slot_ends)
+            slot_ends.append(t1)
+        slot_ends[slot] = t1
+        out.append((slot, t0, t1, step))
+    return out, len(slot_ends)
+
+def chrome_trace(tree):
+    #
+    # Chrome trace event format, can be loaded into chrome://tracing or Perfetto.
+    # Commands are shown on one track per concurrency slot, groups on separate tracks.
+    #
+    t_base = tree.StartT or 0.0
+    events = [
+        {"ph": "M", "pid": 0, "name": "process_name", "args": {"name": "commands"}},
+        {"ph": "M", "pid": 1, "name": "process_name", "args": {"name": "groups"}},
+    ]
+    def add(pid, slots, cat):
+        for slot, t0, t1, step in slots:
+            args = {"path": step.Path, "status": step.Status, "exit_code": step.ExitCode}
+            if step.Usage:
+                args["usage"] = step.Usage
+            events.append({
+                "name": step.Title, "cat": cat, "ph": "X", "pid": pid, "tid": slot,
+                "ts": (t0 - t_base) * 1e6, "dur": (t1 - t0) * 1e6, "args": args
+            })
+        for slot in set(s[0] for s in slots):
+            events.append({"ph": "M", "pid": pid, "tid": slot, "name": "thread_name", "args": {"name": f"slot {slot}"}})
+
+    commands, _ = assign_slots(command_spans(tree))
+    add(0, commands, "command")
+    groups, _ = assign_slots(sorted((
+            (step.StartT, step.EndT, step) for step in tree.walk()
+            if hasattr(step, "Steps") and step.StartT is not None and step.EndT is not None
+        ), key=lambda span: span[0]))
+    add(1, groups, "group")
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def write_trace(tree, path):
+    with open(path, "w") as f:
+        json.dump(chrome_trace(tree), f)
+
+def pretty_size(kb):
+    for unit in "KMGT":
+        if kb < 1024 or unit == "T":
+            return "%.1f%s" % (kb, unit)
+        kb /= 1024
+
+def summary(tree, top=5):
+    lines = ["Run summary:"]
+    wall = (tree.EndT or time.time()) - (tree.StartT or time.time())
+    lines.append("  wall time:        %.2fs" % (wall,))
+
+    commands = [step for step in tree.walk() if hasattr(step, "Command")]
+    counts = {}
+    for step in commands:
+        status = "skipped" if step.Skipped else "cached" if step.Cached else (step.Status or "not run")
+        counts[status] = counts.get(status, 0) + 1
+    lines.append("  commands:         " + ", ".join(f"{n} {status}" for status, n in sorted(counts.items())))
+
+    usage = tree.Usage
+    if usage:
+        cpu = usage["user"] + usage["sys"]
+        lines.append("  CPU time:         user %.2fs, sys %.2fs, %.2f cores on average" % (
+            usage["user"], usage["sys"], cpu/wall if wall > 0 else 0.0))
+        lines.append("  max RSS:          %s (largest command)" % (pretty_size(usage["maxrss"]),))
+        lines.append("  block I/O:        %d in, %d out" % (usage["inblock"], usage["oublock"]))
+
+    cache = tree.Context.Cache
+    if cache is not None:
+        stats = cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        lines.append("  result cache:     %d hits, %d misses (%.0f%% hit rate), %d stored, %d evicted, %s restored" % (
+            stats["hits"], stats["misses"], 100.0*stats["hits"]/lookups if lookups else 0.0,
+            stats["stored"], stats["evicted"], pretty_size(stats["restored_bytes"]/1024)))
+        lines.append("                    %d entries, %s" % (stats["entries"], pretty_size(stats["size"]/1024)))
+
+    # commands killed on timeout are counted apart from those cancelled, as in their status
+    killed = [step for step in commands if step.Termination is not None and step.Termination.Latency is not None]
+    for label, timed_out in (("cancellation:", False), ("timeouts:", True)):
+        terminations = [step.Termination for step in killed if bool(step.TimedOut) == timed_out]
+        if terminations:
+            latencies = sorted(t.Latency for t in terminations)
+            lines.append("  %-17s %d commands, latency median %.3fs, max %.3fs, %d needed SIGKILL, %d stray processes" % (
+                label, len(latencies), latencies[len(latencies)//2], latencies[-1], sum(t.Escalated for t in terminations),
+                sum(len(t.Strays) for t in terminations)))
+
+    spans = command_spans(tree)
+    slots, nslots = assign_slots(spans)
+    if nslots:
+        busy = sum(t1 - t0 for t0, t1, _ in spans)
+        lines.append("  slots:            %d used at peak, %.0f%% busy" % (nslots, 100.0*busy/(nslots*wall) if wall > 0 else 0.0))
+        lines.append("  longest commands:")
+        for t0, t1, step in sorted(spans, key=lambda s: s[0] - s[1])[:top]:
+            lines.append("    %8.2fs  %-10s %s" % (t1 - t0, step.Path, step.Title))
+    return "\n".join(lines)
@@ -0,0 +1,409 @@
+import sys, os, time, glob, select, threading
+from pythreader import Primitive, synchronized
+from .journal import Journal, text_hash
+from .cache import expand
+from .groups import Command, SequentialGroup, SweepGroup
+
+#
+# director --watch: runs the script, then waits for changes of the files the commands declare
+# with -inputs=<glob>,... and of the script itself, and runs it again. Only the commands which are
+# affected by the changes run:
+#
+#   - commands whose command line, environment or input files changed since they last succeeded,
+#     and commands which did not succeed in the previous run
+#   - everything after them in their sequential groups, in the steps which depend on them with -after,
+#     and in the other commands of their -stdin pipelines
+#
+# The other commands are skipped, as with --resume. Commands without -inputs are not affected by
+# file changes. When the script is edited, it is parsed again, and the commands are matched by their
+# paths in the tree, so the commands after an inserted or removed step in the same group run again.
+# A sweep runs when a file of its elements or the script changed, and its elements check themselves.
+#
+# Changes are collected until there are none for Debounce seconds, so saving many files at once
+# starts one run. If the script, or an input file of a command which already started, changes during
+# a run, the run is killed and started again. Files written by the commands for the commands after
+# them do not restart the run.
+#
+# Directories of the input files are watched with inotify(7). Where it is not available, they are
+# polled every second.
+#
+
+Debounce = 0.3          # seconds without changes before a run starts
+
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_ONLYDIR      = 0x01000000
+
+WatchMask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+def input_state(globs):
+    # (path, size, mtime) of the input files, compared between the runs
+    state = []
+    for path in expand(globs):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        state.append((path, st.st_size, st.st_mtime_ns))
+    return tuple(state)
+
+def directories(globs):
+    # directories to watch for changes of the files matching the globs
+    dirs = set()
+    for pattern in globs:
+        parts = pattern.split(os.sep)
+        static = []
+        for part in parts[:-1]:
+            if glob.has_magic(part):
+                break
+            static.append(part)
+        base = os.sep.join(static) if static else ("/" if pattern.startswith(os.sep) else ".")
+        while base not in ("", ".", os.sep) and not os.path.isdir(base):
+            base = os.path.dirname(base)            # watch for the directory to be created
+        dirs.add(base or ".")
+        recursive = "**" in pattern
+        for path in glob.glob(pattern, recursive=True):
+            if os.path.isdir(path):
+                recursive = True
+                base = path
+            else:
+                dirs.add(os.path.dirname(path) or ".")
+        if recursive and os.path.isdir(base):
+            dirs.update(top for top, _, _ in os.walk(base))
+    return {os.path.normpath(d) for d in dirs}
+
+class INotify(object):
+    #
+    # Directory watches, wait() returns True when something changed in any of them
+    #
+
+    def __init__(self):
+        import ctypes
+        self.Libc = ctypes.CDLL(None, use_errno=True)
+        self.FD = self.Libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.FD < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.Watches = {}           # directory -> watch descriptor
+
+    def update(self, dirs):
+        for path in set(self.Watches) - dirs:
+            self.Libc.inotify_rm_watch(self.FD, self.Watches.pop(path))
+        for path in dirs - set(self.Watches):
+            wd = self.Libc.inotify_add_watch(self.FD, path.encode(), WatchMask)
+            if wd >= 0:
+                self.Watches[path] = wd
+
+    def wait(self, timeout=None):
+        readable, _, _ = select.select([self.FD], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self.FD, 64*1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.FD)
+
+
+class DirectoryPoller(object):
+    #
+    # Same as INotify, by comparing the directory listings
+    #
+
+    Interval = 1.0
+
+    def __init__(self):
+        self.Dirs = set()
+        self.Listing = None
+
+    def listing(self):
+        entries = set()
+        for path in self.Dirs:
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        entries.add((entry.path, st.st_size, st.st_mtime_ns))
+            except OSError:
+                pass
+        return entries
+
+    def update(self, dirs):
+        self.Dirs = dirs
+        self.Listing = self.listing()
+
+    def wait(self, timeout=None):
+        t1 = None if timeout is None else time.time() + timeout
+        while True:
+            delay = self.Interval if t1 is None else min(self.Interval, t1 - time.time())
+            if delay <= 0:
+                return False
+            time.sleep(delay)
+            listing = self.listing()
+            if listing != self.Listing:
+                self.Listing = listing
+                return True
+
+    def close(self):
+        pass
+
+
+def notifier():
+    try:
+        return INotify()
+    except (OSError, AttributeError):
+        return DirectoryPoller()            # not Linux
+
+
+class WatchJournal(Primitive):
+    #
+    # In-memory journal of the watch mode, used instead of Journal. Keeps the steps which succeeded,
+    # with the state of their input files when they started
+    #
+
+    def __init__(self):
+        Primitive.__init__(self)
+        self.Done = {}              # path -> (command hash, env hash, input globs, input state)
+        self.Started = {}           # path -> input state when the command started
+        self.Forced = set()         # paths of the steps which run all their commands
+        self.Checked = {}           # path -> input globs of the commands started or skipped in this run
+        self.ScriptHash = None
+
+    def stale(self, step, script_changed):
+        if isinstance(step, Command):
+            return self.Done.get(step.Path) != Journal.step_hashes(step) + (step.Inputs, input_state(step.Inputs))
+        if isinstance(step, SweepGroup):
+            if script_changed or step.Path not in self.Done:
+                return True
+            prefix = step.Path + "/"
+            return any(path.startswith(prefix) and state != input_state(globs)
+                for path, (_, _, globs, state) in self.Done.items())
+        return False
+
+    @synchronized
+    def plan(self, tree, text):
+        # finds the steps which have to run. Returns the number of them, 0 if the script is up to date.
+        # The run environment of the tree must be set
+        steps = list(tree.walk())               # without sweep elements, they do not exist yet
+        script_hash = text_hash(text)
+        script_changed, self.ScriptHash = script_hash != self.ScriptHash, script_hash
+        parents, positions = {}, {}
+        for step in steps:
+            for i, child in enumerate(getattr(step, "Steps", ())):
+                parents[child] = step
+                positions[child] = i
+        run = {step for step in steps if self.stale(step, script_changed)}
+        forced = set()
+        while True:
+            size = (len(run), len(forced))
+            first_run = {}          # sequential group -> index of its first step which runs
+            for group in steps:
+                if isinstance(group, SequentialGroup):
+                    first_run[group] = next((i for i, s in enumerate(group.Steps) if s in run), len(group.Steps))
+            for step in steps:
+                parent = parents.get(step)
+                if step not in forced and (parent in forced
+                            or any(dep in run for dep in step.Dependencies)
+                            or parent in first_run and first_run[parent] < positions[step]
+                            or isinstance(step, Command) and step.piped() and any(member in run for member in self.pipeline(step))):
+                    forced.add(step)
+                    run.add(step)
+            for step in reversed(steps):            # children before their parents
+                if step in run and step in parents:
+                    run.add(parents[step])
+            if (len(run), len(forced)) == size:
+                break
+        self.Forced = {step.Path for step in forced}
+        self.Started = {}
+        self.Checked = {}
+        return len(run)
+
+    @staticmethod
+    def pipeline(step):
+        while step.Producer is not None:
+            step = step.Producer
+        return step.pipeline()
+
+    def forced(self, path):
+        parts = path.split("/")
+        return any("/".join(parts[:i]) in self.Forced for i in range(1, len(parts)+1))
+
+    def completed(self, step):
+        state = input_state(step.Inputs)
+        record = Journal.step_hashes(step) + (step.Inputs, state)
+        with self:
+            self.Started[step.Path] = state
+            self.Checked[step.Path] = step.Inputs
+            return not self.forced(step.Path) and self.Done.get(step.Path) == record
+
+    @synchronized
+    def record(self, step):
+        state = self.Started.pop(step.Path, None)
+        if step.Status == "ok":
+            inputs = getattr(step, "Inputs", ())
+            if state is None:
+                state = input_state(inputs)
+            self.Done[step.Path] = Journal.step_hashes(step) + (inputs, state)
+        else:
+            self.Done.pop(step.Path, None)
+            self.Checked.pop(step.Path, None)
+
+    def outdated(self):
+        # input files which changed after the commands of this run which use them started or were skipped
+        with self:
+            checked = [(globs, self.Started.get(path) or self.Done.get(path, (None,)*4)[3]) for path, globs in self.Checked.items()]
+        changed = set()
+        for globs, state in checked:
+            if state is not None:
+                changed.update(path for path, _, _ in set(state) ^ set(input_state(globs)))
+        return sorted(changed)
+
+    @synchronized
+    def inputs(self, tree):
+        # input globs of the commands, including those of sweep elements from the previous runs
+        inputs = set()
+        for step in tree.walk():
+            if isinstance(step, Command):
+                inputs.update(step.Inputs)
+        for _, _, globs, _ in self.Done.values():
+            inputs.update(globs)
+        return sorted(inputs)
+
+    def close(self):
+        pass
+
+
+class Watcher(object):
+
+    def __init__(self, script_path, make_context, quiet, engine, report=None):
+        self.ScriptPath = script_path
+        self.MakeContext = make_context         # make_context(journal) -> new Context for each run
+        self.Quiet = quiet
+        self.Engine = engine
+        self.Report = report                    # report(script, status) called after each run
+        self.Journal = WatchJournal()
+        self.Notify = notifier()
+        self.Status = None                      # of the last run
+
+    def message(self, *words):
+        print(time.strftime("%H:%M:%S"), "watch:", *words, file=sys.stderr)
+
+    def snapshot(self, inputs):
+        # state of the script and of the input files, to report what changed
+        state = {path: (size, mtime) for path, size, mtime in input_state(inputs)}
+        try:
+            st = os.stat(self.ScriptPath)
+            state[self.ScriptPath] = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            pass
+        return state
+
+    def describe(self, changed):
+        if len(changed) > 3:
+            changed = changed[:3] + ["and %d more" % (len(changed) - 3,)]
+        return ", ".join(changed)
+
+    def settle(self):
+        # waits until there are no changes for Debounce seconds
+        while self.Notify.wait(Debounce):
+            pass
+
+    def load(self):
+        from .director import Script
+        try:
+            text = open(self.ScriptPath, "r").read()
+            script = Script(text, context=self.MakeContext(self.Journal))
+        except (ValueError, OSError) as e:
+            self.message("can not load script:", e)
+            return None, None
+        except Exception as e:
+            self.message("can not parse script:", e)        # lark exceptions
+            return None, None
+        script.Tree.update_run_env(dict(os.environ))
+        return script, text
+
+    def run_script(self, script, result):
+        t0 = time.time()
+        status = script.run(self.Quiet, self.Engine)
+        result.append((status, time.time() - t0))
+
+    def execute(self, script, text):
+        # runs the script in a thread. The run is killed when the script changes, or an input file
+        # of a command which already started. Returns True if the run was not killed
+        result = []
+        thread = threading.Thread(target=self.run_script, args=(script, result), daemon=True, name="director watch run")
+        thread.start()
+        try:
+            while thread.is_alive():
+                if self.Notify.wait(0.2):
+                    self.settle()
+                    changed = self.Journal.outdated()
+                    try:
+                        if open(self.ScriptPath, "r").read() != text:
+                            changed.append(self.ScriptPath)
+                    except OSError:
+                        pass
+                    if changed and thread.is_alive():
+                        self.message("changed during the run:", self.describe(changed), "- restarting")
+                        script.kill()
+                        thread.join()
+                        return False
+        except KeyboardInterrupt:
+            script.kill()
+            thread.join()
+            raise
+        thread.join()
+        self.Status, elapsed = result[0] if result else ("failed", 0.0)
+        if self.Report is not None:
+            self.Report(script, self.Status)
+        self.message(self.Status, "in %.1fs, waiting for changes" % (elapsed,))
+        return True
+
+    def run(self):
+        # runs until interrupted, returns the status of the last completed run
+        inputs, previous = [], None
+        try:
+            while True:
+                script, text = self.load()
+                ran = False
+                if script is not None:
+                    inputs = self.Journal.inputs(script.Tree)
+                    self.Notify.update(directories(inputs + [self.ScriptPath]))
+                    if self.Journal.plan(script.Tree, text):
+                        if previous is not None:
+                            current = self.snapshot(inputs)
+                            changed = sorted(p for p in set(previous) | set(current) if previous.get(p) != current.get(p))
+                            if changed:
+                                self.message("changed:", self.describe(changed))
+                        if not self.execute(script, text):
+                            continue                # start right away with the new changes
+                        ran = True
+                        inputs = self.Journal.inputs(script.Tree)
+                        self.Notify.update(directories(inputs + [self.ScriptPath]))      # created by the run
+                previous = self.snapshot(inputs)
+                changed = self.Journal.outdated() if ran else None
+                if changed:
+                    self.message("changed during the run:", self.describe(changed))
+                    continue
+                while self.snapshot(inputs) == previous:        # other files in the watched directories
+                    self.Notify.wait()
+                    self.settle()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.Notify.close()
+        return self.Status
@@ -0,0 +1,178 @@
+import os, re, uuid, shlex, signal, subprocess, selectors
+from subprocess import Popen
+from pythreader import Primitive, synchronized
+
+#
+# Long-lived shell workers. Each command is sent to an idle worker as:
+#
+#   ( export NAME=value ...; unset NAME ...; eval '<command>' ) </dev/null
+#   printf '\n<marker> %d\n' $?; printf '\n<marker>\n' >&2
+#
+# so the command runs in a subshell with its own environment, and the end of its stdout, stderr
+# and the exit code are recognized by the marker unique for the worker.
+# The worker is the leader of its process group, which includes the command processes.
+# Killing the command kills the worker too, and a new worker is started for the next command.
+#
+
+NamePattern = re.compile(r"[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class Framed(object):
+    #
+    # Splits a worker output stream into the command output and the marker line
+    #
+
+    def __init__(self, marker):
+        self.Marker = marker
+        self.Pending = b""
+        self.Trailer = None         # text after the marker, once it is found
+
+    def feed(self, data):
+        # returns the part of the data which belongs to the command output
+        if not data:
+            out, self.Pending = self.Pending, b""          # EOF, the worker is gone
+            return out
+        self.Pending += data
+        i = self.Pending.find(self.Marker)
+        if i >= 0:
+            j = self.Pending.find(b"\n", i + len(self.Marker))
+            out, self.Pending = self.Pending[:i], self.Pending[i:]
+            if j >= 0:
+                self.Trailer = self.Pending[len(self.Marker):j - i].strip()
+                self.Pending = b""
+            return out
+        n = max(0, len(self.Pending) - len(self.Marker) + 1)      # the marker may be split between reads
+        out, self.Pending = self.Pending[:n], self.Pending[n:]
+        return out
+
+    @property
+    def done(self):
+        return self.Trailer is not None
+
+
+class ShellWorker(object):
+
+    ChunkSize = 64*1024
+
+    def __init__(self):
+        self.Env = dict(os.environ)
+        self.Shell = Popen(["/bin/sh"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env=self.Env, process_group=0)
+        self.pid = self.Shell.pid
+        self.Marker = ("\n__director_%s__" % (uuid.uuid4().hex,)).encode("utf-8")
+        self.Readers = None         # asyncio StreamReaders, created on the first asynchronous use
+        self.Dead = False
+        self.returncode = None      # of the current command
+
+    def __str__(self):
+        return f"shell worker {self.pid}"
+
+    def request(self, command, env):
+        setup = []
+        for name, value in (env or {}).items():
+            if NamePattern.match(name) and self.Env.get(name) != value:
+                setup.append("export %s=%s" % (name, shlex.quote(value)))
+        if env is not None:
+            for name in self.Env:
+                if name not in env and NamePattern.match(name):
+                    setup.append("unset " + name)
+        marker = self.Marker.decode("utf-8").strip()
+        setup.append("eval " + shlex.quote(command))
+        return ("( %s ) </dev/null\nprintf '\\n%s %%d\\n' $?; printf '\\n%s\\n' >&2\n" % ("; ".join(setup), marker, marker)).encode("utf-8")
+
+    def start(self, command, env):
+        # sends the command to the worker, returns self as the Popen-like object for the command
+        self.returncode = None
+        self.Out = Framed(self.Marker)
+        self.Err = Framed(self.Marker)
+        self.Shell.stdin.write(self.request(command, env))
+        self.Shell.stdin.flush()
+        return self
+
+    def ended(self):
+        if self.Out.done:
+            self.returncode = int(self.Out.Trailer)
+        else:
+            # the worker died with the command, e.g. killed with it. Its status is that of the command
+            self.returncode = self.Shell.wait()
+            self.Dead = True
+
+    def output(self, callback):
+        # calls callback("out"|"err", bytes) for the command output until the command ends
+        framed = {self.Shell.stdout.fileno(): ("out", self.Out), self.Shell.stderr.fileno(): ("err", self.Err)}
+        with selectors.DefaultSelector() as selector:
+            for fd in framed:
+                selector.register(fd, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    name, f = framed[key.fd]
+                    data = os.read(key.fd, self.ChunkSize)
+                    out = f.feed(data)
+                    if out:
+                        callback(name, out)
+                    if not data or f.done:
+                        selector.unregister(key.fd)
+        self.ended()
+
+    async def aoutput(self, callback):
+        import asyncio
+        if self.Readers is None:
+            loop = asyncio.get_running_loop()
+            self.Readers = []
+            for pipe in (self.Shell.stdout, self.Shell.stderr):
+                reader = asyncio.StreamReader(limit=self.ChunkSize)
+                await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+                self.Readers.append(reader)
+
+        async def read(name, f, reader):
+            while not f.done:
+                data = await reader.read(self.ChunkSize)
+                out = f.feed(data)
+                if out:
+                    callback(name, out)
+                if not data:
+                    break
+
+        await asyncio.gather(read("out", self.Out, self.Readers[0]), read("err", self.Err, self.Readers[1]))
+        self.ended()
+
+    def close(self):
+        try:
+            if not self.Dead:
+                self.Shell.stdin.close()
+            else:
+                os.killpg(self.pid, signal.SIGKILL)
+        except (OSError, ValueError):
+            pass
+        self.Shell.wait()
+
+
+class WorkerPool(Primitive):
+    #
+    # Shell workers of a parallel group, one per slot, started when first needed
+    #
+
+    def __init__(self):
+        Primitive.__init__(self)
+        self.Idle = []
+        self.Busy = set()
+
+    @synchronized
+    def get(self):
+        worker = self.Idle.pop() if self.Idle else ShellWorker()
+        self.Busy.add(worker)
+        return worker
+
+    @synchronized
+    def release(self, worker):
+        self.Busy.discard(worker)
+        if worker.Dead:
+            worker.close()
+        else:
+            self.Idle.append(worker)
+
+    @synchronized
+    def close(self):
+        for worker in self.Idle:
+            worker.close()
+        self.Idle = []
@@ -28,6 +28,7 @@ setup(
     entry_points = {
             "console_scripts": [
                 "director = director.director:main",
+                "director-agent = director.agent:main",
             ]
         }
 )
\ No newline at end of file
@@ -0,0 +1,41 @@
+import os, sys, subprocess
+import pytest
+
+from director.director import Script
+from director.context import Context
+from director.agent import AgentPool
+
+#
+# Commands run and killed through an agent on localhost
+#
+
+@pytest.fixture
+def agent():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    process = subprocess.Popen([sys.executable, "-m", "director.agent", "-p", "0"], env=env, stderr=subprocess.PIPE)
+    try:
+        line = process.stderr.readline().decode("utf-8")        # director-agent listening on <host>:<port>
+        assert "listening on" in line, line
+        yield line.split()[-1]
+    finally:
+        process.kill()
+        process.wait()
+
+def run(text, address, **options):
+    script = Script(text, context=Context(history=None, agents=AgentPool.parse(address + ":2"), **options))
+    return script, script.run(True, "threads")
+
+def test_remote_run(agent):
+    script, status = run("{\n    echo hello\n    sh -c \"exit 3\"\n}\n", agent)
+    assert status == "failed"
+    echo, failed = script.Tree.Steps
+    assert echo.Status == "ok" and echo.Out.tail() == "hello\n"
+    assert failed.ExitCode == 3
+
+def test_remote_kill_grace(agent):
+    # the command gets SIGTERM first and exits by itself within the grace period
+    text = "{\n    ( -timeout=0.5s\n        sh -c \"trap 'exit 7' TERM; sleep 30 & wait\"\n    )\n}\n"
+    script, status = run(text, agent, kill_grace=5)
+    assert status == "failed"
+    assert script.Tree.Steps[0].ExitCode == 7
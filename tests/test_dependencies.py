@@ -0,0 +1,60 @@
+import threading
+import pytest
+
+from director.director import Script
+from director.context import Context
+
+#
+# A step inside a child group waits for a step of the same parallel group which has no free slot yet.
+# The child group must give up its slot meanwhile
+#
+
+Blocked = """\
+{ -multiplicity=1
+    [
+        sleep 0.5
+        ( -after=x
+            echo inner
+        )
+    ]
+    ( -id=x
+        echo x
+    )
+}
+"""
+
+def run_with_timeout(text, engine, timeout=20):
+    script = Script(text, context=Context(history=None))
+    result = []
+    thread = threading.Thread(target=lambda: result.append(script.run(True, engine)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        script.kill()
+        pytest.fail("the script did not finish in %s seconds" % (timeout,))
+    return result[0]
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_nested_dependency_on_sibling(engine):
+    assert run_with_timeout(Blocked, engine) == "ok"
+
+#
+# Elements of a sweep are created while it runs, dependencies in its body are rejected
+#
+
+InSweep = """\
+{
+    { -foreach=i:1..3
+        ( -after=x
+            echo $i
+        )
+    }
+    ( -id=x
+        echo x
+    )
+}
+"""
+
+def test_dependency_in_sweep_rejected():
+    with pytest.raises(ValueError):
+        Script(InSweep, context=Context(history=None))
@@ -0,0 +1,27 @@
+from director.director import Script
+from director.context import Context
+from director.history import schedule
+
+#
+# Predicted durations take -after into account
+#
+
+Chain = """\
+{
+    ( -id=a
+        sleep 1
+    )
+    ( -after=a
+        sleep 1
+    )
+}
+"""
+
+def test_schedule_after():
+    assert schedule([1.0, 1.0], 4) == 1.0
+    assert schedule([1.0, 1.0], 4, [[], [0]]) == 2.0
+    assert schedule([2.0, 1.0, 1.0], 2, [[], [0], []]) == 3.0
+
+def test_predict_chain():
+    script = Script(Chain, context=Context(history=None))
+    assert script.Tree.predict() == 2.0
@@ -0,0 +1,47 @@
+import threading, time
+import pytest
+
+from director.director import Script
+from director.context import Context
+
+#
+# A run is killed from another thread, as by the daemon when the client disconnects or by --watch
+#
+
+Long = """\
+{
+    sleep 30
+    sleep 30
+}
+"""
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_kill_from_another_thread(engine):
+    script = Script(Long, context=Context(history=None, kill_grace=0.2))
+    result = []
+    thread = threading.Thread(target=lambda: result.append(script.run(True, engine)), daemon=True)
+    thread.start()
+    time.sleep(0.5)
+    script.kill()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert result[0] != "ok"
+
+#
+# A command run by a shell worker and killed on timeout reports the signal which stopped it
+#
+
+Timeout = """\
+{
+    ( -timeout=0.5s
+        sleep 30
+    )
+}
+"""
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_worker_timeout_status(engine):
+    script = Script(Timeout, context=Context(history=None, shell_workers=True, kill_grace=5))
+    assert script.run(True, engine) == "failed"
+    command = script.Tree.Steps[0]
+    assert command.ExitCode == -15
@@ -0,0 +1,27 @@
+from director.output import OutputBuffer
+
+#
+# If the spool file can not be written, only the tail is kept and the rest is reported as lost
+#
+
+def test_spool_error_keeps_tail_only(tmp_path):
+    buf = OutputBuffer(tail_size=100, spool_dir=str(tmp_path / "missing"))
+    for i in range(1000):
+        buf.feed(b"line %04d \xc3\xa9\n" % (i,))
+    buf.flush()
+    assert buf.SpoolError is not None
+    assert buf.TailBytes <= 100 + 13
+    text = buf.text()
+    assert text.startswith("[%d bytes lost: " % (buf.LostBytes,))
+    assert text.endswith("line 0999 é\n")
+    assert buf.LostBytes + buf.TailBytes == 1000*13
+    buf.close()
+
+def test_spool_round_trip(tmp_path):
+    buf = OutputBuffer(tail_size=100, spool_dir=str(tmp_path))
+    data = b"".join(b"line %04d \xc3\xa9\n" % (i,) for i in range(1000))
+    buf.feed(data)
+    buf.flush()
+    assert buf.spilled and buf.LostBytes == 0
+    assert buf.text().encode("utf-8") == data
+    buf.close()
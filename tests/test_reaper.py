@@ -0,0 +1,33 @@
+import os, sys, subprocess, textwrap
+import pytest
+
+#
+# With the subreaper on, orphans of commands are reaped, other children of the process are not.
+# The subreaper is a process-wide setting, so the check runs in a separate process
+#
+
+Check = textwrap.dedent("""\
+    import os, sys, subprocess, time
+    from director.director import Script
+    from director.context import Context
+    from director.reaper import Reaper, process_table
+
+    if not Reaper.enable_subreaper():
+        sys.exit(3)
+    me = os.getpid()
+    own = subprocess.Popen(["sh", "-c", "exit 3"])
+    script = Script('sh -c "sleep 0.2 &"\\n', context=Context(history=None))
+    assert script.run(True, "threads") == "ok"
+    time.sleep(Reaper.ReapInterval*3 + 0.5)
+    zombies = {pid for pid, (ppid, _, state, _) in process_table().items() if ppid == me and state == b"Z"}
+    assert zombies == {own.pid}, zombies
+    assert own.wait() == 3
+""")
+
+def test_reaps_only_adopted():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    result = subprocess.run([sys.executable, "-c", Check], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if result.returncode == 3:
+        pytest.skip("PR_SET_CHILD_SUBREAPER is not supported")
+    assert result.returncode == 0, result.stdout.decode("utf-8", errors="replace")
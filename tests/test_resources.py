@@ -0,0 +1,25 @@
+import pytest
+
+from director.resources import ResourcePool
+
+#
+# A large request waiting for CPUs is not overtaken by smaller ones which arrive after it
+#
+
+def test_large_request_not_starved():
+    pool = ResourcePool(cpus=4)
+    granted = []
+    wake = lambda name: (lambda ok: granted.append(name))
+    assert pool.request("a", {"cpus": 1}, wake("a"))
+    assert not pool.request("big", {"cpus": 4}, wake("big"))
+    assert not pool.request("b", {"cpus": 1}, wake("b"))
+    pool.release({"cpus": 1})
+    assert granted == ["big"]
+    pool.release({"cpus": 4})
+    assert granted == ["big", "b"]
+
+def test_unknown_resource():
+    pool = ResourcePool(cpus=4, resources={"db": 1})
+    pool.check({"cpus": 1, "db": 1}, "step")
+    with pytest.raises(ValueError):
+        pool.check({"cpus": 1, "gpu": 1}, "step")
@@ -0,0 +1,22 @@
+import pytest
+
+from director.director import Script
+from director.context import Context
+
+#
+# A speculative copy which fails does not kill the original, which succeeds
+#
+
+def script_text(lock):
+    # the first run of the slow command takes the lock and succeeds, the copy fails right away
+    fast = "    true\n" * 6
+    return ("{ -multiplicity=8\n" + fast +
+        "    ( -speculate=50\n"
+        f"        sh -c \"mkdir {lock} && sleep 1.5\"\n"
+        "    )\n"
+        "}\n")
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_failed_copy_keeps_original(tmp_path, engine):
+    script = Script(script_text(tmp_path / "lock"), context=Context(history=None))
+    assert script.run(True, engine) == "ok"